@@ -20,31 +20,145 @@ import pandas as pd
 import numpy as np
 #Flask for api response return
 from flask import Flask, Response
+#Parquet and Arrow downloads
+import output_formats
 #json for api response return
 import json
 #time for sleep
 import time
 #os for file paths
 import os
+#process pool for reading site files in parallel
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from collections import deque
+import multiprocessing
+
+
+
+#Python reader for AmeriFlux BASE files
+import amf_reader
+#cached AmeriFlux site table
+import amf_sites
+#local archive of downloaded BASE zips
+import amf_archive
+
+#R-Python interface, used for site metadata (Call_API), for the 'r' reader, and for the site table when there are no database credentials
+##the manager still reads BASE files without R, R_AVAILABLE tells if the amerifluxr calls can be used
+##any error counts as R being unavailable, rpy2 raises more than ImportError when it is installed but R is missing or R_HOME is wrong
+try:
+    import rpy2
+    os.environ['R_HOME'] = 'C:\Program Files\R\R-4.3.2'
+    import rpy2.robjects as robjects
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects import conversion, default_converter
+    from rpy2.robjects.packages import importr, data
+    R_AVAILABLE = True
+except Exception as e:
+    print("R CODE INTERFACE IS NON FUNCTIONAL, AmeriFlux files will be downloaded and read in Python: " + type(e).__name__ + ": " + str(e))
+    R_AVAILABLE = False
+
+#number of processes reading AmeriFlux site files at the same time, defaults to the number of cores on the host
+SITE_WORKERS = os.cpu_count() or 1
+
+#columns of a read BASE file that aren't measurements (see amf_reader.py), plus the site id added by aggregate_site
+NON_DATA_COLUMNS = ['TIMESTAMP', 'Latitude', 'Longitude', 'station_id', 'YEAR', 'MONTH', 'DAY', 'DOY', 'HOUR', 'MINUTE', 'TIMESTAMP_START', 'TIMESTAMP_END']
+
+
+#site settings function
+##collects what aggregate_site needs from a request, so worker processes are only sent these settings and never the manager (its arguments hold the database credentials)
+##input: translation, additional_arguments, api_parameters -- same as AMFETLManager.aggregate_data
+##output: dictionary with 'reader', 'columns', 'start', 'end', 'dropNA', 'aggregation', and 'freq'
+def site_settings(translation, additional_arguments, api_parameters):
+    additional_arguments = additional_arguments or {}
+    #only the timestamps and requested data types are parsed
+    columns = None
+    if api_parameters['datatypeid'] is not None and api_parameters['datatypeid'] != '':
+        columns = api_parameters['datatypeid'].split(',')
+    aggregation = dict(additional_arguments.get('aggregation', {}))
+    return {
+        #BASE files are read in Python unless the user asks for amerifluxr's reader (Additional_Arguments 'reader' : 'r')
+        'reader': 'r' if str(additional_arguments.get('reader', 'python')).lower() == 'r' else 'python',
+        'columns': columns,
+        'start': pd.Timestamp(datetime.strptime(api_parameters['startdate'], "%Y-%m-%d %H:%M:%S")).tz_localize('GMT'),
+        'end': pd.Timestamp(datetime.strptime(api_parameters['enddate'], "%Y-%m-%d %H:%M:%S")).tz_localize('GMT'),
+        'dropNA': additional_arguments.get('dropNA') == True,
+        'aggregation': aggregation,
+        'freq': translation['aggregation'].get(aggregation.get('time'), '30T')
+    }
+
+
+#aggregate site function
+##reads one site's BASE file, cuts it to the requested times and data types, and resamples it. Runs in a worker process for multi-site requests
+##input: path -- path to the site's BASE zip file
+##input: station_id -- AmeriFlux site id
+##input: location -- (lat, lon) of the site
+##input: settings -- dictionary from site_settings
+##output: pandas DataFrame of the site's aggregated data
+def aggregate_site(path, station_id, location, settings):
+    dataset = read_base(path, settings['reader'], settings['columns'])
+    lat, lon = location
+
+    # Add station_id as a new column in the dataframe
+    dataset['station_id'] = station_id
+    dataset['Latitude'] = lat
+    dataset['Longitude'] = lon
+
+    #subset by time
+    dataset = dataset[(dataset['TIMESTAMP'] >= settings['start']) & (dataset['TIMESTAMP'] <= settings['end'])]
+    #subset to data variables if presented, otherwise every measurement column of the file
+    ##the site id and the timestamp parts aren't measurements, so they are never aggregated
+    columns = settings['columns']
+    if columns is None:
+        columns = [col for col in dataset.columns if col not in NON_DATA_COLUMNS]
+    keep_cols = ['TIMESTAMP', 'Latitude', 'Longitude']
+    keep_cols.extend(columns)
+    dataset = dataset[keep_cols]
+
+    # Replace all -9999 values with NaN
+    dataset = dataset.replace(-9999, np.nan)
+
+    if settings['dropNA']:
+        dataset = dataset.dropna()
+
+    #aggregate given variables (otherwise mean)
+    # Define the default aggregation function
+    default_agg_func = 'mean'
+
+    # Create the aggregation dictionary
+    agg_dict = {col: settings['aggregation'].get(col, default_agg_func) for col in dataset.columns if col not in NON_DATA_COLUMNS}
+
+    # Resample and aggregate the data
+    dataset = dataset.set_index('TIMESTAMP').groupby(['Latitude', 'Longitude'])
+    dataset = dataset.resample(settings['freq']).agg(agg_dict).reset_index()
+    return dataset
+
+
+#read base function
+##reads one AmeriFlux BASE file into a pandas DataFrame, both readers return the same columns (see amf_reader.py)
+##input: path -- path to the BASE zip file
+##input: reader -- 'python' (default) reads the file with amf_reader, 'r' uses amerifluxr's amf_read_base through rpy2
+##input: columns -- data columns to parse (python reader only), None parses every column
+##output: pandas DataFrame with YEAR, MONTH, DAY, DOY, HOUR, MINUTE, TIMESTAMP, and the file's columns
+def read_base(path, reader = 'python', columns = None):
+    if reader != 'r':
+        return amf_reader.read_base(path, columns = columns)
+    if not R_AVAILABLE:
+        raise RuntimeError('The r reader needs R and amerifluxr, which are not installed')
+    with conversion.localconverter(default_converter):
+        amr = importr('amerifluxr')
+        data = amr.amf_read_base(file = path, unzip = True, parse_timestamp = True)
+    with (robjects.default_converter + pandas2ri.converter).context():
+        return robjects.conversion.get_conversion().rpy2py(data)
 
 
-
-#R-Python interface
-import rpy2
-import os
-os.environ['R_HOME'] = 'C:\Program Files\R\R-4.3.2'
-import rpy2.robjects as robjects
-from rpy2.robjects import pandas2ri
-from rpy2.robjects import conversion, default_converter
-from rpy2.robjects.packages import importr, data
-
 """
 Class AMFETLManager
 Global variables:
     self.args
         - Arguments passed in by user to the Ameriflux API. There are many, so they are defined in the file noaa_api_call.py
         - There are many Call_X functions, these allow a user to call or bypass any optional data checks in the ETL manager. Typically they will remain active, unless a user has problems with a specific data check.
-        - Typical users will input 'Endpoint' (NOAA_GRID_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV or JSON for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation).
+        - Typical users will input 'Endpoint' (NOAA_GRID_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV, JSON, PARQUET, or ARROW for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation).
     self.response_codes
         - For every section of data checking that occurs, the response codes store the failure/success of the function call. This is used for debugging and indicating to the user what is happening during the data processing pipeline.
 
@@ -64,11 +178,6 @@ class AMFETLManager:
     #Data processing pipeline.
     ##First checks for direct download, if FALSE goes through optional parameters for data checking
     def process_request(self):
-        #R-Python interface
-        with conversion.localconverter(default_converter):
-            utils = importr('utils')
-            base = importr('base')
-            amr = importr('amerifluxr')
         #Database values, stores the response returned by the database -- in this implementation, it is the files from the FTP server
         db_vals = None
         #API values, stores the response returned by API calls
@@ -80,8 +189,15 @@ class AMFETLManager:
         ##Ex. URL of API, and translation from API to database (startdate : X to SQL date >= X)
         arg_trans = self.translate_endpoint(self.args['Endpoint'])
 
-        #If Call_Direct_Download is CSV or JSON --> start our data download process
-        if (self.args['Call_Direct_Download'] == 'CSV') or (self.args['Call_Direct_Download'] == 'JSON'):
+        #If Call_Direct_Download is a download format (CSV, JSON, PARQUET, or ARROW) --> start our data download process
+        if self.args['Call_Direct_Download'] in output_formats.DOWNLOAD_FORMATS:
+            #formats that can't be written from a table (NETCDF) and bad compression options are rejected before any site is downloaded
+            if self.args['Call_Aggregation']:
+                try:
+                    output_formats.check_table_format(self.args['Call_Direct_Download'], self.args['Additional_Arguments'])
+                except ValueError as e:
+                    self.response_codes['output_format'] = str(e)
+                    return json.dumps(self.response_codes, indent = 4)
             #full_call calls generate_api_call, which takes in the user's api parameters and formats it in a 'requests' API call
             full_call = self.generate_api_call(arg_trans, self.args['API_Arguments'], self.args['NOAA_API_KEY'])
             
@@ -93,6 +209,9 @@ class AMFETLManager:
             if db_vals is not None:
                 #if Call_Aggregation is True, then start aggregating the data based on additional arguments
                 if self.args['Call_Aggregation']:
+                    #streaming mode (Additional_Arguments 'stream' : True) sends each site to the user as soon as it is aggregated, so only one site is held in memory
+                    if self.args['Additional_Arguments'] is not None and self.args['Additional_Arguments'].get('stream') == True:
+                        return self.stream_response(self.site_datasets(db_vals, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments']), self.args['Call_Direct_Download'])
                     #call aggregate_data function to aggregate and clean data for user
                     db_vals = self.aggregate_data(db_vals, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments'])
                     #if we want JSON, return in JSON format
@@ -112,6 +231,18 @@ class AMFETLManager:
                             mimetype='text/csv',
                             headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
                         )
+
+                    #if we want a binary format, write it in row groups as it is sent
+                    elif self.args['Call_Direct_Download'] in output_formats.OUTPUT_FORMATS:
+                        try:
+                            return output_formats.frames_response(db_vals, self.args['Call_Direct_Download'], self.args['Additional_Arguments'])
+                        except ValueError as e:
+                            self.response_codes['output_format'] = str(e)
+                            return json.dumps(self.response_codes, indent = 4)
+            #no site could be downloaded, api_download's status for every site is in the response codes
+            if db_vals is None:
+                self.response_codes['data_download'] = "No data downloaded"
+                return json.dumps(self.response_codes, indent = 4)
             long_str = ""
             for i in db_vals:
                 long_str += (" ; " + i)
@@ -251,81 +382,107 @@ class AMFETLManager:
     ###ex. additional_arguments['aggregation']['time'] = 'weekly' --> translation['aggregation']['weekly] : 'W' (turn 'weekly' aggregation to 'W' character)
     ###ex2. additional_arguments['aggregation']['prcp'] = 'SUM' and additional_arguments['aggregation']['tavg'] = 'MEAN' --> SUM the PRCP column and MEAN the TAVG column
     def aggregate_data(self, df, translation, additional_arguments, api_parameters):
-        with conversion.localconverter(default_converter):
-            utils = importr('utils')
-            base = importr('base')
-            amr = importr('amerifluxr')
-
-        datasets = []
+        #the sites are collected and combined once at the end, instead of copying the combined table for every site
+        datasets = list(self.site_datasets(df, translation, additional_arguments, api_parameters))
+        if len(datasets) == 0:
+            return pd.DataFrame()
+        combined_df = pd.concat(datasets, ignore_index=True)
         
-        for i in df:
-            with conversion.localconverter(default_converter):
-                # Extract station_id from file name
-                file_name = os.path.basename(i)
-                station_id = file_name.split('_')[1]
-                
-                new_dat = amr.amf_read_base(file = i, unzip = True, parse_timestamp = True)
-                station_dat = amr.amf_site_info()
-                with (robjects.default_converter + pandas2ri.converter).context():
-                    new_dat = robjects.conversion.get_conversion().rpy2py(new_dat)
-                    station_dat = robjects.conversion.get_conversion().rpy2py(station_dat)
+        #return the data
+        return combined_df
 
-                #find station info
-                station_dat = station_dat[station_dat['SITE_ID'] == station_id]
 
-                lat = station_dat['LOCATION_LAT'].values[0]
-                lon = station_dat['LOCATION_LONG'].values[0]
-                
-                # Add station_id as a new column in the dataframe
-                new_dat['station_id'] = station_id
-                new_dat['Latitude'] = lat
-                new_dat['Longitude'] = lon
-                
-                datasets.append(new_dat)
-                
-        combined_df = pd.DataFrame()
-
-        start = pd.Timestamp(datetime.strptime(api_parameters['startdate'], "%Y-%m-%d %H:%M:%S")).tz_localize('GMT')     
-        end = pd.Timestamp(datetime.strptime(api_parameters['enddate'], "%Y-%m-%d %H:%M:%S")).tz_localize('GMT')
-        
-        for dataset in datasets:
-            #subset by time
-            dataset = dataset[(dataset['TIMESTAMP'] >= start) & (dataset['TIMESTAMP'] <= end)]
-            #subset to data variables if presented
-            if api_parameters['datatypeid'] is not None or api_parameters['datatypeid'] != '':
-                keep_cols = ['TIMESTAMP', 'Latitude', 'Longitude']
-                extra_cols = api_parameters['datatypeid'].split(',')
-                keep_cols.extend(extra_cols)
-                dataset = dataset[keep_cols]
-
-            # Replace all -9999 values with NaN
-            dataset.replace(-9999, np.nan, inplace=True)
-
-            if additional_arguments is not None and 'dropNA' in additional_arguments:
-                if additional_arguments['dropNA'] == True:
-                    dataset.dropna(inplace=True)
-
-            #aggregate given variables (otherwise mean)
-            # Define the default aggregation function
-            default_agg_func = 'mean'
-
-            # Create the aggregation dictionary
-            agg_dict = {col: additional_arguments['aggregation'].get(col, default_agg_func) for col in dataset.columns if col not in ['TIMESTAMP', 'Latitude', 'Longitude']}
-
-            if additional_arguments is not None:
-                freq = translation['aggregation'].get(additional_arguments['aggregation']['time'], '30T')    
-            else:
-                freq = '30T'
-            # Resample and aggregate the data
-            print(dataset)
-            dataset = dataset.set_index('TIMESTAMP').groupby(['Latitude', 'Longitude'])
-            dataset = dataset.resample(freq).agg(agg_dict).reset_index()
-            print(dataset)
-            #append to database
-            combined_df = pd.concat([combined_df, dataset], ignore_index=True)
+    #site datasets function
+    ##aggregates every site of a request, handing back each site's table as soon as it is ready (in request order)
+    ##input: df, translation, additional_arguments, api_parameters -- same as aggregate_data
+    ##output: generator of pandas DataFrames, one per site
+    def site_datasets(self, df, translation, additional_arguments, api_parameters):
+        paths = []
+        station_ids = []
+        locations = []
+        missing = []
         
-        #return the data
-        return combined_df
+        for i in df:
+            # Extract station_id from file name
+            file_name = os.path.basename(i)
+            station_id = file_name.split('_')[1]
+
+            #find station info in the cached site table (see amf_sites.py), looked up here so the table stays in this process
+            location = amf_sites.site_location(station_id, self.args.get('DB_Credentials'))
+            if location is None:
+                missing.append(station_id)
+                location = (np.nan, np.nan)
+
+            paths.append(i)
+            station_ids.append(station_id)
+            locations.append(location)
+        if len(missing) > 0:
+            self.response_codes['site_locations'] = 'Sites not found in the site table: ' + ', '.join(missing)
+
+        #every site is read, cut to the requested times and data types, and resampled on its own by aggregate_site (a module function, so only the site and settings are sent to workers)
+        ##with more than one site, the sites are spread over a pool of processes (Additional_Arguments 'parallel' : False reads them one at a time)
+        ##processes instead of threads, because parsing holds the GIL and the embedded R interpreter can't be used from threads
+        workers = min(SITE_WORKERS, len(paths))
+        if additional_arguments is not None and additional_arguments.get('parallel') == False:
+            workers = 1
+        settings = site_settings(translation, additional_arguments, api_parameters)
+        self.response_codes['aggregate_data'] = 'BASE files read with the ' + settings['reader'] + ' reader in ' + str(max(workers, 1)) + ' process(es)'
+        site_args = zip(paths, station_ids, locations, repeat(settings))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                #only one site per worker is submitted ahead, so finished sites don't pile up while the oldest one is being sent
+                pending = deque()
+                for args in site_args:
+                    pending.append(pool.submit(aggregate_site, *args))
+                    if len(pending) >= workers:
+                        yield pending.popleft().result()
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+        else:
+            for args in site_args:
+                yield aggregate_site(*args)
+
+
+    #stream response function
+    ##wraps site_datasets in a Flask streaming Response, only the site being sent is held in memory
+    ##input: frames -- generator of pandas DataFrames from site_datasets
+    ##input: file_format -- 'CSV', 'JSON', 'PARQUET', or 'ARROW'
+    ##output: Flask Response streaming the data
+    def stream_response(self, frames, file_format):
+        #PARQUET and ARROW: each site is written as its own row groups or record batches
+        if file_format in output_formats.OUTPUT_FORMATS:
+            try:
+                return output_formats.frames_response(frames, file_format, self.args['Additional_Arguments'])
+            except ValueError as e:
+                self.response_codes['output_format'] = str(e)
+                return json.dumps(self.response_codes, indent = 4)
+
+        #CSV: header line from the first site, then rows written site by site
+        def generate_csv():
+            header = True
+            for frame in frames:
+                yield frame.to_csv(index=False, header=header)
+                header = False
+
+        #JSON: one array of records, written as fragments so the full array is never held in memory
+        def generate_json():
+            yield '['
+            first = True
+            for frame in frames:
+                if len(frame) == 0:
+                    continue
+                records = frame.to_json(orient="records", lines = True).strip().replace('\n', ',\n')
+                yield ('\n' if first else ',\n') + records
+                first = False
+            yield '\n]'
+
+        if file_format == 'JSON':
+            return Response(generate_json(), mimetype='application/json')
+        return Response(
+            generate_csv(),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
+        )
 
     
     #generate api call function
@@ -389,45 +546,23 @@ class AMFETLManager:
  
     
     #api download data function
-    ##this function downloads all the data instead of just counting rows. Separated into it's own unique function due to length.
-    ##it repeats API calls, downloading data 'limit' number of rows at a time until it downloads all available data (or function errors 5 times in a row)
-    ##ex. 'limit' = 500, metadata rows = 1200.. the function will make 3 API calls
+    ##this function makes sure the BASE zip of every requested site is in the local archive (see amf_archive.py) and returns their paths
+    ##sites are only downloaded when the AmeriFlux service reports a different file version than the archived one, so repeat requests for the same sites download nothing
     ##input: url -- base url for the API
     ##input: enpoint -- the data endpoint for the API
     ##input: headers -- leading data for the API call (usually api key)
     ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
-    ##output: all_data -- all of the data for the given API call
+    ##output: list of paths to the sites' BASE zips, or None if no site could be downloaded
     def api_download(self, urls, endpoint, headers, parameters):
-        #download real data zips
-        with conversion.localconverter(default_converter):
-            utils = importr('utils')
-            base = importr('base')
-            amr = importr('amerifluxr')
+        #Additional_Arguments 'refresh' : True asks the service for new versions even if the sites were checked recently
+        refresh = self.args.get('Additional_Arguments') is not None and self.args['Additional_Arguments'].get('refresh') == True
+        results = amf_archive.fetch_archives(parameters, parameters['out_dir'], refresh)
+        self.response_codes['api_download'] = {result['site_id']: result['status'] + ('' if result['version'] is None else ' (version ' + result['version'] + ')') for result in results}
 
-        user_id = parameters['user_id']
-        user_email = parameters['user_email']
-        sites = parameters['site_id']
-        data_product = 'BASE-BADM'
-        data_policy = parameters['data_policy']
-        agree_policy = parameters['agree_policy']
-        intended_use = parameters['intended_use']
-        intended_use_text = parameters['intended_use_text']
-        verbose = parameters['verbose']
-        out_dir = parameters['out_dir']
-
-        with conversion.localconverter(default_converter):
-            target_folder = amr.amf_download_base(user_id = user_id,
-                  user_email = user_email,
-                  site_id = sites,
-                  data_product = data_product,
-                  data_policy = data_policy,
-                  agree_policy = agree_policy,
-                  intended_use = intended_use,
-                  intended_use_text = intended_use_text,
-                  verbose = verbose,
-                  out_dir = out_dir)
-        
-        return target_folder
+        paths = [result['path'] for result in results if result['path'] is not None]
+        if len(paths) == 0:
+            return None
+        return paths
         
 
     #check completeness function
@@ -0,0 +1,250 @@
+"""
+AmeriFlux Archive Cache
+
+This file keeps a local archive of downloaded AmeriFlux BASE zips for AMFETLManager, in place of calling amerifluxr's amf_download_base for every request.
+The archive has an index file in the download folder, with one entry per site and data product recording the file version it holds (ex. 19-5 in AMF_US-Ha1_BASE-BADM_19-5.zip).
+The AmeriFlux download service is asked for the current file of each site, and a site is only downloaded when its version differs from the one in the archive, so repeat requests for the same sites download nothing.
+Sites checked within ARCHIVE_CONFIG['ttl'] seconds skip the service call as well. If the service can't be reached, the archived files are used and reported as 'stale'.
+Files are downloaded with grid_download.py, so transfers are resumed, verified, and only moved into place once complete.
+"""
+
+#Imports
+#requests for the AmeriFlux download service
+import requests
+#shared downloader (resume, verify, retries)
+import grid_download
+#ThreadPoolExecutor to download several sites at once
+from concurrent.futures import ThreadPoolExecutor
+#urlparse for file names in download urls
+from urllib.parse import urlparse
+#json for the archive index
+import json
+#os for file paths
+import os
+#re for reading versions from file names
+import re
+#threading so Flask requests don't write the index at the same time
+import threading
+#time for check times
+import time
+
+#Archive settings
+##api -- AmeriFlux download service, returns a download url for every requested site
+##index -- name of the index file kept in the download folder
+##ttl -- seconds a site's version check is trusted before the service is asked again
+##timeout -- seconds to wait for the service to respond
+ARCHIVE_CONFIG = {
+    'api': 'https://amfcdn.lbl.gov/api/v1/data_download',
+    'index': 'amf_archive.json',
+    'ttl': 3600,
+    'timeout': 60
+}
+
+#data product the manager downloads
+DATA_PRODUCT = 'BASE-BADM'
+
+#download file names, ex. AMF_US-Ha1_BASE-BADM_19-5.zip
+FILE_PATTERN = re.compile(r'^AMF_(?P<site>[^_]+)_(?P<product>[^_]+)_(?P<version>[^_]+)\.zip$')
+
+#intended_use codes accepted by amf_download_base, and the text the download service expects for them
+INTENDED_USE = {
+    'synthesis': 'Research - Multi-site synthesis',
+    'model': 'Research - Land model/Earth system model',
+    'remote_sensing': 'Research - Remote sensing',
+    'other_research': 'Research - Other',
+    'education': 'Education (Teacher or Student)',
+    'other': 'Other'
+}
+
+_index_lock = threading.Lock()
+
+
+#index path function
+##input: folder -- download folder
+##output: path to the folder's archive index
+def index_path(folder):
+    return os.path.join(folder, ARCHIVE_CONFIG['index'])
+
+
+#read index function
+##input: folder -- download folder
+##output: dictionary of site_id : {data product : archive entry}, or an empty dictionary if there is no index yet
+def read_index(folder):
+    try:
+        with open(index_path(folder)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+#write index function
+##writes to a temporary file and renames it, so the index is never half written
+##input: folder -- download folder
+##input: index -- dictionary from read_index
+def write_index(folder, index):
+    tmp = index_path(folder) + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(index, file, indent=4)
+    os.replace(tmp, index_path(folder))
+
+
+#archived entry function
+##input: index -- dictionary from read_index
+##input: folder -- download folder
+##input: site_id, product -- site and data product
+##output: the site's archive entry, or None if it isn't archived or its file is gone
+def archived_entry(index, folder, site_id, product):
+    entry = index.get(site_id, {}).get(product)
+    if entry is None or not os.path.isfile(os.path.join(folder, entry['file'])):
+        return None
+    return entry
+
+
+#file name function
+##input: url -- download url from the AmeriFlux service, which can end in a query string
+##output: name of the file the url downloads
+def file_name(url):
+    return os.path.basename(urlparse(url).path)
+
+
+#file version function
+##input: name -- download file name, ex. AMF_US-Ha1_BASE-BADM_19-5.zip
+##output: the file's version (ex. 19-5), or None if the name doesn't follow the AmeriFlux pattern
+def file_version(name):
+    match = FILE_PATTERN.match(name)
+    if match is None:
+        return None
+    return match.group('version')
+
+
+#request urls function
+##asks the AmeriFlux download service for the current file of every site, the same request amf_download_base makes
+##input: parameters -- AMF_DATA API_Arguments ('user_id', 'user_email', 'data_policy', 'agree_policy', 'intended_use', 'intended_use_text')
+##input: sites -- list of site ids
+##input: product -- data product
+##output: dictionary of site_id : download url, raises requests.RequestException if the service can't be reached
+def request_urls(parameters, sites, product = DATA_PRODUCT):
+    body = {
+        'user_id': parameters['user_id'],
+        'user_email': parameters['user_email'],
+        'data_product': product,
+        'data_policy': parameters['data_policy'],
+        'site_ids': list(sites),
+        'intended_use': INTENDED_USE.get(parameters['intended_use'], parameters['intended_use']),
+        'description': f"Download {product} for {parameters['intended_use_text']}",
+        'agree_policy': bool(parameters['agree_policy'])
+    }
+    response = grid_download.SESSION.post(ARCHIVE_CONFIG['api'], json=body, timeout=ARCHIVE_CONFIG['timeout'])
+    response.raise_for_status()
+    return {item['site_id']: item['url'] for item in response.json().get('data_urls', [])}
+
+
+#archive result function
+##input: site_id -- site id
+##input: entry -- archive entry, or None
+##input: folder -- download folder
+##input: status -- what happened to the site
+##output: dictionary with 'site_id', 'version', 'path', and 'status'
+def archive_result(site_id, entry, folder, status):
+    if entry is None:
+        return {'site_id': site_id, 'version': None, 'path': None, 'status': status}
+    return {'site_id': site_id, 'version': entry['version'], 'path': os.path.join(folder, entry['file']), 'status': status}
+
+
+#fetch archives function
+##makes sure the archive holds the current BASE zip of every site, only downloading sites whose version changed
+##input: parameters -- AMF_DATA API_Arguments, 'site_id' is one site id or a list of them
+##input: folder -- download folder (API_Arguments 'out_dir')
+##input: refresh -- True asks the service for every site, even ones checked within ARCHIVE_CONFIG['ttl']
+##input: product -- data product
+##output: list of archive_result dictionaries in the order of the sites, status is:
+###'cached' -- the archived file is current, nothing was downloaded
+###'downloaded' -- the site wasn't archived and was downloaded
+###'updated' -- the site has a new version, which replaced the archived one
+###'stale' -- the service or download failed, the archived file was used
+###'missing' -- the service has no file for the site
+###'failed' -- the service or download failed and nothing is archived, the 'error' is included
+def fetch_archives(parameters, folder, refresh = False, product = DATA_PRODUCT):
+    sites = parameters['site_id']
+    if isinstance(sites, str):
+        sites = [sites]
+    os.makedirs(folder, exist_ok=True)
+    with _index_lock:
+        index = read_index(folder)
+
+    now = time.time()
+    results = {}
+    to_check = []
+    for site_id in sites:
+        entry = archived_entry(index, folder, site_id, product)
+        if entry is not None and not refresh and now - entry['checked_at'] < ARCHIVE_CONFIG['ttl']:
+            results[site_id] = archive_result(site_id, entry, folder, 'cached')
+        else:
+            to_check.append(site_id)
+    if len(to_check) == 0:
+        return [results[site_id] for site_id in sites]
+
+    #one call to the service gives the current file of every site we need to check
+    try:
+        urls = request_urls(parameters, to_check, product)
+        error = None
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"AmeriFlux download service failed, using archived files: {e}")
+        urls = {}
+        error = str(e)
+
+    updates = {}
+    downloads = []
+    for site_id in to_check:
+        entry = archived_entry(index, folder, site_id, product)
+        url = urls.get(site_id)
+        if url is None:
+            if entry is not None:
+                results[site_id] = archive_result(site_id, entry, folder, 'stale')
+            elif error is not None:
+                results[site_id] = dict(archive_result(site_id, None, folder, 'failed'), error=error)
+            else:
+                results[site_id] = archive_result(site_id, None, folder, 'missing')
+            continue
+        name = file_name(url)
+        version = file_version(name)
+        #the url names the current version, so an unchanged site needs no download at all
+        if entry is not None and version is not None and entry['version'] == version:
+            updates[site_id] = dict(entry, checked_at=now)
+            results[site_id] = archive_result(site_id, updates[site_id], folder, 'cached')
+        else:
+            downloads.append((site_id, url, name, version, entry))
+
+    if len(downloads) > 0:
+        workers = min(grid_download.DOWNLOAD_CONFIG['workers'], len(downloads))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = list(executor.map(lambda d: grid_download.download_with_retries(d[1], folder, d[2]), downloads))
+        for (site_id, url, name, version, entry), download in zip(downloads, fetched):
+            if download['status'] in ('missing', 'failed'):
+                if entry is not None:
+                    results[site_id] = archive_result(site_id, entry, folder, 'stale')
+                else:
+                    results[site_id] = dict(archive_result(site_id, None, folder, 'failed'), error=download.get('error'))
+                continue
+            updates[site_id] = {
+                'version': version,
+                'file': name,
+                'url': url,
+                'size': download['size'],
+                'sha256': download['sha256'],
+                'fetched_at': download['fetched_at'],
+                'checked_at': now
+            }
+            results[site_id] = archive_result(site_id, updates[site_id], folder, 'updated' if entry is not None else 'downloaded')
+            #the old version is dropped once the new one is in place
+            if entry is not None and entry['file'] != name:
+                grid_download.remove_file(os.path.join(folder, entry['file']))
+
+    #the index is read again before writing, so entries written by other requests in the meantime are kept
+    if len(updates) > 0:
+        with _index_lock:
+            index = read_index(folder)
+            for site_id, entry in updates.items():
+                index.setdefault(site_id, {})[product] = entry
+            write_index(folder, index)
+    return [results[site_id] for site_id in sites]
@@ -0,0 +1,94 @@
+"""
+AmeriFlux BASE File Reader
+
+This file reads AmeriFlux BASE data files in Python, in place of amerifluxr's amf_read_base through rpy2.
+A BASE download is a zip (ex. AMF_US-Ha1_BASE-BADM_19-5.zip) holding one half-hourly or hourly CSV (ex. AMF_US-Ha1_BASE_HH_19-5.csv).
+The CSV starts with '#' comment lines (site and version), then a header line, then one row per time step with TIMESTAMP_START and TIMESTAMP_END as YYYYMMDDHHMM numbers and -9999 for missing values.
+The CSV is read straight out of the zip as it is decompressed, every data column is parsed as a number with -9999 turned into NaN while parsing, and the timestamps are parsed with integer arithmetic on whole columns.
+The result has the same columns as amf_read_base(unzip = TRUE, parse_timestamp = TRUE): YEAR, MONTH, DAY, DOY, HOUR, MINUTE, TIMESTAMP (GMT), then the file's own columns.
+"""
+
+#Imports
+#numpy and pandas for parsing
+import numpy as np
+import pandas as pd
+#zipfile for reading the CSV out of the zip without extracting it
+import zipfile
+#re for finding the BASE CSV inside the zip
+import re
+#defaultdict for column types
+from collections import defaultdict
+
+#BASE CSV names inside the zip, ex. AMF_US-Ha1_BASE_HH_19-5.csv (HH = half-hourly, HR = hourly)
+BASE_PATTERN = re.compile(r'_BASE_(HH|HR)_.*\.csv$')
+#value AmeriFlux uses for missing data
+MISSING_VALUE = -9999
+#columns holding YYYYMMDDHHMM timestamps
+TIMESTAMP_COLUMNS = ('TIMESTAMP_START', 'TIMESTAMP_END')
+
+
+#parse timestamps function
+##turns AmeriFlux YYYYMMDDHHMM numbers into dates, the parts are split with integer arithmetic on the whole column at once
+##input: values -- array of YYYYMMDDHHMM numbers
+##output: pandas DatetimeIndex in GMT, missing values are NaT
+def parse_timestamps(values):
+    values = np.asarray(values, dtype='float64')
+    valid = np.isfinite(values) & (values != MISSING_VALUE)
+    stamps = np.where(valid, values, 197001010000).astype('int64')
+    parts = pd.DataFrame({
+        'year': stamps // 100000000,
+        'month': stamps // 1000000 % 100,
+        'day': stamps // 10000 % 100,
+        'hour': stamps // 100 % 100,
+        'minute': stamps % 100
+    })
+    times = pd.DatetimeIndex(pd.to_datetime(parts)).tz_localize('GMT')
+    return times.where(valid)
+
+
+#read csv function
+##input: handle -- open binary file or path of a BASE CSV
+##input: columns -- data columns to parse, None parses every column. The timestamp columns are always parsed
+##output: pandas DataFrame of the file's columns, timestamps as whole numbers and everything else as floats with NaN for missing values
+def read_csv(handle, columns = None):
+    column_types = defaultdict(lambda: 'float64')
+    for column in TIMESTAMP_COLUMNS:
+        column_types[column] = 'int64'
+    usecols = None
+    if columns is not None:
+        wanted = set(TIMESTAMP_COLUMNS) | set(columns)
+        usecols = lambda column: column in wanted
+    return pd.read_csv(handle, comment='#', dtype=column_types, na_values=[MISSING_VALUE, str(MISSING_VALUE)], usecols=usecols, engine='c')
+
+
+#read base function
+##reads an AmeriFlux BASE file, the same interface as amerifluxr's amf_read_base(file, unzip = TRUE, parse_timestamp = TRUE)
+##input: path -- path to a BASE zip, or to a BASE CSV that was already extracted
+##input: parse_timestamp -- True adds the YEAR, MONTH, DAY, DOY, HOUR, MINUTE, and TIMESTAMP columns from TIMESTAMP_START
+##input: columns -- see read_csv
+##output: pandas DataFrame
+def read_base(path, parse_timestamp = True, columns = None):
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if BASE_PATTERN.search(name)]
+            if len(names) == 0:
+                raise ValueError(f'{path} has no BASE CSV file')
+            #the member is decompressed as pandas reads it, the whole CSV is never held in memory as text
+            with archive.open(names[0]) as handle:
+                data = read_csv(handle, columns)
+    else:
+        data = read_csv(path, columns)
+
+    if not parse_timestamp:
+        return data
+    times = parse_timestamps(data['TIMESTAMP_START'].values)
+    parts = pd.DataFrame({
+        'YEAR': times.year,
+        'MONTH': times.month,
+        'DAY': times.day,
+        'DOY': times.dayofyear,
+        'HOUR': times.hour,
+        'MINUTE': times.minute,
+        'TIMESTAMP': times
+    }, index=data.index)
+    return pd.concat([parts, data], axis=1)
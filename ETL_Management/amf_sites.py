@@ -0,0 +1,98 @@
+"""
+AmeriFlux Site Metadata Cache
+
+This file keeps the AmeriFlux site table (amerifluxr's amf_site_info) in memory, indexed by SITE_ID, so looking up a site's location is a dictionary lookup.
+The table is loaded once per process and reloaded after SITE_CONFIG['ttl'] seconds.
+It is read from the amf_stations table (loaded by SETUP_DB/AMERIFLUX_LOAD_DB.ipynb) when database credentials are given, otherwise from amerifluxr through rpy2.
+If a reload fails the last table is kept, so a database or R hiccup doesn't break requests that were working.
+"""
+
+#Imports
+#psycopg2 for database errors
+import psycopg2
+#shared database connection pool
+import db_pool
+#threading so Flask requests share one table and only one of them reloads it
+import threading
+#time for the refresh interval
+import time
+
+#Site table settings
+##ttl -- seconds a loaded site table is used before it is reloaded
+SITE_CONFIG = {
+    'ttl': 86400
+}
+
+#cached site table, keyed by SITE_ID
+_cache = {'sites': None, 'loaded_at': 0, 'source': None}
+_cache_lock = threading.Lock()
+
+
+#load from database function
+##input: db_credentials -- dictionary containing 'dbname', 'user', 'password', 'host', and 'port'
+##output: dictionary of SITE_ID : site row, with the same (upper case) column names as amf_site_info
+def load_from_database(db_credentials):
+    conn = db_pool.get_pool(db_credentials).getconn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM amf_stations;')
+        columns = [col[0].upper() for col in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return {row['SITE_ID']: row for row in (dict(zip(columns, values)) for values in rows)}
+
+
+#load from R function
+##output: dictionary of SITE_ID : site row from amerifluxr's amf_site_info
+def load_from_r():
+    #imported here so this file works without R
+    import rpy2.robjects as robjects
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects import conversion, default_converter
+    from rpy2.robjects.packages import importr
+    with conversion.localconverter(default_converter):
+        amr = importr('amerifluxr')
+        sites = amr.amf_site_info()
+    with (robjects.default_converter + pandas2ri.converter).context():
+        sites = robjects.conversion.get_conversion().rpy2py(sites)
+    return {row['SITE_ID']: row for row in sites.to_dict('records')}
+
+
+#site table function
+##input: db_credentials -- database credentials, or None to load the table from amerifluxr
+##output: dictionary of SITE_ID : site row, reloaded when it is older than SITE_CONFIG['ttl']
+def site_table(db_credentials = None):
+    with _cache_lock:
+        if _cache['sites'] is not None and time.time() - _cache['loaded_at'] < SITE_CONFIG['ttl']:
+            return _cache['sites']
+        try:
+            if db_credentials is not None:
+                sites = load_from_database(db_credentials)
+                source = 'amf_stations'
+            else:
+                sites = load_from_r()
+                source = 'amerifluxr'
+        except (psycopg2.Error, ImportError, RuntimeError, KeyError) as e:
+            if _cache['sites'] is None:
+                raise
+            #keep the last table, and try again after another ttl
+            print(f"Site table reload failed, using the cached table: {e}")
+            _cache['loaded_at'] = time.time()
+            return _cache['sites']
+        _cache['sites'] = sites
+        _cache['loaded_at'] = time.time()
+        _cache['source'] = source
+        return sites
+
+
+#site location function
+##input: site_id -- AmeriFlux site id (ex. US-Ha1)
+##input: db_credentials -- see site_table
+##output: (lat, lon) tuple, or None if the site isn't in the table
+def site_location(site_id, db_credentials = None):
+    site = site_table(db_credentials).get(site_id)
+    if site is None:
+        return None
+    return float(site['LOCATION_LAT']), float(site['LOCATION_LONG'])
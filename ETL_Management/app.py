@@ -2,6 +2,7 @@ from flask import Flask, jsonify, request, render_template_string
 import psycopg2
 from flask_restful import Api
 from resources.noaa_api_call import NOAAAPICall
+import db_pool
 
 
 app = Flask(__name__)
@@ -16,10 +17,33 @@ DATABASE_CONFIG = {
     'password': 'Passwordd'
 }
 
+#borrow a connection from the shared pool, conn.close() hands it back to the pool
 def get_db_connection():
-    conn = psycopg2.connect(**DATABASE_CONFIG)
+    conn = db_pool.get_pool(DATABASE_CONFIG).getconn()
     return conn
 
+#run a query on a pooled connection, the connection is handed back even if the query fails
+def fetch_rows(query, params):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            return cur.fetchall()
+        finally:
+            cur.close()
+    finally:
+        conn.close()
+
+#read the map's bounding box from the request, the corners can be given in any order
+##returns (minlat, maxlat, minlon, maxlon), None if the box isn't given, raises ValueError if a corner isn't a number
+def bounding_box():
+    corners = [request.args.get(key) for key in ('lat1', 'lon1', 'lat2', 'lon2')]
+    if not all(corners):
+        return None
+    lat1, lon1, lat2, lon2 = [float(value) for value in corners]
+    return min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2)
+
 @app.route('/')
 def index():
     return render_template_string(open('templates/index.html').read())
@@ -32,99 +56,79 @@ def gridindex():
 def amf():
     return render_template_string(open('templates/amfindex.html').read())
 
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    return jsonify(db_pool.pool_stats())
+
 @app.route('/stations', methods=['GET'])
 def stations():
-    lat1 = request.args.get('lat1')
-    lon1 = request.args.get('lon1')
-    lat2 = request.args.get('lat2')
-    lon2 = request.args.get('lon2')
-
     query = 'SELECT id, name, latitude, longitude FROM noaa_station_list'
     conditions = []
     params = []
-    
-    if lat1 and lon1 and lat2 and lon2:
-        minlat = min(lat1, lat2)
-        maxlat = max(lat1, lat2)
-        minlon = min(lon1, lon2)
-        maxlon = max(lon1, lon2)
-        conditions.append(f"latitude BETWEEN {minlat} AND {maxlat}")
-        conditions.append(f"longitude BETWEEN {maxlon} AND {minlon}")
+
+    try:
+        box = bounding_box()
+    except ValueError:
+        return jsonify({'error': 'lat1, lon1, lat2, and lon2 must be numbers'}), 400
+    if box is not None:
+        minlat, maxlat, minlon, maxlon = box
+        conditions.append("latitude BETWEEN %s AND %s")
+        conditions.append("longitude BETWEEN %s AND %s")
+        params.extend([minlat, maxlat, minlon, maxlon])
     
     if conditions:
         query += ' WHERE ' + ' AND '.join(conditions)
 
     print(query)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(query, params)
-    stations = [{'id': row[0], 'name': row[1], 'latitude': row[2], 'longitude': row[3]} for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    stations = [{'id': row[0], 'name': row[1], 'latitude': row[2], 'longitude': row[3]} for row in fetch_rows(query, params)]
 
     return jsonify(stations)
     
 @app.route('/amf_stations', methods=['GET'])
 def amf_stations():
-    lat1 = request.args.get('lat1')
-    lon1 = request.args.get('lon1')
-    lat2 = request.args.get('lat2')
-    lon2 = request.args.get('lon2')
-
     query = 'SELECT site_id, site_name, location_lat, location_long FROM amf_stations'
     conditions = []
     params = []
-    
-    if lat1 and lon1 and lat2 and lon2:
-        minlat = min(lat1, lat2)
-        maxlat = max(lat1, lat2)
-        minlon = min(lon1, lon2)
-        maxlon = max(lon1, lon2)
-        conditions.append(f"CAST(location_lat AS NUMERIC) BETWEEN {minlat} AND {maxlat}")
-        conditions.append(f"CAST(location_long AS NUMERIC) BETWEEN {maxlon} AND {minlon}")
+
+    try:
+        box = bounding_box()
+    except ValueError:
+        return jsonify({'error': 'lat1, lon1, lat2, and lon2 must be numbers'}), 400
+    if box is not None:
+        minlat, maxlat, minlon, maxlon = box
+        conditions.append("CAST(location_lat AS NUMERIC) BETWEEN %s AND %s")
+        conditions.append("CAST(location_long AS NUMERIC) BETWEEN %s AND %s")
+        params.extend([minlat, maxlat, minlon, maxlon])
     
     if conditions:
         query += ' WHERE ' + ' AND '.join(conditions)
 
     print(query)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(query, params)
-    stations = [{'id': row[0], 'name': row[1], 'latitude': row[2], 'longitude': row[3]} for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    stations = [{'id': row[0], 'name': row[1], 'latitude': row[2], 'longitude': row[3]} for row in fetch_rows(query, params)]
 
     return jsonify(stations)
     
 @app.route('/grid_points', methods=['GET'])
 def grid_points():
-    lat1 = request.args.get('lat1')
-    lon1 = request.args.get('lon1')
-    lat2 = request.args.get('lat2')
-    lon2 = request.args.get('lon2')
-
     query = 'SELECT id, latitude, longitude FROM noaa_grid_coords'
     conditions = []
     params = []
-    
-    if lat1 and lon1 and lat2 and lon2:
-        minlat = min(lat1, lat2)
-        maxlat = max(lat1, lat2)
-        minlon = min(lon1, lon2)
-        maxlon = max(lon1, lon2)
-        conditions.append(f"latitude BETWEEN {minlat} AND {maxlat}")
-        conditions.append(f"longitude BETWEEN {maxlon} AND {minlon}")
+
+    try:
+        box = bounding_box()
+    except ValueError:
+        return jsonify({'error': 'lat1, lon1, lat2, and lon2 must be numbers'}), 400
+    if box is not None:
+        minlat, maxlat, minlon, maxlon = box
+        conditions.append("latitude BETWEEN %s AND %s")
+        conditions.append("longitude BETWEEN %s AND %s")
+        params.extend([minlat, maxlat, minlon, maxlon])
     
     if conditions:
         query += ' WHERE ' + ' AND '.join(conditions)
 
     print(query)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(query, params)
-    stations = [{'id': row[0], 'latitude': row[1], 'longitude': row[2]} for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    stations = [{'id': row[0], 'latitude': row[1], 'longitude': row[2]} for row in fetch_rows(query, params)]
 
     return jsonify(stations)
 
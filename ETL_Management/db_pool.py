@@ -0,0 +1,249 @@
+"""
+Database Connection Pool
+
+This file holds a process-wide pool of psycopg2 connections shared by the Flask routes in app.py and the ETL managers.
+Opening a new connection for every request costs a TCP and authentication handshake, which is often slower than the query itself for small lookups.
+Connections are borrowed from the pool and handed back when .close() is called on them, so existing code that opens and closes connections keeps working unchanged.
+"""
+
+#Imports
+#psycopg2 for database connection
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+#threading to share the pool between Flask requests and background threads
+import threading
+#time for connection lifetimes and wait statistics
+import time
+
+#Pool settings, edit these to size the pool for your database
+##minconn -- connections opened when the pool is created
+##maxconn -- most connections the pool will open at once, requests wait when all of them are in use
+##timeout -- seconds a request will wait for a free connection before failing
+##max_lifetime -- seconds before a connection is closed and replaced by a fresh one
+##health_check -- run 'SELECT 1' on idle connections before handing them out
+POOL_CONFIG = {
+    'minconn': 1,
+    'maxconn': 10,
+    'timeout': 30,
+    'max_lifetime': 1800,
+    'health_check': True
+}
+
+#pools are kept per set of database credentials, since users can pass their own DB_Credentials
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+"""
+Class PooledConnection
+psycopg2 connection that goes back to its pool when closed, instead of disconnecting from the database.
+"""
+class PooledConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        #pool that owns this connection, set by the pool after connecting
+        self.pool = None
+        #time the connection was opened, used to recycle old connections
+        self.created_at = time.monotonic()
+        #True while the connection is sitting idle in the pool, stops it being returned twice
+        self.in_pool = False
+        #names of the prepared statements created on this connection
+        self.prepared = set()
+
+    #return the connection to the pool
+    def close(self):
+        if self.pool is not None:
+            if not self.in_pool:
+                self.pool.putconn(self)
+        else:
+            super().close()
+
+    #really disconnect from the database
+    def disconnect(self):
+        super().close()
+
+
+"""
+Class DBPool
+Global variables:
+    self.db_credentials
+        - dictionary passed directly into psycopg2.connect (dbname, user, password, host, port)
+    self.idle
+        - list of connections ready to be borrowed
+    self.size
+        - number of connections currently open (idle + in use)
+    self.counters
+        - usage statistics reported by stats()
+"""
+class DBPool:
+    #initialization of the pool, opens minconn connections right away
+    def __init__(self, db_credentials, minconn, maxconn, timeout, max_lifetime, health_check):
+        self.db_credentials = db_credentials
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.idle = []
+        self.size = 0
+        self.lock = threading.Condition()
+        self.counters = {
+            'connections_opened': 0,
+            'connections_recycled': 0,
+            'failed_health_checks': 0,
+            'borrows': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'total_wait_seconds': 0.0,
+            'max_wait_seconds': 0.0
+        }
+        for i in range(minconn):
+            conn = self.connect()
+            conn.in_pool = True
+            with self.lock:
+                self.size += 1
+                self.idle.append(conn)
+
+    #open a new connection to the database
+    def connect(self):
+        conn = psycopg2.connect(connection_factory=PooledConnection, **self.db_credentials)
+        conn.pool = self
+        with self.lock:
+            self.counters['connections_opened'] += 1
+        return conn
+
+    #check if a connection is too old, closed, or not answering
+    def is_usable(self, conn):
+        if conn.closed:
+            return False
+        if (time.monotonic() - conn.created_at) > self.max_lifetime:
+            with self.lock:
+                self.counters['connections_recycled'] += 1
+            return False
+        if self.health_check:
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                conn.rollback()
+            except psycopg2.Error:
+                with self.lock:
+                    self.counters['failed_health_checks'] += 1
+                return False
+        return True
+
+    #borrow a connection from the pool
+    ##waits up to self.timeout seconds when all connections are in use
+    ##output: PooledConnection, raises PoolError if no connection frees up in time
+    def getconn(self):
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self.lock:
+            while True:
+                #reuse an idle connection
+                if self.idle:
+                    conn = self.idle.pop()
+                    conn.in_pool = False
+                    break
+                #open a new connection if we are under the size limit
+                if self.size < self.maxconn:
+                    self.size += 1
+                    break
+                #otherwise wait for a connection to be returned
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolError(f'No database connection available after {self.timeout} seconds')
+                waited = True
+                self.lock.wait(remaining)
+
+        #checks and connecting happen outside of the lock so other requests are not blocked
+        try:
+            if conn is not None and not self.is_usable(conn):
+                conn.disconnect()
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except Exception:
+            #free the slot if we could not connect
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+
+        wait = time.monotonic() - start
+        with self.lock:
+            self.counters['borrows'] += 1
+            if waited:
+                self.counters['waits'] += 1
+            self.counters['total_wait_seconds'] += wait
+            self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], wait)
+        return conn
+
+    #return a connection to the pool
+    ##any open transaction is rolled back so the next user gets a clean connection
+    def putconn(self, conn):
+        keep = not conn.closed
+        if keep:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        recycle = keep and (time.monotonic() - conn.created_at) > self.max_lifetime
+        if recycle or not keep:
+            conn.disconnect()
+        with self.lock:
+            if recycle:
+                self.counters['connections_recycled'] += 1
+                keep = False
+            if keep:
+                conn.in_pool = True
+                self.idle.append(conn)
+            else:
+                self.size -= 1
+            self.lock.notify()
+
+    #pool usage statistics, reported in the response codes and the /pool_stats route
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = self.size
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = self.size - len(self.idle)
+            stats['maxconn'] = self.maxconn
+        if stats['borrows'] > 0:
+            stats['avg_wait_seconds'] = stats['total_wait_seconds'] / stats['borrows']
+        else:
+            stats['avg_wait_seconds'] = 0.0
+        return stats
+
+    #disconnect every idle connection
+    def closeall(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.disconnect()
+            self.size -= len(self.idle)
+            self.idle = []
+
+
+#get the process-wide pool for a set of database credentials, creating it the first time it is asked for
+##input: db_credentials -- dictionary containing 'dbname', 'user', 'password', 'host', and 'port'
+##output: DBPool object
+def get_pool(db_credentials):
+    key = tuple(sorted((k, str(v)) for k, v in db_credentials.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = DBPool(dict(db_credentials), **POOL_CONFIG)
+            _pools[key] = pool
+    return pool
+
+
+#statistics for every pool in the process, keyed by user@host/dbname (passwords are never reported)
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {f"{p.db_credentials.get('user')}@{p.db_credentials.get('host')}/{p.db_credentials.get('dbname')}": p.stats() for p in pools}
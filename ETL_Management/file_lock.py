@@ -0,0 +1,94 @@
+"""
+File Locks
+
+This file holds a lock file that works across threads and processes (ex. several gunicorn or uwsgi workers sharing one data folder).
+A lock is a file created with O_EXCL next to the file it protects, so only one holder can create it and everyone else waits until it is removed.
+Holders refresh the lock's modification time while they work. A lock that hasn't been refreshed for LOCK_CONFIG['stale'] seconds (or the lock's own stale time) belongs to a holder that died (ex. a killed worker), and is broken.
+"""
+
+#Imports
+#os for creating and removing the lock file
+import os
+#time for waiting and stale checks
+import time
+
+#Lock settings
+##stale -- seconds without a refresh before a lock is treated as abandoned and broken
+##poll -- seconds between checks while waiting for a lock
+LOCK_CONFIG = {
+    'stale': 120,
+    'poll': 0.2
+}
+
+
+"""
+Class FileLock
+Global variables:
+    self.path
+        - path of the lock file
+    self.timeout
+        - most seconds to wait for the lock, None waits until it is free
+    self.stale
+        - seconds without a refresh before the lock is treated as abandoned
+    self.refreshed
+        - time the lock was last refreshed by this holder
+"""
+class FileLock:
+    #initialization of the lock, nothing is locked until acquire (or a with block)
+    ##input: path -- path of the file to protect, the lock file is this path + '.lock'
+    ##input: timeout -- see self.timeout
+    ##input: stale -- see self.stale, None uses LOCK_CONFIG['stale']
+    def __init__(self, path, timeout = None, stale = None):
+        self.path = path + '.lock'
+        self.timeout = timeout
+        self.stale = stale or LOCK_CONFIG['stale']
+        self.refreshed = None
+
+    #take the lock, waiting while someone else holds it
+    ##raises TimeoutError if the lock isn't free within self.timeout seconds
+    def acquire(self):
+        start = time.monotonic()
+        while True:
+            try:
+                handle = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(handle, str(os.getpid()).encode())
+                os.close(handle)
+                self.refreshed = time.monotonic()
+                return
+            except FileExistsError:
+                pass
+            try:
+                age = time.time() - os.path.getmtime(self.path)
+            except FileNotFoundError:
+                #released between our two checks, try again right away
+                continue
+            if age > self.stale:
+                print(f"Breaking stale lock: {self.path}")
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                raise TimeoutError(f'{self.path} is held by another download or process')
+            time.sleep(LOCK_CONFIG['poll'])
+
+    #tell waiters the holder is still working, cheap enough to call for every chunk of work
+    def refresh(self):
+        if time.monotonic() - self.refreshed > self.stale / 4:
+            os.utime(self.path)
+            self.refreshed = time.monotonic()
+
+    #give up the lock
+    def release(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,149 @@
+"""
+Gridded Data File Catalog
+
+This file keeps a catalog of the nClimGrid month files downloaded into the local data folder (../GRID_DATA/catalog.json).
+Each month has one entry with its file path, whether it is the 'scaled' (final) or 'prelim' (preliminary) version, its size, checksum, and when it was fetched.
+GRIDETLManager uses the catalog to open only the files covering a request's dates, instead of every file in the folder.
+When the scaled version of a month is downloaded it replaces the prelim version in the catalog, and the prelim file is deleted.
+"""
+
+#Imports
+#json for the catalog file
+import json
+#os for file paths and atomic renames
+import os
+#re for reading months out of file names
+import re
+#threading so download threads and Flask requests don't update the catalog at the same time
+import threading
+#datetime for month ranges
+from datetime import datetime
+#grid_download for the metadata saved next to each downloaded file
+import grid_download
+
+#name of the catalog file inside the data folder
+CATALOG_FILE = 'catalog.json'
+
+#nClimGrid file names, ex. ncdd-202301-grd-scaled.nc
+FILE_PATTERN = re.compile(r'ncdd-(\d{6})-grd-(scaled|prelim)\.nc$')
+
+_catalog_lock = threading.RLock()
+
+
+#read catalog function
+##input: folder -- the data folder
+##output: dictionary of catalog entries keyed by month (YYYYMM), rebuilt from the files in the folder if there is no catalog yet
+def read_catalog(folder):
+    path = os.path.join(folder, CATALOG_FILE)
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return rebuild_catalog(folder)
+    except ValueError:
+        return rebuild_catalog(folder)
+
+
+#write catalog function
+##writes to a temporary file and renames it, so readers never see a half written catalog
+##input: folder -- the data folder
+##input: catalog -- dictionary of catalog entries keyed by month
+def write_catalog(folder, catalog):
+    path = os.path.join(folder, CATALOG_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(catalog, file, indent = 4, sort_keys = True)
+    os.replace(tmp, path)
+
+
+#file entry function
+##builds a catalog entry for a downloaded file
+##input: path -- path to the downloaded file
+##input: meta -- download metadata (from grid_download), read from the file's metadata file if not given
+##output: (month, entry dictionary) tuple, or None if the file name is not an nClimGrid month file
+def file_entry(path, meta = None):
+    match = FILE_PATTERN.search(os.path.basename(path))
+    if match is None:
+        return None
+    if meta is None:
+        meta = grid_download.read_meta(path)
+    entry = {
+        'path': os.path.basename(path),
+        'kind': match.group(2),
+        'size': meta['size'] if meta.get('size') is not None else os.path.getsize(path),
+        'sha256': meta['sha256'] if meta.get('sha256') is not None else grid_download.file_checksum(path),
+        'fetched_at': meta.get('fetched_at'),
+        'etag': meta.get('etag'),
+        'last_modified': meta.get('last_modified')
+    }
+    return match.group(1), entry
+
+
+#add entry function
+##adds a file to the catalog, scaled files always replace prelim files for the same month
+##input: folder -- the data folder
+##input: catalog -- dictionary of catalog entries keyed by month, updated in place
+##input: month -- month of the file (YYYYMM)
+##input: entry -- catalog entry from file_entry
+##output: True if the catalog changed
+def add_entry(folder, catalog, month, entry):
+    current = catalog.get(month)
+    #never replace a scaled file with a prelim file
+    if current is not None and current['kind'] == 'scaled' and entry['kind'] == 'prelim':
+        return False
+    if current == entry:
+        return False
+    catalog[month] = entry
+    #the prelim file was superseded by the scaled file, remove it so it can't be opened by mistake
+    if current is not None and current['path'] != entry['path']:
+        grid_download.remove_file(os.path.join(folder, current['path']))
+    return True
+
+
+#rebuild catalog function
+##builds the catalog from the files already in the folder (ex. files downloaded before the catalog existed)
+##input: folder -- the data folder
+##output: dictionary of catalog entries keyed by month
+def rebuild_catalog(folder):
+    catalog = {}
+    if not os.path.isdir(folder):
+        return catalog
+    for name in sorted(os.listdir(folder)):
+        result = file_entry(os.path.join(folder, name))
+        if result is not None:
+            add_entry(folder, catalog, *result)
+    with _catalog_lock:
+        write_catalog(folder, catalog)
+    return catalog
+
+
+#update catalog function
+##records the results of a grid_download.download_files call in the catalog
+##input: folder -- the data folder
+##input: results -- list of download results, only files that were downloaded, resumed, or already up to date are added
+##output: the updated catalog dictionary
+def update_catalog(folder, results):
+    with _catalog_lock:
+        catalog = read_catalog(folder)
+        changed = False
+        for result in results:
+            if result['status'] not in ('downloaded', 'resumed', 'skipped'):
+                continue
+            entry = file_entry(result['path'], result)
+            if entry is not None:
+                changed = add_entry(folder, catalog, *entry) or changed
+        if changed:
+            write_catalog(folder, catalog)
+    return catalog
+
+
+#files for range function
+##finds the files covering a date range
+##input: folder -- the data folder
+##input: start, end -- first and last dates of the request (YYYY-MM-DD)
+##output: list of file paths in month order, months that haven't been downloaded are left out
+def files_for_range(folder, start, end):
+    first = datetime.strptime(start, "%Y-%m-%d").strftime("%Y%m")
+    last = datetime.strptime(end, "%Y-%m-%d").strftime("%Y%m")
+    catalog = read_catalog(folder)
+    return [os.path.join(folder, catalog[month]['path']) for month in sorted(catalog) if first <= month <= last]
@@ -0,0 +1,368 @@
+"""
+Gridded Data Download Manager
+
+This file downloads the monthly nClimGrid NetCDF files for GRIDETLManager.
+Files are downloaded by a pool of worker threads sharing one pooled HTTP session.
+Each file is written to a '.part' file first and only renamed to its final name once it is complete and verified, so an interrupted transfer never leaves a truncated file behind.
+Interrupted transfers are resumed with HTTP Range requests, and files that are already downloaded and unchanged on the server (same size, ETag, and Last-Modified) are skipped.
+Each file is locked while it is downloaded (see file_lock.py), so two requests (or worker processes) asking for the same file never write the same '.part' file; the second one waits and then finds the file already downloaded.
+A skipped file is checked against the checksum recorded when it was downloaded if it has been modified since.
+It also checks which files are available on the server, with the results cached so months that can no longer change are only checked once.
+The same downloader fetches AmeriFlux BASE zips for amf_archive.py.
+"""
+
+#Imports
+#requests for downloading files
+import requests
+from requests.adapters import HTTPAdapter
+#ThreadPoolExecutor to download several files at once
+from concurrent.futures import ThreadPoolExecutor
+#hashlib for file checksums
+import hashlib
+#json for download metadata files
+import json
+#os for file paths and atomic renames
+import os
+#time for waiting between retries
+import time
+#threading to share the availability cache between requests
+import threading
+#lock files so only one download writes each file
+from file_lock import FileLock
+
+#Download settings
+##workers -- number of files downloaded at the same time
+##max_attempts -- attempts per file before giving up, interrupted downloads resume where they stopped
+##chunk_size -- bytes read from the network at a time
+##timeout -- seconds to wait for the server to respond
+DOWNLOAD_CONFIG = {
+    'workers': 4,
+    'max_attempts': 3,
+    'chunk_size': 1024 * 1024,
+    'timeout': 60
+}
+
+#Availability check settings
+##workers -- number of files checked at the same time
+##recent_ttl -- seconds a check of a recent month (or of a file that was not available) is trusted, available historical months are trusted forever
+AVAILABILITY_CONFIG = {
+    'workers': 16,
+    'recent_ttl': 600
+}
+
+#file signatures of valid NetCDF files (NetCDF3 classic/64-bit, and NetCDF4 which is HDF5)
+NETCDF_SIGNATURES = (b'CDF\x01', b'CDF\x02', b'CDF\x05', b'\x89HDF\r\n\x1a\n')
+#file signature of zip files (AmeriFlux downloads)
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+#one session for every download thread, keeps connections to the server open between files
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+#results of availability checks, keyed by url: (available, time checked, trusted forever)
+_availability = {}
+_availability_lock = threading.Lock()
+
+
+#metadata path function
+##every downloaded file has a small JSON file next to it with the server's size, ETag, and Last-Modified, and the file's checksum
+##input: path -- path to the downloaded file (or .part file)
+##output: path to the metadata file
+def meta_path(path):
+    return path + '.json'
+
+
+#read metadata function
+##input: path -- path to the downloaded file (or .part file)
+##output: dictionary of the file's download metadata, or an empty dictionary if there is none
+def read_meta(path):
+    try:
+        with open(meta_path(path)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+#write metadata function
+##writes to a temporary file and renames it, so the metadata is never half written
+##input: path -- path to the downloaded file (or .part file)
+##input: meta -- dictionary of download metadata
+def write_meta(path, meta):
+    tmp = meta_path(path) + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp, meta_path(path))
+
+
+#remove file function
+##removes a file and its metadata file, ignoring files that don't exist
+def remove_file(path):
+    for p in (path, meta_path(path)):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+#file intact function
+##checks a downloaded file still matches its metadata, the checksum is only computed if the file was modified after it was downloaded
+##input: path -- path to the downloaded file
+##input: meta -- the file's download metadata
+##output: True if the file has the recorded size and is unmodified (or its content still has the recorded checksum)
+def file_intact(path, meta):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != meta.get('size'):
+        return False
+    if meta.get('mtime') == stat.st_mtime:
+        return True
+    return meta.get('sha256') is not None and file_checksum(path) == meta['sha256']
+
+
+#file checksum function
+##input: path -- path to the file
+##input: hexdigest -- return the checksum as text (True) or the hashlib object so more bytes can be added (False)
+##output: sha256 checksum of the file
+def file_checksum(path, hexdigest = True):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CONFIG['chunk_size']), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest() if hexdigest else sha256
+
+
+#remote file information function
+##asks the server for a file's size, ETag, and Last-Modified without downloading it
+##input: url -- file url
+##input: session -- requests session to use
+##output: dictionary with 'size', 'etag', and 'last_modified' (None for anything the server doesn't report), raises requests.HTTPError if the file isn't available
+def remote_info(url, session = SESSION):
+    response = session.head(url, allow_redirects=True, timeout=DOWNLOAD_CONFIG['timeout'])
+    response.raise_for_status()
+    size = response.headers.get('Content-Length')
+    return {
+        'size': int(size) if size is not None else None,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+
+
+#same version function
+##checks if saved metadata describes the same version of the file as the server reports
+##input: meta -- saved download metadata
+##input: info -- remote_info of the file
+##output: True if the size matches and every validator the server reports (ETag, Last-Modified) matches
+def same_version(meta, info):
+    if info['size'] is not None and meta.get('size') != info['size']:
+        return False
+    for key in ('etag', 'last_modified'):
+        if info[key] is not None and meta.get(key) != info[key]:
+            return False
+    return True
+
+
+#verify file function
+##checks a finished download is complete and is a NetCDF (or zip) file
+##input: path -- path to the downloaded file
+##input: size -- size the server reported, or None
+##output: None if the file is good, otherwise a string describing the problem
+def verify_file(path, size):
+    actual = os.path.getsize(path)
+    if size is not None and actual != size:
+        return f'expected {size} bytes, got {actual}'
+    if path.endswith('.nc.part') or path.endswith('.nc'):
+        with open(path, 'rb') as file:
+            head = file.read(8)
+        if not any(head.startswith(signature) for signature in NETCDF_SIGNATURES):
+            return 'file is not a NetCDF file'
+    if path.endswith('.zip.part') or path.endswith('.zip'):
+        with open(path, 'rb') as file:
+            head = file.read(4)
+        if head != ZIP_SIGNATURE:
+            return 'file is not a zip file'
+    return None
+
+
+#download file function
+##downloads one file to full_path, resuming a previous partial download when the server still has the same version
+##input: url -- file url
+##input: full_path -- where to save the file
+##input: session -- requests session to use
+##output: dictionary with 'url', 'path', 'status' ('skipped', 'downloaded', or 'resumed'), 'size', 'etag', 'last_modified', 'sha256', 'fetched_at', and 'mtime'
+##raises requests.RequestException on network errors and ValueError if the finished file fails verification
+def download_file(url, full_path, session = SESSION):
+    #only one thread or process downloads a file at a time, others wait here and then skip the finished file
+    with FileLock(full_path) as lock:
+        return locked_download(url, full_path, session, lock)
+
+
+#locked download function
+##download_file's work, run while the file's lock is held
+##input: url, full_path, session -- see download_file
+##input: lock -- the file's FileLock, refreshed while data arrives so waiters know the download is alive
+##output: see download_file
+def locked_download(url, full_path, session, lock):
+    info = remote_info(url, session)
+
+    #skip files we already have, as long as the server's version hasn't changed and the local copy is intact
+    if os.path.exists(full_path):
+        meta = read_meta(full_path)
+        if meta and same_version(meta, info) and file_intact(full_path, meta):
+            #remember the file's current modification time, so it isn't hashed again next time
+            if meta.get('mtime') != os.path.getmtime(full_path):
+                meta['mtime'] = os.path.getmtime(full_path)
+                write_meta(full_path, meta)
+            return dict(meta, url=url, path=full_path, status='skipped')
+        #files downloaded before metadata was kept are adopted if they are complete
+        if not meta and info['size'] is not None and verify_file(full_path, info['size']) is None:
+            meta = dict(info, sha256=file_checksum(full_path), fetched_at=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(full_path))), mtime=os.path.getmtime(full_path))
+            write_meta(full_path, meta)
+            return dict(meta, url=url, path=full_path, status='skipped')
+
+    #resume a partial download if it is from the same version of the file
+    ##only possible when the server reports a validator (ETag or Last-Modified) to prove the version hasn't changed
+    part_path = full_path + '.part'
+    part_meta = read_meta(part_path)
+    offset = 0
+    sha256 = hashlib.sha256()
+    if os.path.exists(part_path) and part_meta and same_version(part_meta, info) \
+            and (info['etag'] is not None or info['last_modified'] is not None) \
+            and info['size'] is not None and os.path.getsize(part_path) <= info['size']:
+        offset = os.path.getsize(part_path)
+        #hash the bytes we already have so the checksum covers the whole file
+        sha256 = file_checksum(part_path, hexdigest = False)
+    else:
+        remove_file(part_path)
+    write_meta(part_path, info)
+
+    status = 'resumed' if offset > 0 else 'downloaded'
+    #a .part file that already has every byte only needs to be verified and moved into place
+    if offset == 0 or offset != info['size']:
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+            #if the file changed since the .part file was started, the server sends the whole new file instead
+            headers['If-Range'] = info['etag'] or info['last_modified']
+        response = session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_CONFIG['timeout'])
+        try:
+            response.raise_for_status()
+            if offset > 0 and response.status_code == 206:
+                mode = 'ab'
+            else:
+                #server sent the whole file, start over
+                status = 'downloaded'
+                sha256 = hashlib.sha256()
+                mode = 'wb'
+            with open(part_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CONFIG['chunk_size']):
+                    file.write(chunk)
+                    sha256.update(chunk)
+                    lock.refresh()
+        finally:
+            response.close()
+
+    #verify the file, a bad file is removed so the next attempt starts fresh
+    problem = verify_file(part_path, info['size'])
+    if problem is not None:
+        remove_file(part_path)
+        raise ValueError(f'{url}: {problem}')
+
+    #move the finished file into place, the final path only ever holds complete files
+    meta = dict(info, size=os.path.getsize(part_path), sha256=sha256.hexdigest(), fetched_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    os.replace(part_path, full_path)
+    meta['mtime'] = os.path.getmtime(full_path)
+    write_meta(full_path, meta)
+    remove_file(part_path)
+    return dict(meta, url=url, path=full_path, status=status)
+
+
+#download with retries function
+##tries download_file up to max_attempts times, each retry resumes where the last attempt stopped
+##input: url -- file url
+##input: target_folder -- folder to save the file in
+##input: file_name -- name to save the file as, None keeps the name from the url
+##output: download_file result, or a dictionary with status 'missing' (file not on server) or 'failed' and the 'error'
+def download_with_retries(url, target_folder, file_name = None):
+    full_path = os.path.join(target_folder, file_name or url.split('/')[-1])
+    error = None
+    for attempt in range(DOWNLOAD_CONFIG['max_attempts']):
+        try:
+            return download_file(url, full_path)
+        except requests.HTTPError as e:
+            #files that don't exist on the server (ex. a prelim file after the scaled file was released) are not retried
+            if e.response is not None and e.response.status_code == 404:
+                return {'url': url, 'path': full_path, 'status': 'missing', 'error': str(e)}
+            error = e
+        except (requests.RequestException, ValueError, OSError) as e:
+            error = e
+        print(f"Attempt {attempt + 1} failed: {error}")
+        time.sleep(0.5 * 2 ** attempt)
+    return {'url': url, 'path': full_path, 'status': 'failed', 'error': str(error)}
+
+
+#download files function
+##downloads a list of files in parallel
+##input: urls -- list of file urls
+##input: target_folder -- folder to save the files in
+##input: workers -- number of files downloaded at the same time, defaults to DOWNLOAD_CONFIG['workers']
+##output: list of download_with_retries results, in the same order as urls
+def download_files(urls, target_folder, workers = None):
+    os.makedirs(target_folder, exist_ok=True)
+    if len(urls) == 0:
+        return []
+    workers = workers or DOWNLOAD_CONFIG['workers']
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        return list(executor.map(lambda url: download_with_retries(url, target_folder), urls))
+
+
+#check available function
+##checks if one file is on the server, retrying network errors
+##input: url -- file url
+##output: True if the server has the file, False if it doesn't, None if the server couldn't be reached
+def check_available(url):
+    for attempt in range(DOWNLOAD_CONFIG['max_attempts']):
+        try:
+            response = SESSION.head(url, allow_redirects=True, timeout=DOWNLOAD_CONFIG['timeout'])
+            if response.status_code == 200:
+                return True
+            if response.status_code in (403, 404, 410):
+                return False
+            print(f"Attempt {attempt + 1} failed: HTTP {response.status_code} for {url}")
+        except requests.RequestException as e:
+            print(f"Attempt {attempt + 1} failed: {e}")
+        time.sleep(0.5 * 2 ** attempt)
+    return None
+
+
+#check files available function
+##checks which files are on the server, several at a time, using cached results where possible
+##historical months never change once they are on the server, so they are only checked once per process
+##recent months (and files that were not available) are checked again after AVAILABILITY_CONFIG['recent_ttl'] seconds, since prelim files are replaced by scaled files
+##input: urls -- list of file urls
+##input: recent -- set of urls for recent months
+##output: list of check_available results, in the same order as urls
+def check_files_available(urls, recent = ()):
+    now = time.monotonic()
+    results = {}
+    to_check = []
+    with _availability_lock:
+        for url in urls:
+            cached = _availability.get(url)
+            if cached is not None and (cached[2] or now - cached[1] < AVAILABILITY_CONFIG['recent_ttl']):
+                results[url] = cached[0]
+            else:
+                to_check.append(url)
+
+    if len(to_check) > 0:
+        with ThreadPoolExecutor(max_workers=min(AVAILABILITY_CONFIG['workers'], len(to_check))) as executor:
+            checked = list(executor.map(check_available, to_check))
+        with _availability_lock:
+            for url, available in zip(to_check, checked):
+                results[url] = available
+                #failed checks are not cached, so the next request tries again
+                if available is not None:
+                    _availability[url] = (available, time.monotonic(), available and url not in recent)
+    return [results[url] for url in urls]
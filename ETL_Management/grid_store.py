@@ -0,0 +1,242 @@
+"""
+Gridded Data Zarr Store
+
+This file keeps a local Zarr copy of the downloaded nClimGrid months (../GRID_DATA/nclimgrid_store), with one store per year (ex. nclimgrid_store/2023.zarr).
+The monthly NetCDF files are laid out as whole-CONUS daily maps, so reading one point's time series means opening every month file.
+Each year store holds the year in chunks that cover the whole year but a small area, so a long time series for a point or small box only reads one chunk per year.
+A year is only written once every one of its months is downloaded, and it is written whole, chunk by chunk from the month files opened lazily, so only a strip of the year is in memory at a time. No chunk is ever partly written or rewritten, so ingesting doesn't read back what is already in the store.
+A new version of a year is written next to the old one and swapped in, and it is rewritten when one of its month files changes (ex. a prelim month replaced by the scaled month).
+Months of years that aren't complete (ex. the current year) are read from their NetCDF files, so a request can read from the store and the files together.
+Ingesting runs in a background thread after downloads (ingest_job), or as a separate job with 'python grid_store.py <data folder>'. A file lock keeps it to one writer across threads and worker processes.
+"""
+
+#Imports
+#numpy for the time axis
+import numpy as np
+#xarray and dask for building and writing the store without loading it into memory
+import xarray as xr
+import dask.array as da
+#zarr for the store's metadata
+import zarr
+#os and shutil for file paths and swapping year stores
+import os
+import shutil
+#sys for the command line job
+import sys
+#lock file so only one thread or process writes the store
+from file_lock import FileLock
+#grid_catalog for the list of downloaded month files
+import grid_catalog
+
+#Store settings
+##folder -- name of the folder holding the year stores, inside the data folder
+##chunks -- lat and lon chunk size. Every chunk covers a whole year, so a point or small box reads one chunk per year
+##band_chunks -- rows of chunks written between refreshes of the ingest lock
+##variables -- data variables copied into the store
+##lock_stale -- seconds the ingest lock can go without a refresh before it is treated as abandoned
+STORE_CONFIG = {
+    'folder': 'nclimgrid_store',
+    'chunks': {'lat': 16, 'lon': 16},
+    'band_chunks': 4,
+    'variables': ['tmax', 'tmin', 'tavg', 'prcp'],
+    'lock_stale': 900
+}
+
+#errors that mean the store can't be read (missing or half-swapped files, bad metadata, damaged chunks), requests read the NetCDF files instead
+##zarr's own errors are ValueErrors, and damaged chunks raise RuntimeError from the decompressor
+STORE_ERRORS = (OSError, KeyError, ValueError, RuntimeError)
+
+
+#store folder function
+##input: folder -- the data folder
+##output: path to the folder of year stores
+def store_folder(folder):
+    return os.path.join(folder, STORE_CONFIG['folder'])
+
+
+#year path function
+##input: folder -- the data folder
+##input: year -- year (YYYY)
+##output: path to the year's store
+def year_path(folder, year):
+    return os.path.join(store_folder(folder), f'{year}.zarr')
+
+
+#year months function
+##input: year -- year (YYYY)
+##output: the year's twelve months (YYYYMM)
+def year_months(year):
+    return [f'{year}{month:02d}' for month in range(1, 13)]
+
+
+#ingested months function
+##input: folder -- the data folder
+##input: year -- year (YYYY)
+##output: dictionary of the year's months (YYYYMM) and the checksum of the file each was ingested from, empty if the year isn't in the store
+def ingested_months(folder, year):
+    path = year_path(folder, year)
+    if not os.path.exists(path):
+        return {}
+    return dict(zarr.open_group(path, mode='r').attrs.get('months', {}))
+
+
+#stored years function
+##input: folder -- the data folder
+##input: catalog -- the folder's catalog (see grid_catalog.py)
+##output: set of years whose store holds the catalogued version of all twelve months
+def stored_years(folder, catalog):
+    years = set()
+    for year in {month[:4] for month in catalog}:
+        months = year_months(year)
+        if all(month in catalog for month in months):
+            if ingested_months(folder, year) == {month: catalog[month]['sha256'] for month in months}:
+                years.add(year)
+    return years
+
+
+#write year function
+##writes a whole year into a new store and swaps it in place of the old one
+##the year is written in bands of whole chunks (every chunk spans the whole year), so each chunk is written exactly once
+##input: folder -- the data folder
+##input: year -- year (YYYY)
+##input: entries -- catalog entries of the year's twelve months, keyed by month
+##input: lock -- the ingest FileLock, refreshed after every band
+def write_year(folder, year, entries, lock):
+    months = sorted(entries)
+    #opened lazily in strips of one chunk row, so only a few strips of each month are in memory at a time
+    month_ds = [xr.open_dataset(os.path.join(folder, entries[month]['path']), chunks={'lat': STORE_CONFIG['chunks']['lat'], 'lon': -1}) for month in months]
+    path = year_path(folder, year)
+    tmp = path + '.tmp'
+    try:
+        first = month_ds[0]
+        #every month has to be on the same grid
+        for month, ds in zip(months, month_ds):
+            if not (np.array_equal(first['lat'].values, ds['lat'].values) and np.array_equal(first['lon'].values, ds['lon'].values)):
+                raise ValueError(f'{month} is not on the same grid as the rest of {year}')
+        variables = [var for var in STORE_CONFIG['variables'] if all(var in ds for ds in month_ds)]
+        time = np.concatenate([ds['time'].values for ds in month_ds])
+        nlat = first.sizes['lat']
+        nlon = first.sizes['lon']
+        chunks = (len(time), STORE_CONFIG['chunks']['lat'], STORE_CONFIG['chunks']['lon'])
+
+        #empty store with the year's time axis, only the metadata and coordinates are written here
+        template = xr.Dataset(
+            {var: (('time', 'lat', 'lon'), da.full((len(time), nlat, nlon), np.nan, chunks=chunks, dtype='float32'), first[var].attrs) for var in variables},
+            coords={'time': time, 'lat': first['lat'].values, 'lon': first['lon'].values}
+        )
+        shutil.rmtree(tmp, ignore_errors=True)
+        template.to_zarr(tmp, mode='w', compute=False, encoding={var: {'chunks': chunks} for var in variables})
+
+        #the year as one lazy dataset, in the store's chunks. Each chunk is built from its piece of the twelve month strips when it is written
+        year_ds = xr.concat([ds[variables] for ds in month_ds], dim='time').astype('float32')
+        year_ds = year_ds.drop_vars(list(year_ds.coords)).chunk(dict(zip(('time', 'lat', 'lon'), chunks)))
+
+        #write the year a band of whole chunks at a time, refreshing the lock in between
+        ##the synchronous scheduler writes chunk by chunk on this thread, so an ingest running inside the Flask process holds one strip of the year in memory and uses one core
+        rows = STORE_CONFIG['chunks']['lat'] * STORE_CONFIG['band_chunks']
+        for start in range(0, nlat, rows):
+            band = slice(start, min(start + rows, nlat))
+            year_ds.isel(lat=band).to_zarr(tmp, region={'time': slice(None), 'lat': band, 'lon': slice(None)}, compute=False).compute(scheduler='synchronous')
+            lock.refresh()
+        zarr.open_group(tmp, mode='a').attrs['months'] = {month: entries[month]['sha256'] for month in months}
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    finally:
+        for ds in month_ds:
+            ds.close()
+
+    #swap the new year in. The previous version is kept until the next swap, so requests that opened it can finish reading
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+
+
+#ingest catalog function
+##writes every year whose twelve months are catalogued, and that isn't in the store yet or has a month file that changed since it was ingested
+##only one thread or process ingests at a time, others return right away
+##input: folder -- the data folder
+##output: list of years (YYYY) written to the store, raises TimeoutError if another ingest is running
+def ingest_catalog(folder):
+    os.makedirs(store_folder(folder), exist_ok=True)
+    written = []
+    with FileLock(store_folder(folder), timeout=0, stale=STORE_CONFIG['lock_stale']) as lock:
+        catalog = grid_catalog.read_catalog(folder)
+        done = stored_years(folder, catalog)
+        for year in sorted({month[:4] for month in catalog}):
+            months = year_months(year)
+            if year in done or not all(month in catalog for month in months):
+                continue
+            write_year(folder, year, {month: catalog[month] for month in months}, lock)
+            written.append(year)
+    return written
+
+
+#ingest job function
+##runs ingest_catalog and reports the result instead of raising, for background threads and the command line job
+##the store is only a faster copy of the files, so a failed ingest never affects requests, they read the NetCDF files instead
+##input: folder -- the data folder
+##output: list of years written, or None if the ingest didn't run or failed
+def ingest_job(folder):
+    try:
+        written = ingest_catalog(folder)
+        print(f"Store ingest finished, years written: {', '.join(written) if written else 'none'}")
+        return written
+    except TimeoutError:
+        print("Store ingest already running")
+    except Exception as e:
+        print(f"Store ingest failed: {type(e).__name__}: {e}")
+    return None
+
+
+#open files function
+##opens the NetCDF files for a date range lazily, without the store
+##input: folder -- the data folder
+##input: start, end -- first and last dates of the request (YYYY-MM-DD)
+##output: (xarray Dataset, description of what was read) tuple, or None if no files cover the dates
+def open_files(folder, start, end):
+    files = grid_catalog.files_for_range(folder, start, end)
+    if len(files) == 0:
+        return None
+    return xr.open_mfdataset(files, concat_dim='time', combine='nested'), 'Read from ' + str(len(files)) + ' NetCDF files'
+
+
+#open range function
+##opens the data for a date range lazily, complete years from the store and every other month from its NetCDF file, in time order
+##input: folder -- the data folder
+##input: start, end -- first and last dates of the request (YYYY-MM-DD)
+##output: (xarray Dataset, description of what was read) tuple, or None if no files cover the dates
+def open_range(folder, start, end):
+    catalog = grid_catalog.read_catalog(folder)
+    first = start[:7].replace('-', '')
+    last = end[:7].replace('-', '')
+    months = [month for month in sorted(catalog) if first <= month <= last]
+    years = stored_years(folder, catalog) & {month[:4] for month in months}
+    if len(years) == 0:
+        return open_files(folder, start, end)
+
+    #consecutive months outside the store are opened together
+    parts = []
+    run = []
+    for month in months:
+        if month[:4] in years:
+            if len(run) > 0:
+                parts.append(xr.open_mfdataset(run, concat_dim='time', combine='nested'))
+                run = []
+            if month.endswith('01') or month == months[0]:
+                parts.append(xr.open_zarr(year_path(folder, month[:4])))
+        else:
+            run.append(os.path.join(folder, catalog[month]['path']))
+    if len(run) > 0:
+        parts.append(xr.open_mfdataset(run, concat_dim='time', combine='nested'))
+    variables = [var for var in STORE_CONFIG['variables'] if all(var in part for part in parts)]
+    ds = xr.concat([part[variables] for part in parts], dim='time') if len(parts) > 1 else parts[0][variables]
+    file_count = len([month for month in months if month[:4] not in years])
+    return ds, 'Read ' + str(len(years)) + ' year(s) from Zarr store and ' + str(file_count) + ' NetCDF files'
+
+
+#run the ingest as its own job, ex. from cron after downloads: python grid_store.py ../GRID_DATA/
+if __name__ == '__main__':
+    ingest_job(sys.argv[1] if len(sys.argv) > 1 else '../GRID_DATA/')
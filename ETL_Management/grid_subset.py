@@ -0,0 +1,225 @@
+"""
+Gridded Data Spatial Subsetting
+
+This file holds the spatial subsetting used by GRIDETLManager to cut nClimGrid data down to a user's area before any data is loaded.
+nClimGrid is a regular lat/lon grid, so a bounding box is just a range of row and column indexes that can be found with arithmetic on the grid spacing.
+Polygons and shapefiles are rasterized once onto the grid with rasterio.features, and the resulting cell mask is reused for every request with the same area.
+Time series at individual points are found the same way, with nearest-cell or bilinear lookups done as index arithmetic.
+All of these work on lazy xarray datasets, so no per-point geometry tests are ever run.
+"""
+
+#Imports
+#numpy for index arithmetic and masks
+import numpy as np
+#xarray for pointwise indexing
+import xarray as xr
+#threading to share the mask cache between Flask requests
+import threading
+#rasterio for rasterizing polygons onto the grid
+from rasterio import features
+from rasterio.transform import from_origin
+#shapely for reading polygon inputs
+from shapely.geometry import shape, Polygon
+from shapely.ops import unary_union
+#geopandas for reading shapefiles
+import geopandas as gpd
+#os for shapefile modification times
+import os
+
+#Largest number of cell masks kept in memory, oldest masks are dropped first
+MASK_CACHE_SIZE = 64
+
+#masks are kept per grid and polygon, shapefiles are kept per path and modification time
+_masks = {}
+_shapefiles = {}
+_cache_lock = threading.Lock()
+
+
+#grid spacing function
+##finds the first value and step of a regularly spaced coordinate
+##input: values -- 1D numpy array of coordinate values
+##output: (first value, step) tuple, or None if the coordinate is not regularly spaced
+def grid_spacing(values):
+    if len(values) < 2:
+        return None
+    steps = np.diff(values)
+    step = (values[-1] - values[0]) / (len(values) - 1)
+    #coordinates are often stored as rounded or float32 values, so allow steps to be off by 1% of the grid spacing
+    if step == 0 or not np.allclose(steps, step, rtol=0, atol=abs(step) * 0.01):
+        return None
+    return values[0], step
+
+
+#coordinate index range function
+##finds the index range of a coordinate that falls between two values (inclusive)
+##on a regular grid this is arithmetic on the grid spacing, irregular coordinates fall back to a binary search
+##input: values -- 1D numpy array of coordinate values (ascending or descending)
+##input: low, high -- the coordinate range we want
+##output: slice of indexes, can be empty
+def index_range(values, low, high):
+    values = np.asarray(values, dtype=float)
+    descending = len(values) > 1 and values[0] > values[-1]
+    spacing = grid_spacing(values)
+    if spacing is not None:
+        first, step = spacing
+        #small tolerance so a bound exactly on a cell center keeps that cell
+        i0 = int(np.ceil((low - first) / step - 1e-6)) if not descending else int(np.ceil((high - first) / step - 1e-6))
+        i1 = int(np.floor((high - first) / step + 1e-6)) if not descending else int(np.floor((low - first) / step + 1e-6))
+    else:
+        ascending_values = values[::-1] if descending else values
+        lo = int(np.searchsorted(ascending_values, low, side='left'))
+        hi = int(np.searchsorted(ascending_values, high, side='right')) - 1
+        i0, i1 = (len(values) - 1 - hi, len(values) - 1 - lo) if descending else (lo, hi)
+    i0 = max(i0, 0)
+    i1 = min(i1, len(values) - 1)
+    return slice(i0, max(i1 + 1, i0))
+
+
+#select box function
+##subsets a gridded dataset to a lat/lon bounding box with index slices, works on lazy datasets without loading any data
+##input: ds -- xarray Dataset with 'lat' and 'lon' coordinates
+##input: bounds -- dictionary with 'minlat', 'minlon', 'maxlat', and 'maxlon'
+##output: the xarray Dataset cut to the bounding box
+def select_box(ds, bounds):
+    lat_slice = index_range(ds['lat'].values, bounds['minlat'], bounds['maxlat'])
+    lon_slice = index_range(ds['lon'].values, bounds['minlon'], bounds['maxlon'])
+    return ds.isel(lat=lat_slice, lon=lon_slice)
+
+
+#read polygon function
+##turns a user's polygon input into one shapely geometry in lat/lon (EPSG:4326)
+##input: polygon -- GeoJSON geometry dictionary, list of [lon, lat] pairs, or a path to a shapefile (or any file geopandas can read)
+##output: shapely geometry
+def read_polygon(polygon):
+    if isinstance(polygon, str):
+        return read_shapefile(polygon)
+    if isinstance(polygon, dict):
+        #GeoJSON Feature or FeatureCollection, or a bare geometry
+        if polygon.get('type') == 'FeatureCollection':
+            return unary_union([shape(feature['geometry']) for feature in polygon['features']])
+        if polygon.get('type') == 'Feature':
+            return shape(polygon['geometry'])
+        return shape(polygon)
+    return Polygon(polygon)
+
+
+#read shapefile function
+##reads a shapefile once and keeps the merged geometry until the file changes
+##input: path -- path to the shapefile
+##output: shapely geometry in lat/lon (EPSG:4326)
+def read_shapefile(path):
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    with _cache_lock:
+        geometry = _shapefiles.get(key)
+    if geometry is None:
+        shapes = gpd.read_file(path)
+        if shapes.crs is not None:
+            shapes = shapes.to_crs(epsg=4326)
+        geometry = unary_union(shapes.geometry.values)
+        with _cache_lock:
+            _shapefiles[key] = geometry
+    return geometry
+
+
+#polygon mask function
+##rasterizes a polygon onto a regular lat/lon grid, masks are cached per grid and polygon so repeat requests skip this step
+##input: lat, lon -- 1D numpy arrays of the grid coordinates (cell centers)
+##input: geometry -- shapely geometry in lat/lon
+##input: all_touched -- True keeps every cell the polygon touches, False keeps cells whose center is inside the polygon
+##output: 2D boolean numpy array (lat, lon), True for cells inside the polygon
+def polygon_mask(lat, lon, geometry, all_touched = False):
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat_spacing = grid_spacing(lat)
+    lon_spacing = grid_spacing(lon)
+    if lat_spacing is None or lon_spacing is None:
+        raise ValueError('Polygon masks need a regularly spaced lat/lon grid')
+    key = (lat[0], lat_spacing[1], len(lat), lon[0], lon_spacing[1], len(lon), geometry.wkb, all_touched)
+    with _cache_lock:
+        mask = _masks.get(key)
+    if mask is not None:
+        return mask
+
+    #rasterio expects north-up rasters, so build the mask north to south and flip it if latitudes are stored south to north
+    lat_step = abs(lat_spacing[1])
+    lon_step = lon_spacing[1]
+    transform = from_origin(lon[0] - lon_step / 2, lat.max() + lat_step / 2, lon_step, lat_step)
+    mask = features.geometry_mask([geometry], out_shape=(len(lat), len(lon)), transform=transform,
+                                  invert=True, all_touched=all_touched)
+    if lat[0] < lat[-1]:
+        mask = mask[::-1, :]
+    mask.setflags(write=False)
+
+    with _cache_lock:
+        if len(_masks) >= MASK_CACHE_SIZE:
+            _masks.pop(next(iter(_masks)))
+        _masks[key] = mask
+    return mask
+
+
+#select polygon function
+##subsets a gridded dataset to the cells inside a polygon, works on lazy datasets without loading any data
+##the cells inside the polygon are kept along a stacked 'cell' dimension
+##input: ds -- xarray Dataset with 'lat' and 'lon' coordinates
+##input: polygon -- any input accepted by read_polygon
+##input: all_touched -- see polygon_mask
+##output: xarray Dataset with a 'cell' dimension (lat, lon pairs) in place of the 'lat' and 'lon' dimensions
+def select_polygon(ds, polygon, all_touched = False):
+    geometry = read_polygon(polygon)
+    #the mask is built on the whole grid, so it is shared by every request for the same polygon
+    mask = polygon_mask(ds['lat'].values, ds['lon'].values, geometry, all_touched)
+    #cut the grid and the mask to the rows and columns the mask uses so only those cells are stacked
+    ##the mask's own extent is used instead of the polygon's bounds, since with all_touched the mask includes edge cells whose centers are outside the bounds
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        lat_slice = lon_slice = slice(0, 0)
+    else:
+        lat_slice = slice(rows[0], rows[-1] + 1)
+        lon_slice = slice(cols[0], cols[-1] + 1)
+    ds = ds.isel(lat=lat_slice, lon=lon_slice)
+    cells = np.flatnonzero(mask[lat_slice, lon_slice].ravel())
+    return ds.stack(cell=('lat', 'lon')).isel(cell=cells)
+
+
+#select points function
+##extracts the time series at a list of lat/lon points, works on lazy datasets without loading any data
+##every point is found with index arithmetic on the regular grid, so thousands of points cost the same as one
+##input: ds -- xarray Dataset with 'lat' and 'lon' coordinates on a regular grid
+##input: lats, lons -- lists of point latitudes and longitudes
+##input: ids -- list of point names, returned in the 'point' column
+##input: method -- 'nearest' takes the value of the grid cell the point is in, 'bilinear' weights the four grid cells around the point by distance
+##output: xarray Dataset with a 'point' dimension in place of the 'lat' and 'lon' dimensions. Points outside the grid have missing values
+def select_points(ds, lats, lons, ids, method = 'nearest'):
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lat_spacing = grid_spacing(np.asarray(ds['lat'].values, dtype=float))
+    lon_spacing = grid_spacing(np.asarray(ds['lon'].values, dtype=float))
+    if lat_spacing is None or lon_spacing is None:
+        raise ValueError('Point extraction needs a regularly spaced lat/lon grid')
+    #fractional row and column of every point
+    rows = (lats - lat_spacing[0]) / lat_spacing[1]
+    cols = (lons - lon_spacing[0]) / lon_spacing[1]
+    nlat = ds.sizes['lat']
+    nlon = ds.sizes['lon']
+    #points more than half a cell outside the grid have no data
+    inside = (rows >= -0.5) & (rows <= nlat - 0.5) & (cols >= -0.5) & (cols <= nlon - 0.5)
+
+    def cells(r, c):
+        return ds.isel(lat=xr.DataArray(np.clip(r, 0, nlat - 1), dims='point'), lon=xr.DataArray(np.clip(c, 0, nlon - 1), dims='point'))
+
+    if method == 'bilinear':
+        r0 = np.floor(rows).astype(int)
+        c0 = np.floor(cols).astype(int)
+        #clip the weights so points in the outer half cell take the edge values
+        wr = np.clip(rows - r0, 0, 1)
+        wc = np.clip(cols - c0, 0, 1)
+        wr = xr.DataArray(wr, dims='point')
+        wc = xr.DataArray(wc, dims='point')
+        corners = [cells(r0 + dr, c0 + dc).drop_vars(['lat', 'lon']) for dr in (0, 1) for dc in (0, 1)]
+        points = corners[0] * (1 - wr) * (1 - wc) + corners[1] * (1 - wr) * wc + corners[2] * wr * (1 - wc) + corners[3] * wr * wc
+    else:
+        points = cells(np.rint(rows).astype(int), np.rint(cols).astype(int)).drop_vars(['lat', 'lon'])
+
+    points = points.where(xr.DataArray(inside, dims='point'))
+    return points.assign_coords(point=('point', list(ids)), lat=('point', lats), lon=('point', lons))
@@ -17,15 +17,15 @@ import requests
 from datetime import datetime, timedelta
 #pandas for data aggregation
 import pandas as pd
-import geopandas as gpd
 #rasterio and shapefly for raster manipulation
 import rasterio
-from shapely.geometry import box
 from rasterio.transform import from_origin
 #threading to update database with new data in the background
 import threading
 #Flask for api response return
 from flask import Flask, Response
+#Parquet, Arrow, and NetCDF downloads
+import output_formats
 #json for api response return
 import json
 #time for sleep
@@ -34,8 +34,27 @@ import time
 import os
 #xarray for netcdf file management
 import xarray as xr
-#glob for file paths
-import glob
+#grid_subset for cutting gridded data to a box or polygon
+import grid_subset
+#grid_download for downloading the month files
+import grid_download
+#grid_catalog for finding the downloaded files that cover a request
+import grid_catalog
+#grid_store for the chunked Zarr copy of the downloaded files
+import grid_store
+#db_pool for looking up station locations
+import db_pool
+#process pool for out-of-core requests
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+#Out-of-core settings for large gridded requests (Additional_Arguments 'stream' : True)
+##workers -- processes reading and aggregating data at the same time, defaults to the number of cores on the host
+##block_values -- most data values read for one block of output, this bounds the memory used by a request no matter its size
+DASK_CONFIG = {
+    'workers': os.cpu_count() or 1,
+    'block_values': 20000000
+}
 
 """
 Class GRIDETLManager
@@ -43,7 +62,7 @@ Global variables:
     self.args
         - Arguments passed in by user to the NOAA API. There are many, so they are defined in the file noaa_api_call.py
         - There are many Call_X functions, these allow a user to call or bypass any optional data checks in the ETL manager. Typically they will remain active, unless a user has problems with a specific data check.
-        - Typical users will input 'Endpoint' (NOAA_GRID_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV or JSON for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation).
+        - Typical users will input 'Endpoint' (NOAA_GRID_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV, JSON, PARQUET, ARROW, or NETCDF for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation).
     self.response_codes
         - For every section of data checking that occurs, the response codes store the failure/success of the function call. This is used for debugging and indicating to the user what is happening during the data processing pipeline.
 
@@ -75,19 +94,26 @@ class GRIDETLManager:
         arg_trans = self.translate_endpoint(self.args['Endpoint'])
         self.args['API_Arguments']['datatypeid'] = self.args['API_Arguments']['datatypeid'].lower()
 
-        #If Call_Direct_Download is CSV or JSON --> start our data download process
-        if (self.args['Call_Direct_Download'] == 'CSV') or (self.args['Call_Direct_Download'] == 'JSON'):
+        #If Call_Direct_Download is a download format (CSV, JSON, PARQUET, ARROW, or NETCDF) --> start our data download process
+        if self.args['Call_Direct_Download'] in output_formats.DOWNLOAD_FORMATS:
             #full_call calls generate_api_call, which takes in the user's api parameters and formats it in a 'requests' API call
             full_call = self.generate_api_call(arg_trans, self.args['API_Arguments'], self.args['NOAA_API_KEY'])
             
             #api_vals call api_call, which takes in the formatted call generated above
             ##db_vals returns as the count of rows of data in the API call
             db_vals = self.api_download(full_call['url'], full_call['endpoint'], full_call['headers'], full_call['parameters'])
-            files = glob.glob(db_vals + '//*.nc')
+            #copy any new or changed years into the chunked Zarr store in the background, requests read the years it already holds
+            self.ingest_data(db_vals)
             #check if db_vals was able to get data from the FTP Server
             if db_vals is not None:
                 #if Call_Aggregation is True, then start aggregating the data based on additional arguments
                 if self.args['Call_Aggregation']:
+                    #NetCDF keeps the data on its grid, the aggregation is written to the file chunk by chunk
+                    if self.args['Call_Direct_Download'] == 'NETCDF':
+                        return self.netcdf_response(db_vals, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments'])
+                    #out-of-core requests are aggregated block by block and streamed to the user
+                    if self.args['Additional_Arguments'] is not None and self.args['Additional_Arguments'].get('stream') == True:
+                        return self.stream_response(self.stream_data(db_vals, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments']), self.args['Call_Direct_Download'])
                     #call aggregate_data function to aggregate and clean data for user
                     db_vals = self.aggregate_data(db_vals, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments'])
 
@@ -109,6 +135,14 @@ class GRIDETLManager:
                     headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
                 )
 
+            #if we want a binary format, write it in row groups as it is sent
+            elif self.args['Call_Direct_Download'] in output_formats.OUTPUT_FORMATS:
+                try:
+                    return output_formats.frames_response(db_vals, self.args['Call_Direct_Download'], self.args['Additional_Arguments'])
+                except ValueError as e:
+                    self.response_codes['output_format'] = str(e)
+                    return json.dumps(self.response_codes, indent = 4)
+
     ##Above return ends the process_request function. The function will not continue if Call_Direct_Download is called.
     ##Below are data checking calls. They all default to True in a typical user request.
 
@@ -235,101 +269,150 @@ class GRIDETLManager:
     
     #aggregate data funciton
     ##This function aggregates data based on date and performs small data cleaning for the user
-    ##input: df -- a filepath where all the data files are located
+    ##input: df -- the data folder, files are found through the folder's catalog
     ##input: translation -- mapping of data for the given endpoint, in this case we are looking at converting user inputted 'time' to single characters (ex below)
     ##input: additional_arguments -- extra arguments specific to our custom NOAA Gridded API. in this case, looking at time step to aggregate values (ex below) and how to aggregate each data type (ex2 below)
     ###ex. additional_arguments['aggregation']['time'] = 'weekly' --> translation['aggregation']['weekly] : 'W' (turn 'weekly' aggregation to 'W' character)
     ###ex2. additional_arguments['aggregation']['prcp'] = 'SUM' and additional_arguments['aggregation']['tavg'] = 'MEAN' --> SUM the PRCP column and MEAN the TAVG column
     def aggregate_data(self, df, translation, additional_arguments, api_parameters):
-        #create a list of all downloaded netcdf files
-        files = glob.glob(df + '//*.nc')
-        #open multiple NetCDF files, concatenate them along the 'time' dimension
-        combined_ds = xr.open_mfdataset(files, concat_dim='time', combine='nested')
+        #open the requested part of the data lazily
+        subset = self.subset_data(df, translation, additional_arguments, api_parameters)
+        if subset is None:
+            return pd.DataFrame()
+        combined_ds, agg_methods, freq = subset
+        #aggregate and convert to a table
+        try:
+            result_df = self.resample_data(combined_ds, agg_methods, freq, additional_arguments)
+        except grid_store.STORE_ERRORS as e:
+            #data values are only read here, so a damaged store shows up here. Read the NetCDF files instead
+            ##other errors (ex. an unknown aggregation method) are the request's own, and aren't retried
+            if 'Zarr store' not in self.response_codes['aggregate_data']:
+                raise
+            print(f"Store read failed, reading NetCDF files: {type(e).__name__}: {e}")
+            combined_ds, agg_methods, freq = self.subset_data(df, translation, additional_arguments, api_parameters, use_store = False)
+            result_df = self.resample_data(combined_ds, agg_methods, freq, additional_arguments)
+        #return the data
+        return result_df
 
-        #select the data variabless. For the NOAA data, these are all the reported values
-        data_vars = combined_ds[['tmin', 'tmax', 'tavg', 'prcp']]
 
-        #convert the xarray Dataset to a pandas DataFrame
-        df = data_vars.to_dataframe().reset_index()
+    #subset data function
+    ##opens the data for a request lazily and cuts it down to the requested time, data types, and area, no data values are read
+    ##input: df, translation, additional_arguments, api_parameters -- same as aggregate_data
+    ##input: use_store -- False reads only the NetCDF files, skipping the Zarr store
+    ##output: (lazy xarray Dataset, dictionary of aggregation method per data type, resample frequency) tuple, or None if no files cover the requested dates
+    def subset_data(self, df, translation, additional_arguments, api_parameters, use_store = True):
+        #a polygon stacks the grid into cells, so points can't be picked from it afterwards
+        if additional_arguments is not None and additional_arguments.get('points') is not None and additional_arguments.get('polygon') is not None:
+            self.response_codes['aggregate_data'] = "'points' and 'polygon' can't be used together, request one or the other"
+            return None
+        #read complete years from the chunked Zarr store and other months from their NetCDF files (see grid_store.py), a time series for a point or small box only reads a few chunks
+        ##this is lazy, no data values are read until the data is aggregated
+        opened = None
+        if use_store:
+            try:
+                opened = grid_store.open_range(df, api_parameters['startdate'], api_parameters['enddate'])
+            except grid_store.STORE_ERRORS as e:
+                #the store is only a faster copy, a store that can't be opened falls back to the downloaded files
+                print(f"Store read failed, reading NetCDF files: {type(e).__name__}: {e}")
+                use_store = False
+        if not use_store:
+            opened = grid_store.open_files(df, api_parameters['startdate'], api_parameters['enddate'])
+        if opened is None:
+            self.response_codes['aggregate_data'] = 'No downloaded files cover the requested dates'
+            return None
+        combined_ds, self.response_codes['aggregate_data'] = opened
 
-        print(df.head())
-        
-        #ensure 'date' column is datetime type for proper resampling
-        df['time'] = pd.to_datetime(df['time'])
         #determine the aggregation time step. Look at user additional_arguments, and translate that to single character. (ex above)
         if additional_arguments is not None:
-            freq = translation['aggregation'].get(additional_arguments['aggregation']['time'], 'D')    
+            freq = translation['aggregation'].get(additional_arguments.get('aggregation', {}).get('time'), 'D')
         else:
             freq = 'D'
 
         #subset to time we care about
+        ##every subset is applied to the lazy dataset, so only the requested time, variables, and area are ever loaded
         start = datetime.strptime(api_parameters['startdate'], "%Y-%m-%d")
         end = datetime.strptime(api_parameters['enddate'], "%Y-%m-%d")
-        # Subset the DataFrame to the time range we care about
-        df = df[(df['time'] >= start) & (df['time'] <= end)]
-        print(len(df))
+        combined_ds = combined_ds.sel(time=slice(start, end))
 
         #default aggregation methods for our data
         agg_methods = {'tmin': 'mean', 'tmax': 'mean', 'tavg': 'mean', 'prcp': 'sum'}
-        #subset columns we want to keep
-        if api_parameters['datatypeid'] is not None or api_parameters['datatypeid'] != '':
+        #subset the data variables we want to keep
+        data_columns = list(agg_methods.keys())
+        if api_parameters.get('datatypeid') is not None and api_parameters['datatypeid'] != '':
             #find all the data column names that we want to keep
             data_columns = api_parameters['datatypeid'].split(',')
-            #constant columns that will always be returned
-            fixed_columns = ['time', 'lat', 'lon']
-            #keep the constant columns plus the data we want
-            keep = fixed_columns + data_columns
-            #subset the dataframe
-            df = df[keep]
             #filter agg_methods to include only the relevant aggregation methods for the datatype_columns
             agg_methods = {key: agg_methods[key] for key in data_columns if key in agg_methods}
-            
-        #convert DataFrame to GeoDataFrame
-        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon, df.lat))
-        #setting CRS to WGS 84
-        df.set_crs(epsg=4326, inplace=True)
-        #pick bounding box for aggregation
-        if additional_arguments is not None:
-            if additional_arguments['box'] is not None:
-                minlat = additional_arguments['box']['minlat']
-                minlon = additional_arguments['box']['minlon']
-                maxlat = additional_arguments['box']['maxlat']
-                maxlon = additional_arguments['box']['maxlon']
-
-                bounding_box = box(minlon, minlat, maxlon, maxlat)
-                
-                df = df[df.geometry.within(bounding_box)]
-
-        print(df.head())
-        #initialize an empty list to store the aggregated DataFrames
-        aggregated_dfs = []
+        combined_ds = combined_ds[data_columns]
+
+        #pick bounding box or polygon for aggregation
+        ##boxes are index slices on the grid, polygons (GeoJSON or a shapefile path) are a cached cell mask (see grid_subset.py)
+        if additional_arguments is not None and additional_arguments.get('box') is not None:
+            combined_ds = grid_subset.select_box(combined_ds, additional_arguments['box'])
+        if additional_arguments is not None and additional_arguments.get('polygon') is not None:
+            combined_ds = grid_subset.select_polygon(combined_ds, additional_arguments['polygon'], additional_arguments.get('all_touched', False))
+        #pick points for aggregation, only the time series at those points are returned
+        ##points are [lat, lon] pairs, {'id', 'lat', 'lon'} dictionaries, or GHCNd station / AmeriFlux site ids looked up in the database
+        if additional_arguments is not None and additional_arguments.get('points') is not None:
+            ids, lats, lons = self.resolve_points(additional_arguments['points'])
+            combined_ds = grid_subset.select_points(combined_ds, lats, lons, ids, additional_arguments.get('method', 'nearest'))
 
-        if (additional_arguments is not None) and ('aggregation' in additional_arguments):
-            print('true')
-        else:
-            print('false')
         #check to see if there's a custom aggregation method passed in additional_arguments
         if (additional_arguments is not None) and ('aggregation' in additional_arguments):
             for key, method in additional_arguments['aggregation'].items():
-                print(key)
                 if key in agg_methods:
                     agg_methods[key] = method  #ensure only valid columns are included
-        #convert 'time' column to datetime if not already
-        df['time'] = pd.to_datetime(df['time'])
 
-        if additional_arguments is not None and 'dropNA' in additional_arguments:
-            if additional_arguments['dropNA'] == True:
-                df.dropna(inplace=True)
-        
-        #group by 'lat', 'lon' and resample by 'time'
-        grouped = df.set_index('time').groupby(['lat', 'lon']).resample(freq, dropna=False)
-        
-        #aggregating using the specified methods
-        aggregated = grouped.agg(agg_methods)
-        
-        #reset index after aggregation
-        aggregated = aggregated.reset_index()
-        
+        return combined_ds, agg_methods, freq
+
+
+    #resample dataset function
+    ##aggregates a lazy dataset by time, the result is still lazy
+    ##input: combined_ds -- lazy xarray Dataset from subset_data
+    ##input: agg_methods -- dictionary of aggregation method per data type
+    ##input: freq -- resample frequency
+    ##input: additional_arguments -- extra arguments specific to our custom NOAA Gridded API ('dropNA')
+    ##output: lazy xarray Dataset of the aggregated data, with a 'valid_count' variable (complete time steps per period) when dropNA is used
+    def resample_dataset(self, combined_ds, agg_methods, freq, additional_arguments):
+        #dropNA removes every time step where any of the requested data types is missing before aggregating
+        drop_na = additional_arguments is not None and additional_arguments.get('dropNA') == True
+        if drop_na:
+            valid = combined_ds.to_array('datatype').notnull().all('datatype')
+            combined_ds = combined_ds.where(valid)
+
+        #resample every grid cell at once on the array itself, each data type with its own reduction
+        ##ex. agg_methods = {'tmax': 'mean', 'prcp': 'SUM'} --> tmax.resample(time=freq).mean() and prcp.resample(time=freq).sum()
+        aggregated = xr.Dataset({key: getattr(combined_ds[key].resample(time=freq), str(method).lower())() for key, method in agg_methods.items()})
+        if drop_na:
+            #count of complete time steps in each period, computed with the data so the source is only read once
+            aggregated['valid_count'] = valid.resample(time=freq).sum()
+        #sort the grid cells south to north, the same order as before the aggregation was moved to xarray
+        if 'lat' in aggregated.dims:
+            aggregated = aggregated.sortby('lat')
+        #time is the last dimension so each grid cell's time series stays together in the table
+        return aggregated.transpose(..., 'time')
+
+
+    #resample data function
+    ##aggregates a lazy dataset by time and converts it to a table for the user
+    ##input: combined_ds, agg_methods, freq -- same as resample_dataset
+    ##input: additional_arguments -- extra arguments specific to our custom NOAA Gridded API ('dropNA' and 'format')
+    ##input: compute_kwargs -- arguments for dask's compute (ex. scheduler), defaults to dask's default scheduler
+    ##output: pandas DataFrame of the aggregated data
+    def resample_data(self, combined_ds, agg_methods, freq, additional_arguments, compute_kwargs = None):
+        drop_na = additional_arguments is not None and additional_arguments.get('dropNA') == True
+        #read and aggregate the data
+        aggregated = self.resample_dataset(combined_ds, agg_methods, freq, additional_arguments).compute(**(compute_kwargs or {}))
+
+        #convert only the aggregated output cells to a pandas DataFrame
+        ##point requests keep the point name as the first column
+        id_columns = ['point', 'lat', 'lon', 'time'] if 'point' in aggregated.dims else ['lat', 'lon', 'time']
+        table = aggregated.to_dataframe().reset_index()
+        if drop_na:
+            #time steps that had no complete rows left (ex. ocean cells with no precipitation) are removed
+            table = table[table['valid_count'] > 0].reset_index(drop=True)
+        aggregated = table[id_columns + list(agg_methods.keys())]
+
         #convert date back to a readable text for the user
         aggregated['time'] = aggregated['time'].dt.strftime('%Y-%m-%d')
 
@@ -339,15 +422,186 @@ class GRIDETLManager:
         if additional_arguments is not None:
             if additional_arguments.get('format') == 'long':
                 #reshape the DataFrame to have 'datatype' and 'value' columns
-                result_df = aggregated.melt(id_vars=['time', 'lat', 'lon'], var_name='datatype', value_name='value')
+                result_df = aggregated.melt(id_vars=id_columns, var_name='datatype', value_name='value')
             elif additional_arguments.get('format') == 'wide':
                 #if wide format is requested or no format is specified, use the wide format as default
                 result_df = aggregated
-        print(result_df)
-        #return the data
         return result_df
 
-    
+
+    #stream data function
+    ##out-of-core version of aggregate_data for requests too large to hold in memory (Additional_Arguments 'stream' : True)
+    ##the area is split into blocks of grid rows (or cells/points) sized so one block reads at most DASK_CONFIG['block_values'] values
+    ##each block is split into chunks that are read and aggregated in parallel on a pool of processes, then converted to a table and handed back before the next block starts
+    ##input: df, translation, additional_arguments, api_parameters -- same as aggregate_data
+    ##output: generator of pandas DataFrames, one per block
+    def stream_data(self, df, translation, additional_arguments, api_parameters):
+        subset = self.subset_data(df, translation, additional_arguments, api_parameters)
+        if subset is None:
+            return
+        combined_ds, agg_methods, freq = subset
+        #blocks go south to north, the same order as aggregate_data
+        if 'lat' in combined_ds.dims:
+            combined_ds = combined_ds.sortby('lat')
+            block_dim = 'lat'
+        else:
+            block_dim = 'point' if 'point' in combined_ds.dims else 'cell'
+        #values read for one row of the block dimension (ex. one grid row has lon cells x time steps x data types)
+        row_values = combined_ds.sizes['time'] * max(len(agg_methods), 1)
+        if block_dim == 'lat':
+            row_values *= combined_ds.sizes['lon']
+        rows = combined_ds.sizes[block_dim]
+        workers = DASK_CONFIG['workers']
+        block_rows = max(1, min(rows, DASK_CONFIG['block_values'] // max(row_values, 1)))
+        #explicit chunks, every block is split into one chunk per worker
+        chunks = {block_dim: max(1, -(-block_rows // workers))}
+        if block_dim == 'lat':
+            chunks['lon'] = -1
+        combined_ds = combined_ds.chunk(chunks)
+        self.response_codes['stream_data'] = {'blocks': -(-rows // block_rows), 'rows_per_block': block_rows, 'workers': workers}
+
+        #spawned processes, forking a threaded Flask server is not safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for start in range(0, rows, block_rows):
+                block = combined_ds.isel({block_dim: slice(start, start + block_rows)})
+                yield self.resample_data(block, agg_methods, freq, additional_arguments, {'scheduler': 'processes', 'pool': pool})
+
+
+    #stream response function
+    ##wraps stream_data in a Flask streaming Response in CSV, JSON, PARQUET, or ARROW format, only one block of data is held in memory at a time
+    ##input: frames -- generator of pandas DataFrames from stream_data
+    ##input: file_format -- 'CSV', 'JSON', 'PARQUET', or 'ARROW'
+    ##output: Flask Response streaming the data
+    def stream_response(self, frames, file_format):
+        #PARQUET and ARROW: each block is written as its own row groups or record batches
+        if file_format in output_formats.OUTPUT_FORMATS:
+            try:
+                return output_formats.frames_response(frames, file_format, self.args['Additional_Arguments'])
+            except ValueError as e:
+                self.response_codes['output_format'] = str(e)
+                return json.dumps(self.response_codes, indent = 4)
+
+        #CSV: header line from the first block, then rows written block by block
+        def generate_csv():
+            header = True
+            for frame in frames:
+                yield frame.to_csv(index=False, header=header)
+                header = False
+
+        #JSON: one array of records, written as fragments so the full array is never held in memory
+        def generate_json():
+            yield '['
+            first = True
+            for frame in frames:
+                if len(frame) == 0:
+                    continue
+                records = frame.to_json(orient="records", lines = True).strip().replace('\n', ',\n')
+                yield ('\n' if first else ',\n') + records
+                first = False
+            yield '\n]'
+
+        if file_format == 'JSON':
+            return Response(generate_json(), mimetype='application/json')
+        return Response(
+            generate_csv(),
+            mimetype='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
+        )
+
+
+    #netcdf response function
+    ##aggregates a request and sends it as a NetCDF file, keeping the data on its grid (or polygon cells/points) instead of a table
+    ##the aggregation stays lazy and is written to the file chunk by chunk, so it works for requests too large to hold in memory
+    ##the file is written in full before it is sent (see output_formats.netcdf_stream), so unlike 'stream' nothing reaches the user until the whole request is aggregated
+    ##input: df, translation, additional_arguments, api_parameters -- same as aggregate_data ('format' is not used)
+    ##output: Flask Response sending the NetCDF file, or the response codes if there is no data or the compression options are wrong
+    def netcdf_response(self, df, translation, additional_arguments, api_parameters):
+        subset = self.subset_data(df, translation, additional_arguments, api_parameters)
+        if subset is None:
+            return json.dumps(self.response_codes, indent = 4)
+        combined_ds, agg_methods, freq = subset
+        aggregated = self.resample_dataset(combined_ds, agg_methods, freq, additional_arguments)
+        #a grid can't drop rows, so periods with no complete time steps are left missing instead
+        if 'valid_count' in aggregated:
+            aggregated = aggregated.where(aggregated['valid_count'] > 0).drop_vars('valid_count')
+        #NetCDF can't store the polygon's stacked cell index, lat and lon are kept as coordinates of each cell
+        if 'cell' in aggregated.dims:
+            aggregated = aggregated.reset_index('cell')
+        aggregated = aggregated.transpose('time', ...)
+        try:
+            return output_formats.dataset_response(aggregated, additional_arguments)
+        except ValueError as e:
+            self.response_codes['output_format'] = str(e)
+            return json.dumps(self.response_codes, indent = 4)
+
+
+    #resolve points function
+    ##turns the user's points into lists of names, latitudes, and longitudes
+    ##input: points -- list of [lat, lon] pairs, {'id', 'lat', 'lon'} dictionaries, or station ids (GHCNd ids from noaa_station_list, AmeriFlux site ids from amf_stations)
+    ##output: (ids, lats, lons) tuple of lists. Station ids that can't be found are left out and reported in the response codes
+    def resolve_points(self, points):
+        stations = self.station_locations([point for point in points if isinstance(point, str)])
+        ids = []
+        lats = []
+        lons = []
+        missing = []
+        for point in points:
+            if isinstance(point, str):
+                if point not in stations:
+                    missing.append(point)
+                    continue
+                lat, lon = stations[point]
+                ids.append(point)
+            elif isinstance(point, dict):
+                lat, lon = float(point['lat']), float(point['lon'])
+                ids.append(str(point.get('id', f'{lat},{lon}')))
+            else:
+                lat, lon = float(point[0]), float(point[1])
+                ids.append(f'{lat},{lon}')
+            lats.append(lat)
+            lons.append(lon)
+        if len(missing) > 0:
+            self.response_codes['resolve_points'] = 'Stations not found: ' + ', '.join(missing)
+        return ids, lats, lons
+
+
+    #station locations function
+    ##looks up the locations of GHCNd stations and AmeriFlux sites in the database, using the shared connection pool
+    ##input: names -- list of station or site ids
+    ##output: dictionary of id : (lat, lon)
+    def station_locations(self, names):
+        locations = {}
+        if len(names) == 0:
+            return locations
+        if self.args.get('DB_Credentials') is None:
+            self.response_codes['station_locations'] = 'DB_Credentials are needed to look up station ids'
+            return locations
+        queries = [
+            'SELECT id, latitude, longitude FROM noaa_station_list WHERE id = ANY(%s);',
+            'SELECT site_id, location_lat, location_long FROM amf_stations WHERE site_id = ANY(%s);'
+        ]
+        try:
+            conn = db_pool.get_pool(self.args['DB_Credentials']).getconn()
+        except psycopg2.Error as e:
+            self.response_codes['station_locations'] = f"Database connection failed: {e}"
+            return locations
+        try:
+            cursor = conn.cursor()
+            for query in queries:
+                try:
+                    cursor.execute(query, (list(names),))
+                    for name, lat, lon in cursor.fetchall():
+                        locations[name] = (float(lat), float(lon))
+                except psycopg2.Error as e:
+                    #a missing table only skips that kind of station
+                    conn.rollback()
+                    print(f"Station lookup failed: {e}")
+            cursor.close()
+        finally:
+            conn.close()
+        return locations
+
+
     #generate api call function
     ##this function creates the URL list to download files from the FTP Server
     ##input: translation -- endpoint translaiton that provides the base URL and endpoint for this API call
@@ -431,96 +685,85 @@ class GRIDETLManager:
     
     #api call function
     ##this is designed to count the amount of files the FTP server has
-    ##input: url -- base url for the API
+    ##input: url -- list of file urls from generate_api_call
     ##input: enpoint -- the data endpoint for the API
     ##input: headers -- leading data for the API call (usually api key)
     ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
     ##output: rows -- the count of files (amount of data) that the given API call has to the FTP server
     def api_call(self, url, endpoint, headers, parameters):
-        #try to call the API and return the count of rows    
-        #since we only care about the number of rows, we only look at header to be returned so we can check if it downloads
-        rows = 0
+        #check every file at once with HEAD requests over a shared session, since we only care if the file exists (see grid_download.py)
+        ##the current and last month are re-checked after a short time, since their prelim files get replaced by scaled files
+        today = datetime.today().date()
+        last_month = today.replace(day=1) - timedelta(days=1)
+        recent_months = {today.strftime("%Y%m"), last_month.strftime("%Y%m")}
+        recent = set()
         for link in url:
-            filename = link.split('/')[-1]
-            # Retry logic
-            max_attempts = 3
-            attempts = 0
-
-            #try to get the file a few times
-            while attempts < max_attempts:
-                try:
-                    # Send a GET request to the URL
-                    response = requests.head(link)
-                    
-                    # Raise an exception if the request was unsuccessful
-                    response.raise_for_status()
-                    #if sucessful, then add count to the file
-                    if response.status_code == 200:
-                        rows += 1
-                        break
-                    else:
-                        attempts += 1
-                #failed attempt to download data error
-                except requests.exceptions.RequestException as e:
-                    attempts += 1
-                    print(f"Attempt {attempts} failed: {e}")
-                    time.sleep(0.5)  # Wait for 1 second before retrying
+            match = grid_catalog.FILE_PATTERN.search(link)
+            if match is not None and match.group(1) in recent_months:
+                recent.add(link)
+        available = grid_download.check_files_available(url, recent)
+
+        #count of files the FTP server has
+        rows = sum(1 for result in available if result)
+        #files the server couldn't be asked about
+        errors = sum(1 for result in available if result is None)
+        if errors > 0:
+            print(f"{errors} files could not be checked")
         #return the count of files the FTP server has
         self.response_codes['api_call'] = 'API returned ' + str(rows)
         return rows
 
     
     #api download data function
-    ##this function downloads all the data instead of just counting rows. Separated into it's own unique function due to length.
-    ##it repeats API calls, downloading data 'limit' number of rows at a time until it downloads all available data (or function errors 5 times in a row)
-    ##ex. 'limit' = 500, metadata rows = 1200.. the function will make 3 API calls
-    ##input: url -- base url for the API
-    ##input: enpoint -- the data endpoint for the API
-    ##input: headers -- leading data for the API call (usually api key)
-    ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
-    ##output: all_data -- all of the data for the given API call
+    ##this function downloads all the month files for the request into the local data folder
+    ##files are downloaded in parallel, resumed if a previous download was interrupted, and skipped if the local copy is already up to date (see grid_download.py)
+    ##downloaded files are recorded in the folder's catalog (see grid_catalog.py)
+    ##input: url -- list of file urls from generate_api_call
+    ##input: enpoint -- the number of months requested (not used)
+    ##input: headers -- warnings from generate_api_call (not used)
+    ##input: parameters -- the parameters for the API call (not used)
+    ##output: target_folder -- the folder holding all the downloaded files
     def api_download(self, urls, endpoint, headers, parameters):
         target_folder = '../GRID_DATA/'
+        #prelim files are not needed for months we already have the scaled file for
+        catalog = grid_catalog.read_catalog(target_folder)
+        scaled = {month for month, entry in catalog.items() if entry['kind'] == 'scaled'}
+        download_urls = []
         for url in urls:
-            # Extract filename from URL
-            filename = url.split('/')[-1]
-        
-            # Make sure the target folder exists
-            if not os.path.exists(target_folder):
-                os.makedirs(target_folder)
-        
-            # Full path for saving the file
-            full_path = os.path.join(target_folder, filename)
-        
-            # Retry logic
-            max_attempts = 3
-            attempts = 0
-
-            #attempt to download all files
-            while attempts < max_attempts:
-                try:
-                    #send a GET request to the URL
-                    response = requests.get(url, stream=True)
-                    
-                    #raise an exception if the request was unsuccessful
-                    response.raise_for_status()
-        
-                    #write the file
-                    with open(full_path, 'wb') as file:
-                        #write the content of the response in chunks to the file
-                        for chunk in response.iter_content(chunk_size=8192):
-                            file.write(chunk)
-        
-                    print(f"File downloaded: {full_path}")
-                    break
-                except requests.exceptions.RequestException as e:
-                    attempts += 1
-                    print(f"Attempt {attempts} failed: {e}")
-                    time.sleep(0.5)  #wait for 1 second before retrying
+            match = grid_catalog.FILE_PATTERN.search(url)
+            if match is not None and match.group(2) == 'prelim' and match.group(1) in scaled:
+                continue
+            download_urls.append(url)
+        results = grid_download.download_files(download_urls, target_folder)
+        #record the files in the catalog, scaled files replace prelim files for the same month
+        grid_catalog.update_catalog(target_folder, results)
+
+        #report how each file was handled, prelim files are often 'missing' once the scaled file is released
+        summary = {}
+        for result in results:
+            summary[result['status']] = summary.get(result['status'], 0) + 1
+            if result['status'] == 'failed':
+                print(f"Download failed: {result['url']} ({result['error']})")
+            elif result['status'] != 'missing':
+                print(f"File {result['status']}: {result['path']}")
+        self.response_codes['api_download'] = summary
 
         return target_folder
         
 
+    #ingest data function
+    ##copies downloaded years into the chunked Zarr store (see grid_store.py), on a separate thread so the request doesn't wait for it
+    ##only one ingest runs at a time across threads and worker processes, and a failed ingest is only logged, requests read the NetCDF files instead
+    ##input: folder -- the data folder from api_download, or None if the download failed
+    ##output: nothing, it updates the store on a separate thread
+    def ingest_data(self, folder):
+        if folder is None:
+            return
+        thread = threading.Thread(target=grid_store.ingest_job, args=(folder,), daemon=True)
+        thread.start()
+        self.response_codes['ingest_data'] = 'Store ingest started in background'
+
+
     #check completeness function
     ##this function checks if the data is complete based on the reported number of rows by the database and API.
     ##input: db_vals -- count of rows in generated API call, or None if generate API was never called
@@ -14,15 +14,48 @@ import psycopg2
 #requests for NOAA API calls
 import requests
 #datetime for data aggregation by date
-from datetime import datetime
+from datetime import datetime, timedelta
 #pandas for data aggregation
 import pandas as pd
 #threading to update database with new data in the background
 import threading
 #Flask for api response return
 from flask import Flask, Response
+#Parquet and Arrow downloads
+import output_formats
 #json for api response return
 import json
+#csv and io for streaming api response return
+import csv
+import io
+#shared database connection pool
+import db_pool
+#hashlib, itertools, and re for naming and numbering prepared statements
+import hashlib
+import itertools
+import re
+#rate limiting and parallel page downloads for NOAA API calls
+import rate_limiter
+from concurrent.futures import ThreadPoolExecutor
+import random
+import time
+
+#NOAA's Climate Data Online API allows 5 requests per second and 10,000 requests per day for each API key
+NOAA_RATE_LIMITS = [(5, 1), (10000, 86400)]
+#number of API pages downloaded at the same time
+API_WORKERS = 5
+#number of times a single API page is retried before giving up
+API_MAX_RETRIES = 5
+#largest page size NOAA allows
+API_PAGE_LIMIT = 1000
+#NOAA rejects daily (GHCND) requests spanning more than a year, so long requests are split into windows of at most one year
+##stations are also split into groups so the request URL stays a reasonable length
+API_STATIONS_PER_WINDOW = 25
+#number of request windows downloaded at the same time (each window also downloads its pages in parallel)
+API_WINDOW_WORKERS = 3
+#shared requests session, so API calls reuse open (keep-alive) connections instead of reconnecting every time
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
 
 """
 Class NOAAETLManager
@@ -30,7 +63,7 @@ Global variables:
     self.args
         - Arguments passed in by user to the NOAA API. There are many, so they are defined in the file noaa_api_call.py
         - There are many Call_X functions, these allow a user to call or bypass any optional data checks in the ETL manager. Typically they will remain active, unless a user has problems with a specific data check.
-        - Typical users will input 'Endpoint' (NOAA_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV or JSON for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation) 'DB_Credentials' (database credentials), 'NOAA_API_KEY' (NOAA's API key).
+        - Typical users will input 'Endpoint' (NOAA_DATA), 'Call_Direct_Download' (FALSE for checking data, CSV, JSON, PARQUET, or ARROW for downloading data after check) 'API_Arguments' (define data they want), 'Additional_Arguments' (define how they want aggregation) 'DB_Credentials' (database credentials), 'NOAA_API_KEY' (NOAA's API key).
     self.response_codes
         - For every section of data checking that occurs, the response codes store the failure/success of the function call. This is used for debugging and indicating to the user what is happening during the data processing pipeline.
 
@@ -59,21 +92,58 @@ class NOAAETLManager:
         ##Ex. URL of API, and translation from API to database (startdate : X to SQL date >= X)
         arg_trans = self.translate_endpoint(self.args['Endpoint'])
 
-        #If Call_Direct_Download is CSV or JSON --> start our data download process
-        if (self.args['Call_Direct_Download'] == 'CSV') or (self.args['Call_Direct_Download'] == 'JSON'):
+        #If Call_Direct_Download is a download format (CSV, JSON, PARQUET, ARROW, or NETCDF) --> start our data download process
+        if self.args['Call_Direct_Download'] in output_formats.DOWNLOAD_FORMATS:
+            #formats that can't be written from a table (NETCDF) and bad compression options are rejected before the database is queried
+            try:
+                output_formats.check_table_format(self.args['Call_Direct_Download'], self.args['Additional_Arguments'])
+            except ValueError as e:
+                self.response_codes['output_format'] = str(e)
+                return json.dumps(self.response_codes, indent = 4)
             #conn calls db_connect, which creates an open conneciton to our database with psycopg2
             conn = self.db_connect(self.args['DB_Credentials'])
-            #sql calls generate_sql, which generates an sql query for the user inputted parameters
-            sql = self.generate_sql(translation = arg_trans,
-                                api_arguments = self.args['API_Arguments'])
-            #db_vals calls execute_sql, which runs the above generated sql statement AND returns all the rows (download=True)
-            db_vals = self.execute_sql(sql, conn, download=True)
-            #close the connection to the database
-            conn.close()
+            #the connection goes back to the pool however this block ends, unless it was handed to a streaming response
+            try:
+                #sql calls generate_sql, which generates an sql query for the user inputted parameters
+                sql = self.generate_sql(translation = arg_trans,
+                                    api_arguments = self.args['API_Arguments'])
+                #if Call_Aggregation is True, try to aggregate inside the database so only the aggregated rows are sent back
+                ##agg_sql is None when an aggregation style can't be written in SQL, then pandas aggregates the raw rows instead
+                ##weekly, monthly, and yearly requests are served from the rollup table when possible, so the raw daily rows aren't read at all
+                agg_sql = None
+                if self.args['Call_Aggregation']:
+                    agg_sql = self.generate_rollup_sql(sql, arg_trans, self.args['Additional_Arguments'], self.args['API_Arguments'], conn)
+                    if agg_sql is None:
+                        agg_sql = self.generate_aggregate_sql(sql, arg_trans, self.args['Additional_Arguments'])
+                #streaming mode (Additional_Arguments 'stream' : True) sends rows to the user as they are read from the database
+                ##database aggregated rows can be streamed in long format, with Call_Aggregation False streaming mode returns the raw database rows
+                if (self.args['Additional_Arguments'] is not None) and (self.args['Additional_Arguments'].get('stream') == True):
+                    if self.args['Call_Aggregation']:
+                        #wide format and pandas-only aggregations need every row at once, so they can't be streamed. Sending raw rows instead would quietly ignore the aggregation
+                        if agg_sql is None or self.args['Additional_Arguments'].get('format') == 'wide':
+                            self.response_codes['stream'] = "stream can't be used with wide format or with aggregations the database can't do (see SQL_Aggregation). Remove 'stream', or set Call_Aggregation to False to stream the raw rows."
+                            return json.dumps(self.response_codes, indent = 4)
+                        sql = agg_sql
+                    #stream_response keeps the connection open until the last row is sent (or the response is closed), then returns it to the pool
+                    response = self.stream_response(sql, conn, self.args['Call_Direct_Download'])
+                    conn = None
+                    return response
+                #db_vals calls execute_sql, which runs the above generated sql statement AND returns all the rows (download=True)
+                if agg_sql is not None:
+                    db_vals = self.execute_sql(agg_sql, conn, download=True)
+                else:
+                    db_vals = self.execute_sql(sql, conn, download=True)
+            finally:
+                #close the connection to the database
+                if conn is not None:
+                    conn.close()
             #check if db_vals was able to get data from the database
             if db_vals is not None:
+                #the database already aggregated the data, only the format needs to be applied
+                if agg_sql is not None:
+                    db_vals = self.format_data(db_vals, self.args['Additional_Arguments'])
                 #if Call_Aggregation is True, then start aggregating the data based on additional arguments
-                if self.args['Call_Aggregation']:
+                elif self.args['Call_Aggregation']:
                     #call aggregate_data function to aggregate and clean data for user
                     db_vals = self.aggregate_data(db_vals, arg_trans, self.args['Additional_Arguments'])
 
@@ -93,6 +163,14 @@ class NOAAETLManager:
                     headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
                 )
 
+            #if we want a binary format, write it in row groups as it is sent
+            elif self.args['Call_Direct_Download'] in output_formats.OUTPUT_FORMATS:
+                try:
+                    return output_formats.frames_response(db_vals, self.args['Call_Direct_Download'], self.args['Additional_Arguments'])
+                except ValueError as e:
+                    self.response_codes['output_format'] = str(e)
+                    return json.dumps(self.response_codes, indent = 4)
+
     ##Above return ends the process_request function. The function will not continue if Call_Direct_Download is called.
     ##Below are data checking calls. They all default to True in a typical user request.
 
@@ -101,13 +179,16 @@ class NOAAETLManager:
         if self.args['Call_DB']:
             #conn calls db_connect, which creates an open connection to our database with psycopg2
             conn = self.db_connect(self.args['DB_Credentials'])
-            #sql calls generate_sql, which generatees an sql query for the user inputted parameters
-            sql = self.generate_sql(translation = arg_trans,
-                                api_arguments = self.args['API_Arguments'])
-            #db_vals calls execute_sql which runs the above generated sql statements AND returns the count of all the rows (download defaults to False)
-            db_vals = self.execute_sql(sql, conn)
-            #close the connection to the database
-            conn.close()
+            try:
+                #sql calls generate_sql, which generatees an sql query for the user inputted parameters
+                sql = self.generate_sql(translation = arg_trans,
+                                    api_arguments = self.args['API_Arguments'])
+                #db_vals calls execute_sql which runs the above generated sql statements AND returns the count of all the rows (download defaults to False)
+                db_vals = self.execute_sql(sql, conn)
+            finally:
+                #close the connection to the database
+                if conn is not None:
+                    conn.close()
 
         #Call API
         ##in order to check for data completeness, we want to count how many rows the NOAA API has for this specific request
@@ -153,19 +234,21 @@ class NOAAETLManager:
     #translate_endpoint function
     ##this function provides mappings for these items based on the user inputted 'Endpoint':
     ###table -- the table that we are downloading data from in the database
-    ###sql -- translate API parameters to SQL query. ex. 'statdate = X' in the API wil translate to 'date >= X' in the SQL query
+    ###sql -- translate API parameters to SQL query. ex. 'statdate = X' in the API wil translate to 'date >= %s' in the SQL query with X as a query parameter. Conditions using ANY(%s) take a list of values
     ###api -- provide url, endpoint, and data to be downloaded from the NOAA API
     ###aggregation -- user options to aggregate the data by date, swaps it to single character for pandas resample/aggreagtion
+    ###sql_aggregation and sql_functions -- the same aggregation options written as SQL, so aggregation can run inside the database
+    ###rollup -- table of pre-aggregated summaries, and how to get each aggregation style out of it
     def translate_endpoint(self, endpoint):
         #Mappings of relevent details for each API/DB Call
         endpoint_mappings = {
             'NOAA_DATA': {
                 'table': 'noaa_api',
                 'sql': {
-                    'datatypeid' : 'datatype ',
-                    'stationid' : 'station ',
-                    'startdate' : 'date >',
-                    'enddate' : 'date <'
+                    'datatypeid' : 'datatype = ANY(%s)',
+                    'stationid' : 'station = ANY(%s)',
+                    'startdate' : 'date >= %s',
+                    'enddate' : 'date <= %s'
                 },
                 'api' : {
                     'url' : 'https://www.ncdc.noaa.gov/cdo-web/api/v2/',
@@ -177,6 +260,35 @@ class NOAAETLManager:
                     'weekly': 'W',
                     'monthly': 'M',
                     'yearly': 'Y'
+                },
+                #database versions of the aggregation times, labelled the same way as pandas (end of the week (Sunday), month, or year)
+                'sql_aggregation' : {
+                    'daily': "date_trunc('day', date)",
+                    'weekly': "date_trunc('week', date) + interval '6 days'",
+                    'monthly': "date_trunc('month', date) + interval '1 month' - interval '1 day'",
+                    'yearly': "date_trunc('year', date) + interval '1 year' - interval '1 day'"
+                },
+                #database versions of the aggregation styles, styles not listed here are aggregated by pandas instead
+                'sql_functions' : {
+                    'mean': 'AVG(value)',
+                    'sum': 'SUM(value)',
+                    'min': 'MIN(value)',
+                    'max': 'MAX(value)',
+                    'count': 'COUNT(value)',
+                    'median': 'percentile_cont(0.5) WITHIN GROUP (ORDER BY value)',
+                    'std': 'STDDEV_SAMP(value)',
+                    'var': 'VAR_SAMP(value)'
+                },
+                #pre-aggregated weekly, monthly, and yearly summaries (see SETUP_DB/noaa_api_rollup.sql), kept up to date by fill_incomplete
+                'rollup' : {
+                    'table': 'noaa_api_rollup',
+                    'functions': {
+                        'mean': 'value_sum / NULLIF(value_count, 0)',
+                        'sum': 'value_sum',
+                        'min': 'value_min',
+                        'max': 'value_max',
+                        'count': 'value_count'
+                    }
                 }
             },
             # Add more mappings as needed
@@ -197,21 +309,25 @@ class NOAAETLManager:
 
     
     #database connection function
-    ##creates and returns a database connection using psycopg2
+    ##borrows a database connection from the shared connection pool (see db_pool.py)
+    ##calling .close() on the connection hands it back to the pool
     ##input: db_credentials -- dictionary containing 'dbname', 'user', 'password', 'host', and 'port'
     ##output: database connection object (if successful) or None (if fails)
     def db_connect(self, db_credentials):
-        #attempt to connect to database using psycopg2
+        #attempt to borrow a connection from the pool for these credentials
         try:
-            connection = psycopg2.connect(
-                dbname=db_credentials['dbname'],
-                user=db_credentials['user'],
-                password=db_credentials['password'],
-                host=db_credentials['host'],
-                port=db_credentials['port']
-            )
+            pool = db_pool.get_pool({
+                'dbname': db_credentials['dbname'],
+                'user': db_credentials['user'],
+                'password': db_credentials['password'],
+                'host': db_credentials['host'],
+                'port': db_credentials['port']
+            })
+            connection = pool.getconn()
             #if that worked, we can set response code to True (connection was successful)
             self.response_codes['DB_Connect'] = True
+            #report how busy the pool is, so slow requests waiting on connections can be spotted
+            self.response_codes['DB_Pool'] = pool.stats()
             #return connection object
             return connection
         #if it fails, report the error
@@ -225,10 +341,11 @@ class NOAAETLManager:
 
     
     #generate sql query function
-    ##creates a sql query that can download all the data for the given user inputs
+    ##creates a parameterized sql query that can download all the data for the given user inputs
+    ##user values are never written into the SQL text, they are passed separately as query parameters. This keeps the SQL text the same for every request of the same shape, so the database can reuse its query plan
     ##input: translation -- the translation dictionary from translate_endpoint function
     ##input: api_argumets -- the user-inputted api arguments that follow NOAA API's input scheme.
-    ##output: a sql query dictionary with 'SELECT', 'FROM', and 'WHERE' keys.
+    ##output: a sql query dictionary with 'SELECT', 'FROM', 'WHERE', and 'PARAMS' keys.
     def generate_sql(self, translation, api_arguments):
         #select all columns of the data
         ##there used to be more logic involved, such as picking columns to be returned, but this was migrated to the data aggregation function
@@ -237,26 +354,24 @@ class NOAAETLManager:
         from_clause = 'FROM "' + translation['table'] + '"'  # Ensure table_name is correctly quoted for SQL
         #default WHERE clause (downloads everything, allows us to extend the where clause with AND statements)
         where_clause = "WHERE 1=1"
+        #query parameters, in the same order as the %s placeholders in the WHERE clause
+        params = []
     
         #look at each argument in the api_arguments dictionary
         ##if we have a sql translation, add it to the WHERE clause
-        ##ex. arg:value 'startdate':'2023-12-30' adds " AND date >= '2023-12-30' " to the WHERE clause.
-        ##ex2. arg:value 'dataype':'PRCP,TAVG' adds " AND datatype IN ('PRCP', 'TAVG') "  to the WHERE clause.
-        for arg, value in api_arguments.items():
-            #check if argument type is in our translation dictionary
-            if arg in translation['sql']:
-                #check if the argument value contains multiple values separated by commas
-                if ',' in value:
-                    #split the value by comma and create a sql IN clause
-                    values_list = value.split(',')
-                    #create list of values (see ex2 above)
-                    in_clause = "(" + ", ".join(["'" + val + "'" for val in values_list]) + ")"
-                    #make this into a 'condition': " argument IN (list, of, values) "
-                    condition = translation['sql'][arg] + " IN " + in_clause
+        ##ex. arg:value 'startdate':'2023-12-30' adds " AND date >= %s " to the WHERE clause and '2023-12-30' to the parameters.
+        ##ex2. arg:value 'dataype':'PRCP,TAVG' adds " AND datatype = ANY(%s) " to the WHERE clause and ['PRCP', 'TAVG'] to the parameters.
+        ##single values in list arguments are still passed as a list, so 'PRCP' and 'PRCP,TAVG' share the same query shape
+        ##conditions are always added in the order of the translation dictionary, so argument order doesn't change the query shape either
+        for arg, condition in translation['sql'].items():
+            value = api_arguments.get(arg)
+            #skip arguments the user didn't give us
+            if value is not None and value != '':
+                #list conditions take every comma separated value (see ex2 above)
+                if 'ANY(' in condition:
+                    params.append(value.split(','))
                 else:
-                    if value != '':
-                        #single value 'condition': " argument = value " (see ex above)
-                        condition = translation['sql'][arg] + "= '" + value + "'"
+                    params.append(value)
                 #add our 'condition' to the WHERE clause, seperate each condition by " AND "
                 where_clause += " AND " + condition
 
@@ -264,7 +379,8 @@ class NOAAETLManager:
         sql_statement = {
             "SELECT": select_clause,
             "FROM": from_clause,
-            "WHERE": where_clause
+            "WHERE": where_clause,
+            "PARAMS": params
         }
 
         #save the sql statement to the response codes, so user can verify it is working correct
@@ -273,10 +389,223 @@ class NOAAETLManager:
         #return the dictionary
         return sql_statement
 
+
+    #prepare query function
+    ##turns a parameterized query into a prepared statement on the given connection, so the database plans each query shape once per connection
+    ##pooled connections (see db_pool.py) remember which statements they have prepared, other connections run the query as is
+    ##input: connection -- psycopg2 database connection
+    ##input: sql_query -- query text with %s placeholders
+    ##input: params -- list of query parameters
+    ##output: (query, params) tuple to pass into cursor.execute or pd.read_sql_query
+    def prepare_query(self, connection, sql_query, params):
+        prepared = getattr(connection, 'prepared', None)
+        if prepared is None:
+            return sql_query, params
+        #the statement name comes from the query text, so the same shape always gets the same name
+        name = 'noaa_' + hashlib.md5(sql_query.encode()).hexdigest()[:16]
+        if name not in prepared:
+            #PREPARE uses numbered placeholders ($1, $2, ...) instead of %s
+            count = itertools.count(1)
+            numbered = re.sub(r'%s', lambda match: '$' + str(next(count)), sql_query)
+            cursor = connection.cursor()
+            cursor.execute('PREPARE ' + name + ' AS ' + numbered)
+            cursor.close()
+            prepared.add(name)
+        if len(params) == 0:
+            return 'EXECUTE ' + name, params
+        return 'EXECUTE ' + name + ' (' + ', '.join(['%s'] * len(params)) + ')', params
+
+    
+    #generate aggregate sql query function
+    ##turns the user's aggregation (time step plus an aggregation style per data type) into a single GROUP BY query, so only aggregated rows leave the database
+    ##ex. {'time' : 'monthly', 'PRCP' : 'sum'} --> GROUP BY station, datatype, month with CASE datatype WHEN 'PRCP' THEN SUM(value) ELSE AVG(value) END
+    ##output columns and date labels match aggregate_data (station, datatype, date, value, latitude, longitude, elevation, name), periods with no observations are left out
+    ##input: sql_dict -- the sql query dictionary from generate_sql
+    ##input: translation -- the translation dictionary from translate_endpoint function
+    ##input: additional_arguments -- extra arguments specific to our custom NOAA API (see aggregate_data)
+    ##output: a sql query dictionary with 'SELECT', 'FROM', 'WHERE', 'GROUP', and 'PARAMS' keys, or None if an aggregation style can't be written in SQL
+    def generate_aggregate_sql(self, sql_dict, translation, additional_arguments):
+        aggregation = {}
+        if additional_arguments is not None and additional_arguments.get('aggregation') is not None:
+            aggregation = additional_arguments['aggregation']
+        #time bucket, defaults to daily like aggregate_data
+        period = translation['sql_aggregation'].get(aggregation.get('time'), translation['sql_aggregation']['daily'])
+
+        #aggregation style for each data type, anything pandas can do but SQL can't falls back to aggregate_data
+        cases = []
+        params = []
+        for datatype, method in aggregation.items():
+            if datatype == 'time':
+                continue
+            function = translation['sql_functions'].get(str(method).lower())
+            if function is None:
+                self.response_codes['SQL_Aggregation'] = f"'{method}' is not available in the database, aggregating with pandas."
+                return None
+            cases.append('WHEN %s THEN ' + function)
+            params.append(datatype)
+        #data types that were not named are averaged (same default as aggregate_data)
+        value = 'CASE datatype ' + ' '.join(cases) + ' ELSE AVG(value) END' if cases else 'AVG(value)'
+
+        select_clause = ("SELECT station, datatype, to_char(" + period + ", 'YYYY-MM-DD') AS date, "
+                         "(" + value + ")::double precision AS value, "
+                         "MIN(latitude) AS latitude, MIN(longitude) AS longitude, MIN(elevation) AS elevation, MIN(name) AS name")
+        group_clause = "GROUP BY station, datatype, 3 ORDER BY station, datatype, 3"
+
+        agg_statement = {
+            "SELECT": select_clause,
+            "FROM": sql_dict['FROM'],
+            "WHERE": sql_dict['WHERE'],
+            "GROUP": group_clause,
+            #the CASE parameters come before the WHERE parameters in the query text
+            "PARAMS": params + sql_dict['PARAMS']
+        }
+        self.response_codes['SQL_Aggregation'] = agg_statement
+        return agg_statement
+
+
+    #generate rollup sql query function
+    ##serves weekly, monthly, and yearly aggregations from the rollup table instead of aggregating the raw daily rows
+    ##the rollup table holds one row per station, datatype, and period (sum, count, min, and max of the values), labelled with the last day of the period
+    ##only used when the request covers whole periods (startdate is the first day of a period and enddate is the last day) and every aggregation style can be read from the rollup
+    ##input: sql_dict -- the sql query dictionary from generate_sql
+    ##input: translation -- the translation dictionary from translate_endpoint function
+    ##input: additional_arguments -- extra arguments specific to our custom NOAA API (see aggregate_data)
+    ##input: api_arguments -- the user-inputted api arguments, used to check the dates cover whole periods
+    ##input: connection -- psycopg2 database connection, used to check the rollup table exists
+    ##output: a sql query dictionary with 'SELECT', 'FROM', 'WHERE', 'GROUP', and 'PARAMS' keys, or None if the rollup can't answer the request
+    def generate_rollup_sql(self, sql_dict, translation, additional_arguments, api_arguments, connection):
+        if connection is None or additional_arguments is None or additional_arguments.get('aggregation') is None:
+            return None
+        aggregation = additional_arguments['aggregation']
+        period_type = aggregation.get('time')
+        if period_type not in ('weekly', 'monthly', 'yearly'):
+            return None
+
+        #the requested dates have to line up with the start and end of the periods
+        ##dates Python can't read (ex. 2020-1-1) are still valid for the database, they are just not served from the rollup
+        try:
+            if api_arguments.get('startdate'):
+                start = datetime.fromisoformat(api_arguments['startdate']).date()
+                if self.period_bounds(period_type, start)[0] != start:
+                    return None
+            if api_arguments.get('enddate'):
+                end = datetime.fromisoformat(api_arguments['enddate']).date()
+                if self.period_bounds(period_type, end)[1] - timedelta(days=1) != end:
+                    return None
+        except ValueError:
+            return None
+
+        #aggregation style for each data type
+        cases = []
+        params = []
+        for datatype, method in aggregation.items():
+            if datatype == 'time':
+                continue
+            function = translation['rollup']['functions'].get(str(method).lower())
+            if function is None:
+                return None
+            cases.append('WHEN %s THEN ' + function)
+            params.append(datatype)
+        #data types that were not named are averaged (same default as aggregate_data)
+        mean = translation['rollup']['functions']['mean']
+        value = 'CASE datatype ' + ' '.join(cases) + ' ELSE ' + mean + ' END' if cases else mean
+
+        #check the rollup table exists (SETUP_DB/noaa_api_rollup.sql has been run)
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (translation['rollup']['table'],))
+        exists = cursor.fetchone()[0]
+        cursor.close()
+        if not exists:
+            return None
+
+        rollup_statement = {
+            "SELECT": ("SELECT station, datatype, to_char(date, 'YYYY-MM-DD') AS date, "
+                       "(" + value + ")::double precision AS value, latitude, longitude, elevation, name"),
+            "FROM": 'FROM "' + translation['rollup']['table'] + '"',
+            #the rollup's date column holds the period label, so the same WHERE clause selects the same periods
+            "WHERE": sql_dict['WHERE'] + " AND period_type = %s",
+            "GROUP": "ORDER BY station, datatype, date",
+            "PARAMS": params + sql_dict['PARAMS'] + [period_type]
+        }
+        self.response_codes['SQL_Aggregation'] = rollup_statement
+        return rollup_statement
+
+
+    #period bounds function
+    ##finds the weekly (Monday to Sunday), monthly, or yearly period a day falls in
+    ##input: period_type -- 'weekly', 'monthly', or 'yearly'
+    ##input: day -- date object
+    ##output: (first day of the period, first day of the next period) tuple
+    def period_bounds(self, period_type, day):
+        if period_type == 'weekly':
+            start = day - timedelta(days=day.weekday())
+            return start, start + timedelta(days=7)
+        if period_type == 'monthly':
+            start = day.replace(day=1)
+            return start, (start + timedelta(days=32)).replace(day=1)
+        start = day.replace(month=1, day=1)
+        return start, start.replace(year=start.year + 1)
+
+
+    #refresh rollups function
+    ##rebuilds the rollup table rows for the station-months that fill_incomplete changed, runs inside fill_incomplete's transaction
+    ##weeks that overlap a changed month and the year it belongs to are rebuilt as well
+    ##input: cur -- database cursor
+    ##input: translation -- the translation dictionary from translate_endpoint function
+    ##input: station_months -- list of (station, first day of the month) tuples
+    ##output: nothing, it updates the rollup table inside function
+    def refresh_rollups(self, cur, translation, station_months):
+        if len(station_months) == 0:
+            return
+        #skip if the rollup table was never created
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (translation['rollup']['table'],))
+        if not cur.fetchone()[0]:
+            return
+
+        #every period touched by the changed months
+        periods = set()
+        for station, month in station_months:
+            month_start, month_end = self.period_bounds('monthly', month)
+            periods.add(('monthly', station, month_start, month_end))
+            periods.add(('yearly', station) + self.period_bounds('yearly', month))
+            week = self.period_bounds('weekly', month_start)[0]
+            while week < month_end:
+                periods.add(('weekly', station, week, week + timedelta(days=7)))
+                week += timedelta(days=7)
+
+        #rebuild each period from the raw rows
+        period_list = list(periods)
+        params = ([p[0] for p in period_list], [p[1] for p in period_list], [p[2] for p in period_list], [p[3] for p in period_list])
+        cur.execute("""
+            DELETE FROM """ + translation['rollup']['table'] + """ r
+            USING unnest(%s::text[], %s::text[], %s::date[], %s::date[]) AS p(period_type, station, period_start, period_end)
+            WHERE r.period_type = p.period_type AND r.station = p.station AND r.date = p.period_end - 1;
+        """, params)
+        cur.execute("""
+            INSERT INTO """ + translation['rollup']['table'] + """ (period_type, date, station, datatype, value_sum, value_count, value_min, value_max, latitude, longitude, elevation, name)
+            SELECT p.period_type, p.period_end - 1, n.station, n.datatype, SUM(n.value), COUNT(n.value), MIN(n.value), MAX(n.value),
+                   MIN(n.latitude), MIN(n.longitude), MIN(n.elevation), MIN(n.name)
+            FROM unnest(%s::text[], %s::text[], %s::date[], %s::date[]) AS p(period_type, station, period_start, period_end)
+            JOIN noaa_api n ON n.station = p.station AND n.date >= p.period_start AND n.date < p.period_end
+            GROUP BY p.period_type, p.period_end, n.station, n.datatype;
+        """, params)
+        print('Rollup rows refreshed: ' + str(cur.rowcount))
+
+
+    #join sql function
+    ##puts a sql query dictionary together into one query string
+    ##input: sql_dict -- dictionary containing sql query with keys 'SELECT', 'FROM', 'WHERE' (and optionally 'GROUP')
+    ##output: query string
+    def join_sql(self, sql_dict):
+        clauses = [sql_dict['SELECT'], sql_dict['FROM'], sql_dict['WHERE']]
+        if sql_dict.get('GROUP'):
+            clauses.append(sql_dict['GROUP'])
+        return ' '.join(clauses)
+
     
     #execute a given SQL statement
     ##This function has dual purpose: count rows of the given query (download = False) OR return all data as pandas dataframe (download = True)
-    ##input: sql_dict -- dictionary containing sql query with keys 'SELECT', 'FROM', and 'WHERE'
+    ##input: sql_dict -- dictionary containing sql query with keys 'SELECT', 'FROM', 'WHERE', and 'PARAMS' (and optionally 'GROUP')
     ##input: connection -- psycopg2 database connection
     ##input: download -- indicator to count rows or download data (defaults to false)
     ##output: all the data in pandas dataframe (if download = True), count of rows in query (if download = False), OR None (if an error occurs)
@@ -289,10 +618,11 @@ class NOAAETLManager:
         #if download is True, we want to download all the data to a pandas dataframe
         if download:
             #put query together into one string
-            sql_query = sql_dict['SELECT'] + sql_dict['FROM'] + sql_dict['WHERE']
+            sql_query = self.join_sql(sql_dict)
             #execute sql query and save it to pandas dataframe
             try:
-                data = pd.read_sql_query(sql_query, con=connection)
+                sql_query, params = self.prepare_query(connection, sql_query, sql_dict['PARAMS'])
+                data = pd.read_sql_query(sql_query, con=connection, params=params)
                 #if it worked, report that to user in response_codes
                 self.response_codes['Execute_SQL'] = f'Successfully executed.'
                 #return pandas dataframe
@@ -311,7 +641,8 @@ class NOAAETLManager:
                 #create connection cursor
                 cursor = connection.cursor()
                 #execute query
-                cursor.execute(sql_query)
+                sql_query, params = self.prepare_query(connection, sql_query, sql_dict['PARAMS'])
+                cursor.execute(sql_query, params)
                 #get the count of rows
                 row_count = cursor.fetchone()[0]
                 #report the row count to the user in response_codes
@@ -327,7 +658,119 @@ class NOAAETLManager:
             finally:
                 cursor.close()
 
-    
+
+    #stream a given SQL statement
+    ##Generator that pulls rows from the database in chunks using a server-side (named) cursor, so only one chunk is ever held in memory
+    ##input: sql_dict -- dictionary containing sql query with keys 'SELECT', 'FROM', and 'WHERE'
+    ##input: connection -- psycopg2 database connection, released once the generator is finished (or the user disconnects)
+    ##input: chunk_size -- number of rows pulled from the database per round trip
+    ##input: release -- function that hands the connection back (see connection_release), None closes the connection
+    ##output: yields (columns, rows) tuples, where columns is a list of column names and rows is a list of row tuples
+    def stream_sql(self, sql_dict, connection, chunk_size = 5000, release = None):
+        #put query together into one string
+        sql_query = self.join_sql(sql_dict)
+        #named cursors are declared on the server, rows are only sent when we fetch them
+        cursor = connection.cursor(name='noaa_stream')
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql_query, sql_dict['PARAMS'])
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                #the description of a named cursor is only filled after the first fetch
+                columns = [col[0] for col in cursor.description]
+                yield columns, rows
+        #errors can't change the response status once streaming started, so report them to the console
+        except psycopg2.Error as e:
+            print(f"Error streaming SQL: {e}")
+        #when the stream ends, release the cursor and connection
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                pass
+            if release is not None:
+                release()
+            else:
+                connection.close()
+
+
+    #connection release function
+    ##a streamed connection is handed back either when the stream ends, or when Flask closes the response
+    ##the second is needed when the user disconnects before the first chunk: the generator never started, so its finally never runs
+    ##input: connection -- pooled psycopg2 connection
+    ##output: function that returns the connection to the pool the first time it is called and does nothing after that, so a connection someone else borrowed in the meantime is never returned
+    def connection_release(self, connection):
+        lock = threading.Lock()
+        def release():
+            if lock.acquire(blocking=False):
+                connection.close()
+        return release
+
+
+    #stream response function
+    ##wraps stream_sql in a Flask streaming Response in CSV, JSON, PARQUET, or ARROW format, time to first byte is the time to the first chunk instead of the full query
+    ##input: sql_dict -- dictionary containing sql query with keys 'SELECT', 'FROM', and 'WHERE'
+    ##input: connection -- psycopg2 database connection, this function takes it over and returns it to the pool
+    ##input: file_format -- 'CSV', 'JSON', 'PARQUET', or 'ARROW'
+    ##output: Flask Response streaming the data, or the response codes if the database connection failed
+    def stream_response(self, sql_dict, connection, file_format):
+        #immediate error if database connection doesn't exist
+        if connection is None:
+            self.response_codes['Execute_SQL'] = 'Failed to execute SQL due to DB connection error.'
+            return json.dumps(self.response_codes, indent = 4)
+        release = self.connection_release(connection)
+
+        #PARQUET and ARROW: each chunk of rows is written as its own row group or record batch
+        if file_format in output_formats.OUTPUT_FORMATS:
+            frames = (pd.DataFrame(rows, columns=columns) for columns, rows in self.stream_sql(sql_dict, connection, release=release))
+            try:
+                response = output_formats.frames_response(frames, file_format, self.args['Additional_Arguments'])
+            except ValueError as e:
+                release()
+                self.response_codes['output_format'] = str(e)
+                return json.dumps(self.response_codes, indent = 4)
+            response.call_on_close(release)
+            return response
+
+        #CSV: header line from the first chunk, then rows written chunk by chunk
+        def generate_csv():
+            header = False
+            for columns, rows in self.stream_sql(sql_dict, connection, release=release):
+                buffer = io.StringIO()
+                writer = csv.writer(buffer, lineterminator='\n')
+                if not header:
+                    writer.writerow(columns)
+                    header = True
+                writer.writerows(rows)
+                yield buffer.getvalue()
+
+        #JSON: one array of records, written as fragments so the full array is never held in memory
+        ##each chunk is made into a table the same way pd.read_sql_query does (NUMERIC values as floats), and written with the same to_json as the non-streamed JSON, so values and dates come out the same
+        def generate_json():
+            yield '['
+            first = True
+            for columns, rows in self.stream_sql(sql_dict, connection, release=release):
+                frame = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+                records = frame.to_json(orient="records", lines = True).strip().replace('\n', ',\n')
+                yield ('\n' if first else ',\n') + records
+                first = False
+            yield '\n]'
+
+        if file_format == 'JSON':
+            response = Response(generate_json(), mimetype='application/json')
+        else:
+            response = Response(
+                generate_csv(),
+                mimetype='text/csv',
+                headers={'Content-Disposition': 'attachment; filename="dataframe.csv"'}
+            )
+        #returns the connection if the response is closed before the stream finished (or started)
+        response.call_on_close(release)
+        return response
+
+
     #aggregate data funciton
     ##This function aggregates data based on date and performs small data cleaning for the user
     ##input: df -- dataframe with data returned from database
@@ -338,43 +781,64 @@ class NOAAETLManager:
     def aggregate_data(self, df, translation, additional_arguments):
         #ensure 'date' column is datetime type for proper resampling
         df['date'] = pd.to_datetime(df['date'])
+        #database NUMERIC values arrive as Python Decimals, convert them to floats so pandas can aggregate them quickly
+        df['value'] = pd.to_numeric(df['value'], errors='coerce')
+        #categorical station and datatype columns, grouping by small integer codes is much cheaper than hashing strings
+        df['station'] = df['station'].astype('category')
+        df['datatype'] = df['datatype'].astype('category')
         #determine the aggregation time step. Look at user additional_arguments, and translate that to single character. (ex above)
         if additional_arguments is not None:
             freq = translation['aggregation'].get(additional_arguments['aggregation']['time'], 'D')    
         else:
             freq = 'D'
-        
-        #initialize an empty list to store the aggregated DataFrames
-        aggregated_dfs = []
-        #iterate over each unique datatype so we can aggregate them individually by MEAN or SUM or other method
-        for datatype in df['datatype'].unique():
-            #filter the DataFrame for the current datatype
-            df_subset = df[df['datatype'] == datatype]
-            #determine the aggregation method for the current datatype, default is 'mean' (ex2 above)
+
+        #determine the aggregation method for every datatype, default is 'mean' (ex2 above)
+        methods = {}
+        for datatype in df['datatype'].cat.categories:
             if additional_arguments is not None:
-                agg_method = additional_arguments['aggregation'].get(datatype, 'mean')
+                methods[datatype] = str(additional_arguments['aggregation'].get(datatype, 'mean')).lower()
             else:
-                agg_method = 'mean'
-            #group by station, datatype, and aggregate by time
-            grouped = df_subset.set_index('date').groupby(['station', 'datatype']).resample(freq)
-            #place the aggregated (averaged/summed/etc) data in the 'value' column
-            agg_dict = {'value': agg_method,
-                        'latitude' : 'first',
-                        'longitude' : 'first',
-                        'elevation' : 'first',
-                        'name' : 'first'}
-            aggregated = grouped.agg(agg_dict)
-            #reset index after aggregation
-            aggregated = aggregated.reset_index()
-            #append the aggregated DataFrame to the Alist
-            aggregated_dfs.append(aggregated)
-
-        #once we look at all the data types, combine the lists into one big dataframe
-        result_df = pd.concat(aggregated_dfs, ignore_index=True)
+                methods[datatype] = 'mean'
+
+        #group by station, datatype, and aggregation time in a single pass over the data
+        grouped = df.groupby(['station', 'datatype', pd.Grouper(key='date', freq=freq)], observed=True, sort=True)
+        #metadata columns take the first value of each group
+        aggregated = grouped[['latitude', 'longitude', 'elevation', 'name']].first()
+        #each aggregation method runs once over every group, then each row keeps the result of its datatype's method
+        ##ex. PRCP : 'sum' and TAVG, TMIN, TMAX : 'mean' --> two vectorized passes, no matter how many datatypes there are
+        row_methods = aggregated.index.get_level_values('datatype').map(methods)
+        values = pd.Series(float('nan'), index=aggregated.index)
+        for method in set(methods.values()):
+            mask = (row_methods == method)
+            values[mask] = grouped['value'].agg(method)[mask]
+
+        #wide format: unstack the datatypes into columns directly (one column per datatype)
+        if additional_arguments is not None and additional_arguments.get('format') == 'wide':
+            #metadata for each station and date
+            metadata = aggregated.groupby(level=['station', 'date'], observed=True).first()
+            wide = values.unstack('datatype')
+            wide.columns = [str(col) for col in wide.columns]
+            result_df = metadata.join(wide).reset_index()
+            #same column order as the long format pivot: date, station, metadata, then one column per datatype
+            result_df = result_df[['date', 'station', 'latitude', 'longitude', 'elevation', 'name'] + list(wide.columns)]
+        else:
+            aggregated['value'] = values
+            result_df = aggregated.reset_index()[['station', 'datatype', 'date', 'value', 'latitude', 'longitude', 'elevation', 'name']]
+
         #convert date back to a readable text for the user
         result_df['date'] = result_df['date'].dt.strftime('%Y-%m-%d')
         #return only the columns that the user cares about, defaults to return everything. (ex. 'return_columns' : ['date', 'datatype', 'value'] (removes 'station' and 'attributes' from the dataframe))
 
+        # Return the data
+        return result_df
+
+
+    #format data function
+    ##applies the requested format to aggregated long format data (one row per station, datatype, and date)
+    ##input: result_df -- aggregated dataframe from the database (generate_aggregate_sql)
+    ##input: additional_arguments -- extra arguments specific to our custom NOAA API, 'format' : 'wide' makes each datatype a column
+    ##output: dataframe in the requested format
+    def format_data(self, result_df, additional_arguments):
         # Check for requested format of the result
         if additional_arguments is not None:
             if additional_arguments.get('format') == 'wide':
@@ -404,7 +868,7 @@ class NOAAETLManager:
         headers = {'token': noaa_api_key}
         #initialize parameters with defaults for dataset, limit, offset, and locaiton (FIPS:27 is state of Minnesota)
         parameters = {'datasetid' : translation['api']['datasetid'],
-                      'limit': 500,
+                      'limit': API_PAGE_LIMIT,
                       'offset': 0,
                       'locationid' : 'FIPS:27',
                      'units' : 'metric'}
@@ -426,96 +890,200 @@ class NOAAETLManager:
         return full_call
 
     
+    #plan api windows function
+    ##splits a request into windows that NOAA will accept: at most one year of dates, and at most API_STATIONS_PER_WINDOW stations
+    ##ex. startdate 2020-03-01, enddate 2022-06-30 with 30 stations --> 3 date windows x 2 station groups = 6 windows
+    ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
+    ##output: list of parameter dictionaries, one per window, in date order
+    def plan_api_windows(self, parameters):
+        #split the dates into windows of at most one year
+        ##dates Python can't read (ex. 2020-1-1, or a typo) are sent to NOAA unchanged in a single window, so NOAA accepts or reports them as it did before windows were used
+        date_windows = []
+        start = end = None
+        if parameters.get('startdate') and parameters.get('enddate'):
+            try:
+                start = datetime.fromisoformat(parameters['startdate']).date()
+                end = datetime.fromisoformat(parameters['enddate']).date()
+            except ValueError:
+                print(f"Dates not split into windows: {parameters['startdate']} to {parameters['enddate']}")
+                start = end = None
+        if start is not None:
+            while start <= end:
+                #the next window starts on the same day next year (Feb 29 moves to Mar 1)
+                try:
+                    next_start = start.replace(year=start.year + 1)
+                except ValueError:
+                    next_start = start.replace(year=start.year + 1, month=3, day=1)
+                window_end = min(next_start - timedelta(days=1), end)
+                date_windows.append((start.isoformat(), window_end.isoformat()))
+                start = next_start
+        else:
+            date_windows.append((parameters.get('startdate'), parameters.get('enddate')))
+
+        #split the stations into groups
+        station_groups = [parameters.get('stationid')]
+        if parameters.get('stationid'):
+            stations = parameters['stationid'].split(',')
+            station_groups = [','.join(stations[i:i + API_STATIONS_PER_WINDOW]) for i in range(0, len(stations), API_STATIONS_PER_WINDOW)]
+
+        #one set of parameters per date window and station group
+        windows = []
+        for window_start, window_end in date_windows:
+            for station_group in station_groups:
+                window = dict(parameters)
+                window['startdate'] = window_start
+                window['enddate'] = window_end
+                if station_group is not None:
+                    window['stationid'] = station_group
+                windows.append(window)
+        return windows
+
+
     #api call function
     ##this is designed to count the amount of rows the NOAA API has in its data
+    ##the request is split into windows NOAA will accept (see plan_api_windows), the windows are counted in parallel and added together
     ##input: url -- base url for the API
     ##input: enpoint -- the data endpoint for the API
     ##input: headers -- leading data for the API call (usually api key)
     ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
     ##output: rows -- the count of rows (amount of data) that the given API call has
     def api_call(self, url, endpoint, headers, parameters):
-        #try to call the API and return the count of rows    
-        try:
+        #count the rows of a single window
+        def count_window(window):
             #since we only care about the number of rows, we only ask for one row to be returned so we can look at metadata
-            parameters['limit'] = 1
-            #make API call with requests
-            response = requests.get(url + endpoint, headers=headers, params=parameters)
-            #check for error in API call
-            response.raise_for_status()
-            print("API Called")
-            #looking at data as json dictionary
-            data = response.json()
+            window['limit'] = 1
+            #make API call with requests, looking at data as json dictionary
+            data = self.api_get(url + endpoint, headers, window)
             #the count of rows for the NOAA API is in 'metadata', 'resultset' (the metadata of ALL results), and 'count'
             if bool(data):
-                rows = data['metadata']['resultset']['count']
-            else:
-                rows = 0
+                return data['metadata']['resultset']['count']
+            return 0
+
+        #try to call the API and return the count of rows
+        try:
+            windows = self.plan_api_windows(parameters)
+            with ThreadPoolExecutor(max_workers=API_WINDOW_WORKERS) as executor:
+                rows = sum(executor.map(count_window, windows))
+            print("API Called")
             print('API returned ' + str(rows))
             #save the number of rows to response_codes so the user can look at it
-            self.response_codes['api_call'] = 'API returned ' + str(rows)
+            self.response_codes['api_call'] = 'API returned ' + str(rows) + ' (' + str(len(windows)) + ' request windows)'
             #return count of rows
             return rows
         #if an error occurs, report it and return None
-        except requests.exceptions.RequestException as e:
-            print(f"API call failed: {e}")  # Handle exceptions (e.g., network issues, 4xx and 5xx errors).
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"API call failed: {e}")  # Handle exceptions (e.g., network issues, 4xx and 5xx errors, a response that isn't JSON).
             self.response_codes['api_call'] = f"API call failed: {e}"
             return None
 
     
+    #api get function
+    ##makes a single rate limited API call, shared by api_call and api_download
+    ##every call takes a slot from the rate limiter of the API key, so parallel calls stay under NOAA's per second and per day limits
+    ##rate limit (429) and server (5xx) errors are retried with exponential backoff, other errors are raised right away
+    ##input: full_url -- url and endpoint of the API
+    ##input: headers -- leading data for the API call (usually api key)
+    ##input: parameters -- the parameters for the API call (settings, start date, end date, offset, etc.)
+    ##output: the API response as a json dictionary, raises requests.exceptions.RequestException if the call fails
+    def api_get(self, full_url, headers, parameters):
+        limiter = rate_limiter.get_limiter(headers.get('token'), NOAA_RATE_LIMITS)
+        error = None
+        for attempt in range(API_MAX_RETRIES):
+            #wait for our turn under the rate limit
+            if not limiter.acquire():
+                raise requests.exceptions.RequestException('NOAA API rate limit reached, try again later')
+            #default wait before retrying, doubles with every attempt (plus some randomness so parallel calls don't retry together)
+            wait = (2 ** attempt) + random.random()
+            try:
+                response = SESSION.get(full_url, headers=headers, params=parameters)
+                #retry rate limit and server errors (use the server's Retry-After time if it gives one)
+                if response.status_code == 429 or response.status_code >= 500:
+                    retry_after = response.headers.get('Retry-After')
+                    if retry_after is not None and retry_after.isdigit():
+                        wait = int(retry_after)
+                    error = requests.exceptions.HTTPError(f"{response.status_code} error from API", response=response)
+                else:
+                    #check for any other error in API call, these are not retried
+                    response.raise_for_status()
+                    return response.json()
+            #retry network errors
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+            print(f"API call failed ({error}), retrying in {wait:.1f} seconds")
+            time.sleep(wait)
+        #raise the last error after all retries are used
+        raise error
+
+
     #api download data function
     ##this function downloads all the data instead of just counting rows. Separated into it's own unique function due to length.
-    ##it repeats API calls, downloading data 'limit' number of rows at a time until it downloads all available data (or function errors 5 times in a row)
-    ##ex. 'limit' = 500, metadata rows = 1200.. the function will make 3 API calls
+    ##the request is split into windows NOAA will accept (see plan_api_windows), the windows are downloaded in parallel and merged in date order
     ##input: url -- base url for the API
     ##input: enpoint -- the data endpoint for the API
     ##input: headers -- leading data for the API call (usually api key)
     ##input: parameters -- the parameters for the API call (settings, start date, end date, etc.)
-    ##output: all_data -- all of the data for the given API call
+    ##output: all_data -- all of the data for the given API call, or None if a window could not be downloaded
     def api_download(self, url, endpoint, headers, parameters):
-        #store all data in a list
+        windows = self.plan_api_windows(parameters)
+        #download every window, API_WINDOW_WORKERS at a time
+        with ThreadPoolExecutor(max_workers=API_WINDOW_WORKERS) as executor:
+            results = list(executor.map(lambda window: self.api_download_window(url, endpoint, headers, window), windows))
+        #if any window failed, the download is incomplete
+        if any(result is None for result in results):
+            return None
+        #merge the windows in order
         all_data = []
+        for result in results:
+            all_data.extend(result)
+        return all_data
+
+
+    #api download window function
+    ##downloads all the data of a single request window
+    ##the first page tells us how many rows exist, so the offsets of every other page are known and they are downloaded in parallel (API_WORKERS at a time)
+    ##ex. 'limit' = 500, metadata rows = 1200.. the function will make 1 API call, then 2 more at the same time
+    ##input: url -- base url for the API
+    ##input: enpoint -- the data endpoint for the API
+    ##input: headers -- leading data for the API call (usually api key)
+    ##input: parameters -- the parameters for a single window of the API call (see plan_api_windows)
+    ##output: all_data -- all of the data for the window in offset order, or None if a page could not be downloaded
+    def api_download_window(self, url, endpoint, headers, parameters):
         #start with an 'offset' of 0 to start at begining of data
         parameters['offset'] = 0
-        #track how many rows we have downloaded
-        downloaded_rows = 0
-        #track how many times we rety a given call
-        retries = 0
-
-        #loop infinitely until all our data is downloaded
-        while True:
-            #try to make API call and download data
-            try:
-                #use requests to make API call
-                response = requests.get(url + endpoint, headers=headers, params=parameters)
-                #check if an error occured
-                response.raise_for_status()
-                #look at data as json
-                data = response.json()
-                #look at how many rows of data we downloaded. 'results' key has all the data rows
-                rows = len(data['results'])
-                #store how many rows we downloaded
-                downloaded_rows += rows
-                #add new data to results list
-                all_data.extend(data['results'])
-                #check how much total data exists
-                total_rows = data['metadata']['resultset']['count']
-                #check if we downloaded all our data
-                if downloaded_rows >= total_rows:
-                    #exit loop
-                    break
-                #if we did not finish downloading data, change offset and repeat API call
-                parameters['offset'] += rows
-                #reset retries after a successful attempt
-                retries = 0
-            #if there is an error, report the error and retry
-            except requests.exceptions.RequestException as e:
-                print(f"Error: {e}")
-                retries += 1
-                #break after 5 consecutive errors and return None
-                if retries >= 5:
-                    print("Max retries reached. Exiting.")
-                    return None
-        #return all the data after the while loop breaks
+        #download the first page, which also tells us how much total data exists
+        try:
+            data = self.api_get(url + endpoint, headers, parameters)
+        except requests.exceptions.RequestException as e:
+            print(f"Error: {e}")
+            return None
+        #NOAA returns an empty response when there is no data
+        if not data:
+            return []
+        first_page = data['results']
+        total_rows = data['metadata']['resultset']['count']
+        #the offsets of the remaining pages
+        offsets = list(range(len(first_page), total_rows, int(parameters['limit'])))
+
+        #download a single page at a given offset
+        def download_page(offset):
+            page_parameters = dict(parameters)
+            page_parameters['offset'] = offset
+            return self.api_get(url + endpoint, headers, page_parameters).get('results', [])
+
+        #download the remaining pages in parallel, map keeps the pages in offset order
+        try:
+            with ThreadPoolExecutor(max_workers=API_WORKERS) as executor:
+                pages = list(executor.map(download_page, offsets))
+        except requests.exceptions.RequestException as e:
+            print(f"Error: {e}")
+            print("Max retries reached. Exiting.")
+            return None
+
+        #store all data in a list, in offset order
+        all_data = list(first_page)
+        for page in pages:
+            all_data.extend(page)
+        #return all the data
         return all_data
 
     #check completeness function
@@ -559,41 +1127,81 @@ class NOAAETLManager:
     ##input: conn -- database connection
     ##output: nothing, it updates database inside function           
     def fill_incomplete(self, translation, api_parameters, noaa_api_key, conn, diff):
-        # Generate an API call for our given parameters
-        full_call = self.generate_api_call(translation, api_parameters, noaa_api_key)
-        # Download all the data using api_download function, inputting the generated API call
-        api_vals = self.api_download(full_call['url'], full_call['endpoint'], full_call['headers'], full_call['parameters'])
-        # Generate UIDs for API data for easy comparison
-        api_uids = {str(row['date']) + '_' + str(row['station']) + '_' + str(row['datatype']) for row in api_vals}
+        cur = None
         try:
+            # Generate an API call for our given parameters
+            full_call = self.generate_api_call(translation, api_parameters, noaa_api_key)
+            # Download all the data using api_download function, inputting the generated API call
+            api_vals = self.api_download(full_call['url'], full_call['endpoint'], full_call['headers'], full_call['parameters'])
+            # api_download returns None when a window failed or the rate limiter gave up, the database is left as it is
+            if api_vals is None:
+                print('API download failed, database not updated')
+                return
+            # Generate UIDs for API data for easy comparison
+            api_uids = {str(row['date']) + '_' + str(row['station']) + '_' + str(row['datatype']) for row in api_vals}
             # Start cursor with database connection
             cur = conn.cursor()
             if diff < 0:
-                # Add data to database row by row
+                # Fetch additional details from noaa_station_list table once for every station in the download
+                stations = list({row['station'] for row in api_vals})
+                cur.execute("""
+                    SELECT id, latitude, longitude, name, elevation FROM noaa_station_list WHERE id = ANY(%s);
+                """, (stations,))
+                station_details = {record[0]: record[1:] for record in cur.fetchall()}
+
+                # Write the rows as CSV in memory, skipping rows for stations we don't know about
+                columns = ['date', 'datatype', 'station', 'attributes', 'value', 'uid', 'latitude', 'longitude', 'name', 'elevation']
+                buffer = io.StringIO()
+                writer = csv.writer(buffer, lineterminator='\n')
                 for row in api_vals:
-                    uid = str(row['date']) + '_' + str(row['station']) + '_' + str(row['datatype'])
-                    # Fetch additional details from noaa_station_list table
-                    cur.execute("""
-                        SELECT latitude, longitude, name, elevation FROM noaa_station_list WHERE id = %s;
-                    """, (row['station'],))
-                    station_details = cur.fetchone()
-                    
-                    if station_details:
-                        latitude, longitude, name, elevation = station_details
-                        # Add the row into the database using the below SQL query.
-                        cur.execute("""
-                            INSERT INTO noaa_api(date, datatype, station, attributes, value, uid, latitude, longitude, name, elevation)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (uid) DO NOTHING;
-                        """, (row['date'], row['datatype'], row['station'], row['attributes'], row['value'], uid, latitude, longitude, name, elevation))
-            
+                    details = station_details.get(row['station'])
+                    if details:
+                        uid = str(row['date']) + '_' + str(row['station']) + '_' + str(row['datatype'])
+                        writer.writerow([row['date'], row['datatype'], row['station'], row['attributes'], row['value'], uid] + list(details))
+                buffer.seek(0)
+
+                # Stage the rows in a temporary table with COPY (one round trip instead of one per row)
+                cur.execute("""
+                    CREATE TEMP TABLE noaa_api_stage ON COMMIT DROP AS
+                    SELECT """ + ', '.join(columns) + """ FROM noaa_api WITH NO DATA;
+                """)
+                cur.copy_expert("COPY noaa_api_stage (" + ', '.join(columns) + ") FROM STDIN WITH (FORMAT csv)", buffer)
+                # Merge the staged rows into the database in one statement, returning the station-months that got new rows
+                cur.execute("""
+                    WITH inserted AS (
+                        INSERT INTO noaa_api(""" + ', '.join(columns) + """)
+                        SELECT """ + ', '.join(columns) + """ FROM noaa_api_stage
+                        ON CONFLICT (uid) DO NOTHING
+                        RETURNING station, date
+                    )
+                    SELECT station, date_trunc('month', date)::date, COUNT(*) FROM inserted GROUP BY 1, 2;
+                """)
+                station_months = cur.fetchall()
+                print('Rows added to database: ' + str(sum(record[2] for record in station_months)))
+                # Update the rollup tables for the station-months that changed
+                self.refresh_rollups(cur, translation, [record[:2] for record in station_months])
+
             elif diff > 0:
                 # Remove extra rows from the database that are not in the API data
-                cur.execute("SELECT uid FROM noaa_api;")
-                db_uids = {record[0] for record in cur.fetchall()}
-                extra_uids = db_uids - api_uids
-                for uid in extra_uids:
-                    cur.execute("DELETE FROM noaa_api WHERE uid = %s;", (uid,))
+                ## only the rows inside this request's station/date/datatype window are compared, using the same WHERE clause as generate_sql
+                sql = self.generate_sql(translation, api_parameters)
+                # Stream the uids through a server-side cursor so only the extra uids are held in memory
+                uid_cur = conn.cursor(name='noaa_uid_scan')
+                uid_cur.itersize = 10000
+                uid_cur.execute("SELECT uid " + sql['FROM'] + " " + sql['WHERE'], sql['PARAMS'])
+                extra_uids = [record[0] for record in uid_cur if record[0] not in api_uids]
+                uid_cur.close()
+                # Delete all the extra rows in one statement, returning the station-months that lost rows
+                cur.execute("""
+                    WITH deleted AS (
+                        DELETE FROM noaa_api WHERE uid = ANY(%s) RETURNING station, date
+                    )
+                    SELECT station, date_trunc('month', date)::date, COUNT(*) FROM deleted GROUP BY 1, 2;
+                """, (extra_uids,))
+                station_months = cur.fetchall()
+                print('Rows removed from database: ' + str(sum(record[2] for record in station_months)))
+                # Update the rollup tables for the station-months that changed
+                self.refresh_rollups(cur, translation, [record[:2] for record in station_months])
             # Commit changes to the database
             conn.commit()
             print('Database update complete')
@@ -602,5 +1210,7 @@ class NOAAETLManager:
             print(f"Error executing database operations: {e}")
         finally:
             # Close cursor and connection to release resources
-            cur.close()
-            conn.close()
\ No newline at end of file
+            if cur is not None:
+                cur.close()
+            if conn is not None:
+                conn.close()
\ No newline at end of file
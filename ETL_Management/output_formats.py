@@ -0,0 +1,289 @@
+"""
+Binary Output Formats
+
+This file writes API results in binary columnar formats, as an alternative to CSV and JSON for large downloads.
+PARQUET and ARROW (Arrow IPC stream) work for every endpoint, NETCDF works for gridded data (NOAA_GRID_DATA).
+Values are written in their stored types instead of being formatted as text, and every format is compressed (Additional_Arguments 'compression' and 'compression_level').
+Data is written in row groups (PARQUET) or record batches (ARROW) as it is produced, and each piece is sent to the user as soon as it is written, so the whole file is never built in memory.
+"""
+
+#Imports
+#pyarrow for Parquet and Arrow IPC writing
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.ipc as ipc
+#pandas for DataFrame inputs
+import pandas as pd
+#tempfile and os for NetCDF files, which have to be written to disk before they are sent
+import tempfile
+import os
+#Flask for api response return
+from flask import Response
+
+#Every Call_Direct_Download format that downloads data
+DOWNLOAD_FORMATS = ('CSV', 'JSON', 'PARQUET', 'ARROW', 'NETCDF')
+
+#Binary formats written by this file
+##mimetype, extension -- used for the download response
+##codecs -- compression codecs the format supports, 'none' turns compression off
+##compression -- default codec
+##level -- default compression level, None uses the codec's own default
+OUTPUT_FORMATS = {
+    'PARQUET': {
+        'mimetype': 'application/vnd.apache.parquet',
+        'extension': 'parquet',
+        'codecs': ('none', 'snappy', 'gzip', 'brotli', 'lz4', 'zstd'),
+        'compression': 'zstd',
+        'level': None
+    },
+    'ARROW': {
+        'mimetype': 'application/vnd.apache.arrow.stream',
+        'extension': 'arrow',
+        'codecs': ('none', 'lz4', 'zstd'),
+        'compression': 'lz4',
+        'level': None
+    },
+    'NETCDF': {
+        'mimetype': 'application/x-netcdf',
+        'extension': 'nc',
+        'codecs': ('none', 'zlib'),
+        'compression': 'zlib',
+        'level': 4
+    }
+}
+
+#rows in each Parquet row group or Arrow record batch, one group is written and sent at a time
+BATCH_ROWS = 100000
+#size of each piece of a NetCDF file sent to the user
+FILE_BLOCK_BYTES = 1 << 20
+
+
+#output sink class
+##file-like object the pyarrow writers write into. Written bytes are held until they are taken and sent to the user
+class OutputSink:
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    #take function
+    ##output: every byte written since the last call
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+#compression options function
+##checks the compression a user asked for
+##input: file_format -- one of OUTPUT_FORMATS
+##input: additional_arguments -- user's Additional_Arguments, 'compression' and 'compression_level' are optional
+##output: (codec, level) tuple, codec is None when compression is turned off
+def compression_options(file_format, additional_arguments):
+    settings = OUTPUT_FORMATS[file_format]
+    additional_arguments = additional_arguments or {}
+    codec = str(additional_arguments.get('compression', settings['compression'])).lower()
+    if codec not in settings['codecs']:
+        raise ValueError(f"{file_format} compression must be one of {', '.join(settings['codecs'])}")
+    level = additional_arguments.get('compression_level', settings['level'])
+    if level is not None:
+        try:
+            level = int(level)
+        except (TypeError, ValueError):
+            raise ValueError('compression_level must be a whole number')
+    if codec == 'none':
+        return None, None
+    return codec, level
+
+
+#table schema function
+##input: frames -- list of pandas DataFrames with the same columns
+##input: empty_type -- Arrow type of columns that have no values in any of the frames, None leaves them as null
+##output: Arrow schema for the frames. Each column takes its type from the first frame that has values in it
+def table_schema(frames, empty_type = pa.float64()):
+    fields = []
+    for field in pa.Schema.from_pandas(frames[0], preserve_index=False):
+        if pa.types.is_null(field.type):
+            for frame in frames[1:]:
+                column_type = pa.Schema.from_pandas(frame[[field.name]], preserve_index=False).field(field.name).type
+                if not pa.types.is_null(column_type):
+                    field = field.with_type(column_type)
+                    break
+            else:
+                if empty_type is not None:
+                    field = field.with_type(empty_type)
+        fields.append(field)
+    return pa.schema(fields)
+
+
+#frame table function
+##input: frame -- pandas DataFrame
+##input: schema -- Arrow schema of the file
+##output: Arrow table of the frame in the file's schema. Columns whose values have a different type than the file (ex. a column that was empty when the schema was set) are cast to the file's type
+def frame_table(frame, schema):
+    try:
+        return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        columns = [pa.array(frame[field.name], from_pandas=True).cast(field.type) for field in schema]
+        return pa.Table.from_arrays(columns, schema=schema)
+
+
+#arrow writer function
+##input: sink -- OutputSink to write into
+##input: schema -- Arrow schema of the data
+##input: file_format -- 'PARQUET' or 'ARROW'
+##input: codec, level -- from compression_options
+##output: pyarrow Parquet or Arrow IPC stream writer
+def arrow_writer(sink, schema, file_format, codec, level):
+    if file_format == 'PARQUET':
+        return pq.ParquetWriter(sink, schema, compression=codec or 'none', compression_level=level)
+    options = ipc.IpcWriteOptions(compression=None if codec is None else pa.Codec(codec, compression_level=level))
+    return ipc.new_stream(sink, schema, options=options)
+
+
+#arrow stream function
+##writes DataFrames into PARQUET or ARROW, the bytes of each row group or record batch are yielded as soon as they are written
+##the first frames are held until every column has values (or BATCH_ROWS rows are waiting), so a column that starts out empty (ex. an all-NULL first chunk) gets the type of its first values
+##input: frames -- iterable of pandas DataFrames with the same columns (ex. one per streamed block)
+##input: file_format -- 'PARQUET' or 'ARROW'
+##input: codec, level -- from compression_options
+##output: generator of bytes
+def arrow_stream(frames, file_format, codec, level):
+    sink = OutputSink()
+    writer = None
+    schema = None
+    waiting = []
+    waiting_rows = 0
+
+    def write(frame):
+        if len(frame) == 0:
+            return
+        table = frame_table(frame, schema)
+        for batch in table.to_batches(max_chunksize=BATCH_ROWS):
+            if file_format == 'PARQUET':
+                writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            else:
+                writer.write_batch(batch)
+            yield sink.take()
+
+    try:
+        for frame in frames:
+            if writer is not None:
+                yield from write(frame)
+                continue
+            waiting.append(frame)
+            waiting_rows += len(frame)
+            if waiting_rows < BATCH_ROWS and any(pa.types.is_null(field.type) for field in table_schema(waiting, empty_type=None)):
+                continue
+            #the waiting frames set the schema for the whole file
+            schema = table_schema(waiting)
+            writer = arrow_writer(sink, schema, file_format, codec, level)
+            for waiting_frame in waiting:
+                yield from write(waiting_frame)
+            waiting = []
+        if writer is None:
+            #no data at all still returns a valid, empty file
+            schema = table_schema(waiting) if len(waiting) > 0 else pa.schema([])
+            writer = arrow_writer(sink, schema, file_format, codec, level)
+            for waiting_frame in waiting:
+                yield from write(waiting_frame)
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.take()
+
+
+#netcdf stream function
+##writes an xarray Dataset to a NetCDF file and yields the file in pieces. Lazy (dask) datasets are written chunk by chunk, so the result never has to fit in memory
+##this is not a stream of the data as it is produced: NetCDF (HDF5) files are written with seeks back into the file, so nothing is sent until the whole file is written
+##input: ds -- xarray Dataset
+##input: codec, level -- from compression_options
+##input: path -- temporary file to write, removed when the file has been sent (see dataset_response)
+##output: generator of bytes
+def netcdf_stream(ds, codec, level, path):
+    try:
+        encoding = {}
+        if codec is not None:
+            encoding = {var: {'zlib': True, 'complevel': level if level is not None else OUTPUT_FORMATS['NETCDF']['level']} for var in ds.data_vars}
+        ds.to_netcdf(path, encoding=encoding)
+        with open(path, 'rb') as file:
+            while True:
+                data = file.read(FILE_BLOCK_BYTES)
+                if not data:
+                    break
+                yield data
+    finally:
+        remove_temporary(path)
+
+
+#remove temporary function
+##input: path -- temporary file, nothing happens if it is already removed
+def remove_temporary(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+#download response function
+##input: data -- stream of bytes from arrow_stream or netcdf_stream
+##input: file_format -- one of OUTPUT_FORMATS
+##output: Flask Response sending the file as it is written
+def download_response(data, file_format):
+    settings = OUTPUT_FORMATS[file_format]
+    return Response(
+        data,
+        mimetype=settings['mimetype'],
+        headers={'Content-Disposition': f'attachment; filename="dataframe.{settings["extension"]}"'}
+    )
+
+
+#check table format function
+##checks a format and its compression options can be written from a table, so a bad request is rejected before any data is read
+##input: file_format -- Call_Direct_Download format
+##input: additional_arguments -- user's Additional_Arguments, for compression options
+##output: (codec, level) tuple from compression_options, (None, None) for CSV and JSON. Raises ValueError for NETCDF or bad compression options
+def check_table_format(file_format, additional_arguments):
+    if file_format in ('CSV', 'JSON'):
+        return None, None
+    if file_format not in ('PARQUET', 'ARROW'):
+        raise ValueError(f'{file_format} output is only available for gridded data')
+    return compression_options(file_format, additional_arguments)
+
+
+#frames response function
+##input: frames -- a pandas DataFrame, or an iterable of DataFrames with the same columns
+##input: file_format -- 'PARQUET' or 'ARROW'
+##input: additional_arguments -- user's Additional_Arguments, for compression options
+##output: Flask Response streaming the file
+def frames_response(frames, file_format, additional_arguments):
+    if file_format not in ('PARQUET', 'ARROW'):
+        raise ValueError(f'{file_format} output is only available for gridded data')
+    codec, level = check_table_format(file_format, additional_arguments)
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    return download_response(arrow_stream(frames, file_format, codec, level), file_format)
+
+
+#dataset response function
+##the NetCDF file is written in full before its first byte is sent (see netcdf_stream)
+##the temporary file is also removed when Flask closes the response, which covers users who disconnect before the file is sent
+##input: ds -- xarray Dataset
+##input: additional_arguments -- user's Additional_Arguments, for compression options
+##output: Flask Response sending the NetCDF file
+def dataset_response(ds, additional_arguments):
+    codec, level = compression_options('NETCDF', additional_arguments)
+    handle, path = tempfile.mkstemp(suffix='.nc')
+    os.close(handle)
+    response = download_response(netcdf_stream(ds, codec, level, path), 'NETCDF')
+    response.call_on_close(lambda: remove_temporary(path))
+    return response
@@ -0,0 +1,97 @@
+"""
+API Rate Limiter
+
+This file holds rate limiters shared by every thread in the process.
+Web APIs like NOAA's Climate Data Online limit each API key to a number of requests per second and per day.
+Downloads that run in parallel take a slot before every request, so all threads together stay under those limits.
+Each limit is a sliding window: the times of the requests sent in the last period are kept, so no period of that length (ex. any 24 hours) ever holds more requests than the limit.
+"""
+
+#Imports
+#threading to share limiters between download threads
+import threading
+#deque for the request times in each window
+from collections import deque
+#time for request times and waiting
+import time
+
+#limiters are kept per API key, since the limits apply to each key
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+"""
+Class SlidingWindow
+Global variables:
+    self.count
+        - most requests allowed in any period
+    self.period
+        - length of the period in seconds
+    self.times
+        - times of the requests sent in the last period, oldest first
+"""
+class SlidingWindow:
+    #initialization of the window, starts with no requests sent
+    def __init__(self, count, period):
+        self.count = count
+        self.period = period
+        self.times = deque()
+
+    #forget requests older than one period
+    def expire(self, now):
+        while len(self.times) > 0 and now - self.times[0] >= self.period:
+            self.times.popleft()
+
+    #seconds until one more request is allowed (0 if one is allowed now)
+    def wait_time(self):
+        now = time.monotonic()
+        self.expire(now)
+        if len(self.times) < self.count:
+            return 0
+        return self.times[0] + self.period - now
+
+    #record a request sent now
+    def take(self):
+        self.times.append(time.monotonic())
+
+
+"""
+Class RateLimiter
+Global variables:
+    self.buckets
+        - list of SlidingWindow objects, a request has to fit in every window (ex. one per-second window and one per-day window)
+"""
+class RateLimiter:
+    #initialization of the limiter
+    ##input: limits -- list of (number of requests, period in seconds) tuples. ex. [(5, 1), (10000, 86400)] is 5 per second and 10,000 per day
+    def __init__(self, limits):
+        self.buckets = [SlidingWindow(count, period) for count, period in limits]
+        self.lock = threading.Lock()
+
+    #take a slot in every window, waiting if needed
+    ##input: max_wait -- most seconds we are willing to wait for a slot (ex. don't wait hours for the daily limit to free up)
+    ##output: True if a slot was taken, False if it would take longer than max_wait
+    def acquire(self, max_wait = 60):
+        while True:
+            with self.lock:
+                wait = max(bucket.wait_time() for bucket in self.buckets)
+                if wait == 0:
+                    for bucket in self.buckets:
+                        bucket.take()
+                    return True
+            if wait > max_wait:
+                return False
+            time.sleep(wait)
+
+
+#get the process-wide limiter for an API key, creating it the first time it is asked for
+##input: key -- API key (or any name) the limits apply to
+##input: limits -- list of (number of requests, period in seconds) tuples, only used when the limiter is created
+##output: RateLimiter object
+def get_limiter(key, limits):
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(limits)
+            _limiters[key] = limiter
+    return limiter
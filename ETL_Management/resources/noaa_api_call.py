@@ -3,12 +3,12 @@ from noaa_etl_manager import NOAAETLManager
 from nclim_gridded_etl_manager import GRIDETLManager
 try:
     from ameriflux_etl_manager import AMFETLManager
-except exception as e:
-    print("ERROR: R CODE INTERFACE IS NON FUNCTIONAL, Likely R is not installed and correct path to R directory is not defined. CANNOT RUN THE AMERIFLUX ETL MANAGEMENT")
+except Exception as e:
+    print("ERROR: CANNOT RUN THE AMERIFLUX ETL MANAGEMENT: " + str(e))
 
 parser = reqparse.RequestParser()
 parser.add_argument('Endpoint', required=True, help="Endpoint cannot be blank!")
-parser.add_argument('Call_Direct_Download', required=True, choices=('FALSE', 'CSV', 'JSON'), help='Direct Download format must be either FALSE, CSV, JSON')
+parser.add_argument('Call_Direct_Download', required=True, choices=('FALSE', 'CSV', 'JSON', 'PARQUET', 'ARROW', 'NETCDF'), help='Direct Download format must be either FALSE, CSV, JSON, PARQUET, ARROW, NETCDF')
 parser.add_argument('Call_DB', type=bool, default=True)
 parser.add_argument('Call_API', type=bool, default=True)
 parser.add_argument('Call_Completeness', type=bool, default=True)
@@ -36,9 +36,10 @@ class NOAAAPICall(Resource):
         - Endpoint (required)
           -- The API endpoint that we are calling.. Only used in Translation function for now. Will be used to call different API endpoints in the future
           
-        - Call_Direct_Download (required) (FALSE, CSV, JSON)
+        - Call_Direct_Download (required) (FALSE, CSV, JSON, PARQUET, ARROW, NETCDF)
           -- Bypass of parameter checks in order to download data straight from database. This is designed so the user can download data directly from the database. 
           -- Typical use would have 2 API calls: First with Call_Direct_Download as FALSE to check if database has all user required data, and a Second to download the data itself.
+          -- PARQUET and ARROW (Arrow IPC stream) return the same table as CSV in a compressed binary file, written and sent in pieces as the data is produced. NETCDF (NOAA_GRID_DATA only) returns the aggregated grid (or polygon cells/points) as a NetCDF file instead of a table. The NetCDF file is written in full on the server before it is sent, so the download only starts once the whole request is aggregated.
           
         - API_Arguments (required) (dictionary with 'startdate' and 'enddate' at minimum)
           -- This is the API arguments that are formatted to be directly sent to the NOAA API.
@@ -48,6 +49,17 @@ class NOAAAPICall(Resource):
           -- This contains additioanl arguments specific to this API, not hosted in the NOAA API functionality.
           -- return_ columns is a list of columns a user wants returned in their final dataset. They must know what columns are available to return.
           -- aggreagation is user definitions of how they want data aggreagated together. This requires a 'time' field with 'daily', 'weekly', 'monthly', or 'yearly' aggreagations. Default aggregation style is MEAN, but user can define aggregation by data type by inputting data type as another field (ex. 'prcp' : 'SUM', 'tavg' : 'MEAN' ... this will sum the prcp field and average the tavg field across the aggregation times)
+          -- For NOAA_DATA, aggregation runs inside the database when every aggregation style is one of mean, sum, min, max, count, median, std, or var. Other pandas styles (ex. 'first') fall back to aggregating in Python.
+          -- box (NOAA_GRID_DATA only) is a dictionary with 'minlat', 'minlon', 'maxlat', and 'maxlon' to cut the grid to.
+          -- polygon (NOAA_GRID_DATA only) is a GeoJSON geometry, a list of [lon, lat] points, or a path to a shapefile on the server. Only grid cells with their center inside the polygon are returned ('all_touched' : True returns every cell the polygon touches).
+          -- points (NOAA_GRID_DATA only) is a list of points to extract time series at, instead of returning every grid cell. Points can be [lat, lon] pairs, {'id', 'lat', 'lon'} dictionaries, or GHCNd station ids / AmeriFlux site ids (looked up in noaa_station_list and amf_stations, needs DB_Credentials). 'method' : 'nearest' (default) uses the grid cell each point is in, 'bilinear' interpolates between the four surrounding cells.
+          -- compression (PARQUET, ARROW, and NETCDF only) is the compression codec of the file. PARQUET: zstd (default), snappy, gzip, brotli, lz4, or none. ARROW: lz4 (default), zstd, or none. NETCDF: zlib (default) or none. 'compression_level' sets the codec's level.
+          -- reader (AMF_DATA only) is 'python' (default) to read AmeriFlux BASE files in Python, or 'r' to read them with amerifluxr's amf_read_base (needs R).
+          -- refresh (AMF_DATA only) (True/False, default False) asks the AmeriFlux service for new file versions of every site. Otherwise sites downloaded or checked within the last hour are taken from the local archive in out_dir without asking the service (see amf_archive.py).
+          -- parallel (AMF_DATA only) (True/False, default True) reads, filters, and resamples the sites of a multi-site request on a pool of processes, one per core. False reads the sites one at a time.
+          -- stream (True/False) streams rows to the user in chunks instead of building the whole file in memory. For NOAA_DATA, rows aggregated by the database are streamed in long format. Wide format and aggregations only pandas can do are rejected, set Call_Aggregation to False to stream the raw database rows instead.
+          -- For AMF_DATA, stream sends each site as soon as it is aggregated, so only one site is held in memory.
+          -- For NOAA_GRID_DATA, stream aggregates the grid in blocks of rows (or polygon cells/points) on a pool of processes, one per core, and sends each block as soon as it is done, so memory use stays the same for any size of request. In long format each block is reshaped on its own.
           
         - Call_Parameter_Check (optional) (default = True)
           -- This functionality will be implemented in the future. Planned use will be to verify inputted parameters are valid, and also define station lists based on user added location bounding boxes.
@@ -0,0 +1,155 @@
+"""
+Test Fixtures
+
+Shared fixtures for the ETL_Management tests.
+The modules in ETL_Management import each other by name, so the folder is put on the import path here.
+The 'server' fixture is a local HTTP stand-in for the NOAA file server and the AmeriFlux download service, so downloads can be tested without a network.
+"""
+
+#Imports
+import sys
+import os
+import json
+import time
+import hashlib
+import email.utils
+import threading
+import http.server
+import socketserver
+from urllib.parse import urlparse
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+"""
+Class StandInHandler
+Serves the files in server.root with HEAD and GET (with Range and If-Range), and answers AmeriFlux data_download POSTs.
+Behaviour is set on the server object (see StandInServer).
+"""
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    #file name, bytes, ETag, and Last-Modified of the requested file, or None if it doesn't exist
+    def file_info(self):
+        name = os.path.basename(urlparse(self.path).path)
+        path = os.path.join(self.server.root, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as file:
+            data = file.read()
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        return name, data, etag, email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.log.append(('HEAD', self.path, None))
+        info = self.file_info()
+        if info is None:
+            return self.send_empty(404)
+        name, data, etag, last_modified = info
+        self.send_response(200)
+        self.send_header('Content-Length', str(self.server.head_size.get(name, len(data))))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        if self.server.after_head is not None:
+            self.server.after_head(name)
+
+    def do_GET(self):
+        self.server.log.append(('GET', self.path, self.headers.get('Range')))
+        time.sleep(self.server.delay)
+        info = self.file_info()
+        if info is None:
+            return self.send_empty(404)
+        name, data, etag, last_modified = info
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (if_range is None or if_range in (etag, last_modified)):
+            start = int(range_header.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        #drop the connection part way through the body, once
+        if name in self.server.truncate_once:
+            self.server.truncate_once.discard(name)
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+    #AmeriFlux data_download: one url per requested site that has a published version
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.log.append(('POST', self.path, body))
+        if not self.server.service_up:
+            return self.send_empty(503)
+        urls = [{'site_id': site, 'url': f'{self.server.url}/files/AMF_{site}_{body["data_product"]}_{self.server.versions[site]}.zip?=fullname'}
+                for site in body['site_ids'] if site in self.server.versions]
+        data = json.dumps({'data_urls': urls}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+"""
+Class StandInServer
+Global variables:
+    self.root -- folder of served files
+    self.log -- list of (method, path, Range header or POST body) for every request
+    self.truncate_once -- file names whose next GET is cut off part way
+    self.head_size -- file name : size reported by HEAD instead of the real size
+    self.after_head -- function called with the file name after every HEAD, None does nothing
+    self.delay -- seconds every GET waits before answering
+    self.versions -- AmeriFlux site id : published version
+    self.service_up -- False answers data_download with 503
+"""
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.root = root
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.log = []
+        self.truncate_once = set()
+        self.head_size = {}
+        self.after_head = None
+        self.delay = 0
+        self.versions = {}
+        self.service_up = True
+
+    #write a file to serve
+    def publish(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as file:
+            file.write(data)
+
+    #requests made with one method
+    def requests(self, method):
+        return [entry for entry in self.log if entry[0] == method]
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'server'
+    root.mkdir()
+    stand_in = StandInServer(str(root))
+    thread = threading.Thread(target=stand_in.serve_forever, daemon=True)
+    thread.start()
+    yield stand_in
+    stand_in.shutdown()
+    stand_in.server_close()
@@ -0,0 +1,126 @@
+"""
+Tests for amf_archive.py against the local stand-in server (see conftest.py)
+"""
+
+#Imports
+import os
+import io
+import zipfile
+import pytest
+import amf_archive
+
+
+#small zip standing in for a BASE download, so verify_file accepts it
+def base_zip(site, version):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(f'AMF_{site}_BASE_HH_{version}.csv', f'{site},{version}\n')
+    return buffer.getvalue()
+
+
+#publish a site's file and make it the version the download service hands out
+def publish(server, site, version):
+    server.publish(f'AMF_{site}_BASE-BADM_{version}.zip', base_zip(site, version))
+    server.versions[site] = version
+
+
+def parameters(sites):
+    return {'site_id': sites, 'user_id': 'user', 'user_email': 'user@example.com', 'data_policy': 'CCBY4.0',
+            'agree_policy': True, 'intended_use': 'synthesis', 'intended_use_text': 'tests'}
+
+
+def statuses(results):
+    return {result['site_id']: result['status'] for result in results}
+
+
+@pytest.fixture(autouse=True)
+def stand_in_service(server, monkeypatch):
+    monkeypatch.setitem(amf_archive.ARCHIVE_CONFIG, 'api', server.url + '/api/v1/data_download')
+
+
+def test_download_then_cache_hit(server, tmp_path):
+    publish(server, 'US-Ha1', '19-5')
+    publish(server, 'US-MMS', '20-1')
+    folder = str(tmp_path / 'amf')
+
+    first = amf_archive.fetch_archives(parameters(['US-Ha1', 'US-MMS']), folder)
+    assert statuses(first) == {'US-Ha1': 'downloaded', 'US-MMS': 'downloaded'}
+    assert first[0]['path'] == os.path.join(folder, 'AMF_US-Ha1_BASE-BADM_19-5.zip')
+    assert first[0]['version'] == '19-5'
+    assert len(server.requests('POST')) == 1
+    assert server.requests('POST')[0][2]['intended_use'] == 'Research - Multi-site synthesis'
+    assert len(server.requests('GET')) == 2
+
+    #checked within the ttl: no service call and no download
+    second = amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+    assert statuses(second) == {'US-Ha1': 'cached'}
+    assert len(server.requests('POST')) == 1
+    assert len(server.requests('GET')) == 2
+
+
+def test_refresh_same_version_downloads_nothing(server, tmp_path):
+    publish(server, 'US-Ha1', '19-5')
+    folder = str(tmp_path / 'amf')
+    amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+
+    result = amf_archive.fetch_archives(parameters('US-Ha1'), folder, refresh=True)
+    assert statuses(result) == {'US-Ha1': 'cached'}
+    assert len(server.requests('POST')) == 2
+    assert len(server.requests('GET')) == 1
+
+
+def test_expired_check_asks_the_service(server, tmp_path, monkeypatch):
+    publish(server, 'US-Ha1', '19-5')
+    folder = str(tmp_path / 'amf')
+    amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+
+    monkeypatch.setitem(amf_archive.ARCHIVE_CONFIG, 'ttl', 0)
+    assert statuses(amf_archive.fetch_archives(parameters('US-Ha1'), folder)) == {'US-Ha1': 'cached'}
+    assert len(server.requests('POST')) == 2
+
+
+def test_new_version_replaces_archived_file(server, tmp_path):
+    publish(server, 'US-MMS', '20-1')
+    folder = str(tmp_path / 'amf')
+    amf_archive.fetch_archives(parameters('US-MMS'), folder)
+
+    publish(server, 'US-MMS', '20-2')
+    result = amf_archive.fetch_archives(parameters('US-MMS'), folder, refresh=True)
+    assert statuses(result) == {'US-MMS': 'updated'}
+    assert result[0]['version'] == '20-2'
+    assert result[0]['path'] == os.path.join(folder, 'AMF_US-MMS_BASE-BADM_20-2.zip')
+    with zipfile.ZipFile(result[0]['path']) as archive:
+        assert archive.namelist() == ['AMF_US-MMS_BASE_HH_20-2.csv']
+    assert not os.path.exists(os.path.join(folder, 'AMF_US-MMS_BASE-BADM_20-1.zip'))
+    assert amf_archive.read_index(folder)['US-MMS']['BASE-BADM']['version'] == '20-2'
+
+
+def test_unknown_site_is_missing(server, tmp_path):
+    publish(server, 'US-Ha1', '19-5')
+    result = amf_archive.fetch_archives(parameters(['US-Ha1', 'US-XXX']), str(tmp_path / 'amf'))
+    assert statuses(result) == {'US-Ha1': 'downloaded', 'US-XXX': 'missing'}
+    assert result[1]['path'] is None
+
+
+def test_service_down_uses_archived_files(server, tmp_path):
+    publish(server, 'US-Ha1', '19-5')
+    folder = str(tmp_path / 'amf')
+    amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+
+    server.service_up = False
+    result = amf_archive.fetch_archives(parameters(['US-Ha1', 'US-MMS']), folder, refresh=True)
+    assert statuses(result) == {'US-Ha1': 'stale', 'US-MMS': 'failed'}
+    assert os.path.isfile(result[0]['path'])
+    assert '503' in result[1]['error']
+
+
+def test_deleted_file_is_downloaded_again(server, tmp_path):
+    publish(server, 'US-Ha1', '19-5')
+    folder = str(tmp_path / 'amf')
+    first = amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+    os.remove(first[0]['path'])
+
+    second = amf_archive.fetch_archives(parameters('US-Ha1'), folder)
+    assert statuses(second) == {'US-Ha1': 'downloaded'}
+    assert os.path.isfile(second[0]['path'])
+    assert len(server.requests('GET')) == 2
@@ -0,0 +1,164 @@
+"""
+Tests for grid_download.py against the local stand-in server (see conftest.py)
+"""
+
+#Imports
+import os
+import threading
+import pytest
+import grid_download
+import file_lock
+
+
+#NetCDF signature followed by filler, so verify_file accepts the file
+def netcdf_bytes(size, fill = b'a'):
+    return b'CDF\x01' + fill * (size - 4)
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setitem(grid_download.DOWNLOAD_CONFIG, 'chunk_size', 1024)
+
+
+def read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def test_download_then_skip(server, tmp_path):
+    data = netcdf_bytes(50000)
+    server.publish('m.nc', data)
+    target = str(tmp_path / 'out')
+    os.makedirs(target)
+
+    first = grid_download.download_with_retries(server.url + '/m.nc', target)
+    assert first['status'] == 'downloaded'
+    assert read(first['path']) == data
+    assert not os.path.exists(first['path'] + '.part')
+    assert not os.path.exists(first['path'] + '.lock')
+
+    second = grid_download.download_with_retries(server.url + '/m.nc', target)
+    assert second['status'] == 'skipped'
+    assert len(server.requests('GET')) == 1
+
+
+def test_resume_after_interrupted_transfer(server, tmp_path):
+    data = netcdf_bytes(60000, b'r')
+    server.publish('m.nc', data)
+    server.truncate_once.add('m.nc')
+
+    result = grid_download.download_with_retries(server.url + '/m.nc', str(tmp_path))
+    assert result['status'] == 'resumed'
+    assert read(result['path']) == data
+    gets = server.requests('GET')
+    assert gets[0][2] is None
+    assert gets[1][2] is not None and gets[1][2].startswith('bytes=') and gets[1][2] != 'bytes=0-'
+
+
+def test_part_from_old_version_is_discarded(server, tmp_path):
+    server.publish('m.nc', netcdf_bytes(30000, b'1'))
+    url = server.url + '/m.nc'
+    full_path = str(tmp_path / 'm.nc')
+    #half a file from the old version, with its validators
+    with open(full_path + '.part', 'wb') as file:
+        file.write(netcdf_bytes(30000, b'1')[:15000])
+    grid_download.write_meta(full_path + '.part', grid_download.remote_info(url))
+
+    new = netcdf_bytes(30000, b'2')
+    server.publish('m.nc', new)
+    os.utime(os.path.join(server.root, 'm.nc'), (1, 1))
+    result = grid_download.download_file(url, full_path)
+    assert result['status'] == 'downloaded'
+    assert read(full_path) == new
+    assert server.requests('GET')[-1][2] is None
+
+
+def test_if_range_mismatch_restarts_from_zero(server, tmp_path):
+    old = netcdf_bytes(30000, b'1')
+    new = netcdf_bytes(30000, b'2')
+    server.publish('m.nc', old)
+    url = server.url + '/m.nc'
+    full_path = str(tmp_path / 'm.nc')
+    with open(full_path + '.part', 'wb') as file:
+        file.write(old[:10000])
+    grid_download.write_meta(full_path + '.part', grid_download.remote_info(url))
+
+    #the file changes between the HEAD check and the GET, so the server ignores the Range and sends the new file
+    def replace(name):
+        server.after_head = None
+        server.publish('m.nc', new)
+        os.utime(os.path.join(server.root, 'm.nc'), (1, 1))
+    server.after_head = replace
+
+    result = grid_download.download_file(url, full_path)
+    assert server.requests('GET')[-1][2] == 'bytes=10000-'
+    assert result['status'] == 'downloaded'
+    assert read(full_path) == new
+    assert result['sha256'] == grid_download.file_checksum(full_path)
+
+
+def test_size_mismatch_fails_verification(server, tmp_path, monkeypatch):
+    monkeypatch.setitem(grid_download.DOWNLOAD_CONFIG, 'max_attempts', 2)
+    server.publish('m.nc', netcdf_bytes(20000))
+    server.head_size['m.nc'] = 25000
+
+    result = grid_download.download_with_retries(server.url + '/m.nc', str(tmp_path))
+    assert result['status'] == 'failed'
+    assert 'expected 25000 bytes' in result['error']
+    assert not os.path.exists(result['path'])
+    assert not os.path.exists(result['path'] + '.part')
+
+
+def test_concurrent_downloads_of_one_file(server, tmp_path):
+    data = netcdf_bytes(40000, b'c')
+    server.publish('m.nc', data)
+    server.delay = 0.5
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(grid_download.download_with_retries(server.url + '/m.nc', str(tmp_path)))) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(result['status'] for result in results) == ['downloaded', 'skipped', 'skipped']
+    assert len(server.requests('GET')) == 1
+    assert read(str(tmp_path / 'm.nc')) == data
+
+
+def test_modified_file_is_checked_against_checksum(server, tmp_path):
+    data = netcdf_bytes(20000, b'k')
+    server.publish('m.nc', data)
+    url = server.url + '/m.nc'
+    full_path = str(tmp_path / 'm.nc')
+    grid_download.download_file(url, full_path)
+
+    #touched but unchanged: kept, and not hashed again next time
+    os.utime(full_path, (5, 5))
+    assert grid_download.download_file(url, full_path)['status'] == 'skipped'
+    assert grid_download.read_meta(full_path)['mtime'] == 5
+
+    #same size but different content: downloaded again
+    with open(full_path, 'r+b') as file:
+        file.seek(100)
+        file.write(b'XXXX')
+    result = grid_download.download_file(url, full_path)
+    assert result['status'] == 'downloaded'
+    assert read(full_path) == data
+
+
+def test_stale_lock_is_broken(tmp_path, monkeypatch):
+    monkeypatch.setitem(file_lock.LOCK_CONFIG, 'stale', 10)
+    path = str(tmp_path / 'm.nc')
+    with open(path + '.lock', 'w') as file:
+        file.write('1')
+    os.utime(path + '.lock', (1, 1))
+    with file_lock.FileLock(path, timeout=1):
+        assert os.path.exists(path + '.lock')
+    assert not os.path.exists(path + '.lock')
+
+
+def test_held_lock_times_out(tmp_path):
+    path = str(tmp_path / 'm.nc')
+    with file_lock.FileLock(path):
+        with pytest.raises(TimeoutError):
+            file_lock.FileLock(path, timeout=0.3).acquire()
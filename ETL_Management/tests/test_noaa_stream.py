@@ -0,0 +1,93 @@
+"""
+Tests for the streamed downloads of noaa_etl_manager.py against a stand-in database connection
+"""
+
+#Imports
+import json
+import warnings
+from decimal import Decimal
+from datetime import datetime
+import pytest
+import noaa_etl_manager
+
+
+COLUMNS = ['station', 'datatype', 'date', 'value', 'latitude', 'longitude', 'elevation', 'name']
+
+#rows as psycopg2 returns them from noaa_api: NUMERIC columns as Decimal, TIMESTAMP as datetime
+ROWS = [
+    ('GHCND:S0', 'PRCP', datetime(2023, 1, 1), Decimal('1.5'), Decimal('44.97'), Decimal('-93.26'), '256.0', 'Station 0'),
+    ('GHCND:S0', 'TMAX', datetime(2023, 1, 1), Decimal('-3'), Decimal('44.97'), Decimal('-93.26'), '256.0', 'Station 0'),
+    ('GHCND:S1', 'PRCP', datetime(2023, 1, 2), None, Decimal('45.1'), Decimal('-94'), '300.0', 'Station "1"\nnorth'),
+]
+
+
+"""
+Class StandInCursor
+Serves ROWS for any query, with the parts of the psycopg2 cursor the manager and pd.read_sql_query use.
+fetchmany returns at most two rows, so streamed records are split over several fragments.
+"""
+class StandInCursor:
+    def __init__(self):
+        self.description = None
+        self.itersize = None
+        self.position = 0
+
+    def execute(self, query, params = None):
+        self.description = [(column,) for column in COLUMNS]
+
+    def fetchmany(self, size):
+        rows = ROWS[self.position:self.position + min(size, 2)]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = ROWS[self.position:]
+        self.position = len(ROWS)
+        return rows
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    def __init__(self):
+        self.closed = 0
+
+    def cursor(self, name = None):
+        return StandInCursor()
+
+    def close(self):
+        self.closed += 1
+
+
+SQL = {'SELECT': 'SELECT *', 'FROM': 'FROM noaa_api', 'WHERE': 'WHERE 1 = 1', 'PARAMS': []}
+
+
+@pytest.fixture
+def manager():
+    return noaa_etl_manager.NOAAETLManager({'Additional_Arguments': None})
+
+
+def test_streamed_json_matches_download(manager):
+    with warnings.catch_warnings():
+        #pandas warns about connections that aren't SQLAlchemy or sqlite3
+        warnings.simplefilter('ignore', UserWarning)
+        frame = manager.execute_sql(SQL, StandInConnection(), download=True)
+    downloaded = json.loads(frame.to_json(orient="records", lines = False, indent = 4))
+
+    connection = StandInConnection()
+    response = manager.stream_response(SQL, connection, 'JSON')
+    streamed = json.loads(response.get_data(as_text=True))
+    response.close()
+
+    assert streamed == downloaded
+    assert isinstance(streamed[0]['value'], float)
+    assert streamed[0]['date'] == downloaded[0]['date']
+    assert streamed[2]['value'] is None
+    assert connection.closed == 1
+
+
+def test_streamed_json_without_rows(manager, monkeypatch):
+    monkeypatch.setattr(StandInCursor, 'fetchmany', lambda self, size: [])
+    response = manager.stream_response(SQL, StandInConnection(), 'JSON')
+    assert json.loads(response.get_data(as_text=True)) == []
@@ -0,0 +1,20 @@
+-- Indexes for the NOAA GHCNd observations table (noaa_api)
+-- Run once against your database after creating the noaa_api table in NOAA_API_LOAD_DB.ipynb:
+--     psql -h localhost -U postgres -d postgres -f noaa_api_indexes.sql
+--
+-- The ETL manager filters noaa_api by station, datatype, and a date range (see generate_sql in noaa_etl_manager.py).
+-- A composite index in that order lets those range scans read only the index. value is stored in the index
+-- as well, so counts and aggregations over a request never have to visit the table itself.
+-- CONCURRENTLY builds the index without blocking inserts from running fill_incomplete threads.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS noaa_api_station_datatype_date_idx
+    ON noaa_api (station, datatype, date)
+    INCLUDE (value);
+
+-- Requests without a station list (ex. every station for one datatype) can't use the index above,
+-- this one covers datatype and date range only requests.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS noaa_api_datatype_date_idx
+    ON noaa_api (datatype, date);
+
+-- Index-only scans depend on the visibility map, and the planner needs fresh statistics to pick the new indexes.
+VACUUM ANALYZE noaa_api;
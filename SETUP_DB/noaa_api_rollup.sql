@@ -0,0 +1,41 @@
+-- Weekly, monthly, and yearly summaries of the noaa_api table
+-- Run this once against your database after the noaa_api table exists (safe to run again, it rebuilds the summaries).
+--     psql -h localhost -U postgres -d postgres -f noaa_api_rollup.sql
+-- NOAAETLManager reads aggregated requests from this table when the request covers whole weeks, months, or years
+-- and every aggregation style is one of mean, sum, min, max, or count. Rows added or removed by Call_Fill_Incomplete
+-- update the summaries for the station-months they touch. Rows loaded into noaa_api some other way need this file re-run.
+
+-- one row per period, station, and data type
+-- date is the period label, the last day of the period (weeks run Monday to Sunday)
+CREATE TABLE IF NOT EXISTS noaa_api_rollup (
+    period_type VARCHAR(16) NOT NULL,
+    date DATE NOT NULL,
+    station VARCHAR NOT NULL,
+    datatype VARCHAR NOT NULL,
+    value_sum NUMERIC,
+    value_count BIGINT,
+    value_min NUMERIC,
+    value_max NUMERIC,
+    latitude NUMERIC,
+    longitude NUMERIC,
+    elevation VARCHAR,
+    name VARCHAR,
+    PRIMARY KEY (period_type, station, datatype, date)
+);
+
+-- (re)build every summary from the raw rows
+BEGIN;
+TRUNCATE noaa_api_rollup;
+INSERT INTO noaa_api_rollup (period_type, date, station, datatype, value_sum, value_count, value_min, value_max, latitude, longitude, elevation, name)
+SELECT p.period_type, p.label, n.station, n.datatype, SUM(n.value), COUNT(n.value), MIN(n.value), MAX(n.value),
+       MIN(n.latitude), MIN(n.longitude), MIN(n.elevation), MIN(n.name)
+FROM noaa_api n
+CROSS JOIN LATERAL (VALUES
+    ('weekly', (date_trunc('week', n.date) + interval '6 days')::date),
+    ('monthly', (date_trunc('month', n.date) + interval '1 month' - interval '1 day')::date),
+    ('yearly', (date_trunc('year', n.date) + interval '1 year' - interval '1 day')::date)
+) AS p(period_type, label)
+GROUP BY p.period_type, p.label, n.station, n.datatype;
+COMMIT;
+
+ANALYZE noaa_api_rollup;